@@ -1,5 +1,5 @@
 from fastapi import Request, HTTPException, APIRouter, Response, Query
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -52,10 +52,27 @@ def clip_vector_from_image_path(request: Request,
                                 bucket: str = "datasets"):
     clip_server = request.app.clip_server
 
-    similarity_list = clip_server.compute_cosine_match_value_list(phrase, bucket, image_path)
+    similarity_list, timing = clip_server.compute_cosine_match_value_list_with_timing(phrase, bucket, image_path)
 
     return {
-        "similarity_list" : similarity_list
+        "similarity_list" : similarity_list,
+        "timing" : timing
+    }
+
+@router.get("/search-images")
+def search_images(request: Request,
+                  phrase: str,
+                  k: int = 20,
+                  bucket: str = "datasets",
+                  dataset: Optional[List[str]] = Query(None),
+                  start_date: Optional[str] = None,
+                  end_date: Optional[str] = None):
+    clip_server = request.app.clip_server
+
+    images = clip_server.search_images(phrase, bucket, k, dataset, start_date, end_date)
+
+    return {
+        "images" : images
     }
 
 @router.get("/image-clip")
@@ -68,6 +85,18 @@ def clip_vector_from_image_path(request: Request,
 
     return image_clip_vector_numpy
 
+@router.post("/image-clip-list")
+def image_clip_list(request: Request,
+                    image_path: List[str],
+                    bucket: str = "datasets"):
+    clip_server = request.app.clip_server
+
+    clip_vector_list = clip_server.get_image_clip_vector_list(bucket, image_path)
+
+    return {
+        "clip_vector_list" : clip_vector_list
+    }
+
 @router.put("/add-phrase")
 def add_job(request: Request, phrase : str):
     clip_server = request.app.clip_server
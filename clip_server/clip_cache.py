@@ -6,13 +6,15 @@ import os
 import json
 import msgpack
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.clip.clip import ClipModel
 from clip_utils import get_image_clip_from_minio
-from clip_constants import BUCKET_NAME
+from clip_constants import BUCKET_NAME, CLIP_VECTOR_DOWNLOAD_WORKERS, CLIP_SYNC_STATE_FILE_NAME
+from clip_vector_store import ClipVectorStore
 
 class ClipFile:
     def __init__(self, clip_vector_max_count, clip_vector_list):
@@ -66,29 +68,95 @@ class ClipCache:
         # self.clip_model = ClipModel(device=device)
         self.device = device
         self.clip_cache_directory = clip_cache_directory
-        self.clip_vector_dictionary_lock = threading.Lock()
-        self.clip_vector_dictionary = {}
+        # one memory mapped vector store per bucket
+        self.clip_vector_store_dictionary_lock = threading.Lock()
+        self.clip_vector_store_dictionary = {}
+        # shared by all the requests, so the number of
+        # concurrent gets never exceeds the minio connection pool
+        self.download_executor = ThreadPoolExecutor(max_workers=CLIP_VECTOR_DOWNLOAD_WORKERS)
+
+    def get_clip_vector_store(self, bucket):
+        with self.clip_vector_store_dictionary_lock:
+            if bucket not in self.clip_vector_store_dictionary:
+                store_directory = os.path.join(self.clip_cache_directory, bucket)
+                self.clip_vector_store_dictionary[bucket] = ClipVectorStore(store_directory)
+
+            return self.clip_vector_store_dictionary[bucket]
 
     # the cache has two levels
-    # the first one is the memory
-    # second one is the hard drive
-    def cache_clip_vector(self, image_path, clip_vector):
+    # the first one is the memory mapped store on the hard drive
+    # second one is minio
+    def cache_clip_vector(self, bucket, image_path, clip_vector):
         # TODO(): implement ssh cache
-        # TODO(): memory mapped clip vector caching
-        with self.clip_vector_dictionary_lock:
-            if image_path not in self.clip_vector_dictionary:
-                self.clip_vector_dictionary[image_path] = clip_vector
+        clip_vector_store = self.get_clip_vector_store(bucket)
+        clip_vector_store.add_clip_vector(image_path, clip_vector)
 
     def get_clip_vector(self, bucket, image_path):
         # if its already in the cache just return it
-        with self.clip_vector_dictionary_lock:
-            if image_path in self.clip_vector_dictionary:
-                return self.clip_vector_dictionary[image_path]
+        clip_vector_store = self.get_clip_vector_store(bucket)
+        image_clip_vector_numpy = clip_vector_store.get_clip_vector(image_path)
+        if image_clip_vector_numpy is not None:
+            return image_clip_vector_numpy
 
         image_clip_vector_numpy = self.get_clip_vector_from_minio(bucket, image_path)
 
         return image_clip_vector_numpy
 
+    def get_clip_vectors(self, bucket, image_path_list):
+        # returns a (n, dim) matrix with the vectors that were found
+        # and the indices of image_path_list they belong to
+        clip_vector_store = self.get_clip_vector_store(bucket)
+
+        self.download_clip_vectors(bucket, image_path_list)
+
+        return clip_vector_store.get_clip_vectors(image_path_list)
+
+    def download_clip_vectors(self, bucket, image_path_list):
+        # download the vectors that are not cached concurrently
+        # they are added to the store as they arrive
+        # returns the image paths that have no clip vector in minio
+        clip_vector_store = self.get_clip_vector_store(bucket)
+
+        missing_image_path_list = [image_path for image_path in image_path_list if image_path not in clip_vector_store]
+        if len(missing_image_path_list) == 0:
+            return []
+
+        clip_vector_list = list(self.download_executor.map(lambda image_path: self.get_clip_vector_from_minio(bucket, image_path),
+                                                           missing_image_path_list))
+
+        not_found_image_path_list = []
+        for image_path, clip_vector in zip(missing_image_path_list, clip_vector_list):
+            if clip_vector is None:
+                not_found_image_path_list.append(image_path)
+
+        return not_found_image_path_list
+
+    def load_sync_state(self, bucket):
+        sync_state_path = os.path.join(self.clip_cache_directory, bucket, CLIP_SYNC_STATE_FILE_NAME)
+        try:
+            with open(sync_state_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"An error occurred while loading the sync state: {str(e)}")
+            return None
+
+    def save_sync_state(self, bucket, sync_state):
+        bucket_directory = os.path.join(self.clip_cache_directory, bucket)
+        os.makedirs(bucket_directory, exist_ok=True)
+
+        # write to a temporary file first
+        # so a crash never leaves a half written state
+        sync_state_path = os.path.join(bucket_directory, CLIP_SYNC_STATE_FILE_NAME)
+        temporary_path = sync_state_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(sync_state, file)
+        os.replace(temporary_path, sync_state_path)
+
+    def is_clip_vector_cached(self, bucket, image_path):
+        return image_path in self.get_clip_vector_store(bucket)
+
     def get_clip_vector_from_minio(self, bucket, image_path):
         # if its not in the cache
         # get the clip vector from minio
@@ -101,9 +169,24 @@ class ClipCache:
             return None
 
         # the image clip vector was loaded correctly
-        self.cache_clip_vector(image_path, image_clip_vector_numpy)
+        self.cache_clip_vector(bucket, image_path, image_clip_vector_numpy)
 
-        return image_clip_vector_numpy
+        return self.get_clip_vector_store(bucket).get_clip_vector(image_path)
+
+    def load_all_clip_vector_stores(self):
+        # maps the stores already on the hard drive
+        # so a restart does not need to download anything
+        self.create_cache_directory_if_not_exists()
+        for bucket in self.list_cache_directory_files():
+            if os.path.isdir(os.path.join(self.clip_cache_directory, bucket)):
+                self.get_clip_vector_store(bucket)
+
+    def flush(self):
+        with self.clip_vector_store_dictionary_lock:
+            clip_vector_store_list = list(self.clip_vector_store_dictionary.values())
+
+        for clip_vector_store in clip_vector_store_list:
+            clip_vector_store.flush()
 
     def create_cache_directory_if_not_exists(self):
         clip_cache_directory = self.clip_cache_directory
@@ -5,3 +5,21 @@ CLIP_CACHE_DIRECTORY = './clip_cache/'
 
 # bucket name is hard coded to datasets
 BUCKET_NAME = 'datasets'
+
+# number of threads used to download
+# the clip vectors that are not cached
+CLIP_VECTOR_DOWNLOAD_WORKERS = 16
+
+# the sync state of each bucket (last cursor of the
+# orchestration feed) is stored in the bucket cache directory
+CLIP_SYNC_STATE_FILE_NAME = 'sync_state.json'
+
+# number of images requested to orchestration per call
+CLIP_SYNC_PAGE_SIZE = 10000
+
+# images whose clip vector was not in minio yet
+# are retried on the next syncs, up to this many
+CLIP_SYNC_MAX_RETRY_IMAGES = 100000
+
+# time between two syncs of the clip vectors
+CLIP_SYNC_INTERVAL_IN_SECONDS = 10 * 60
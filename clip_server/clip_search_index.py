@@ -0,0 +1,406 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    # faiss is optional (see faiss_requirements.txt)
+    # without it the search is exact and done with numpy
+    faiss = None
+
+
+# metadata of the rows of a clip vector store
+# one json object per line: image path, dataset, date
+CLIP_VECTOR_METADATA_ROWS_FILE_NAME = 'clip_vector_metadata.jsonl'
+
+# the hnsw graph of the store, saved next to it so a restart only adds the new rows
+# its vectors are kept as float16, half the memory of a float32 copy of the store
+CLIP_SEARCH_INDEX_FILE_NAME = 'clip_search_index.faiss'
+
+# number of neighbors of each node in the hnsw graph
+HNSW_NUM_NEIGHBORS = 32
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 128
+
+# rows added to the graph per lock, so searches run between the chunks
+GRAPH_BUILD_CHUNK_SIZE = 16384
+
+# dates are kept as fixed width iso strings
+DATE_DTYPE = '<U32'
+# length of a date without a time, yyyy-mm-dd
+DATE_ONLY_LENGTH = 10
+
+# rows scored at once by the exact search
+EXACT_SEARCH_CHUNK_SIZE = 65536
+
+# when filtering the approximate results we ask the index
+# for more neighbors than needed, and grow it until enough survive
+SEARCH_OVERSAMPLE_FACTOR = 4
+SEARCH_MAX_OVERSAMPLE_FACTOR = 256
+
+
+def get_end_date_bound(end_date):
+    # returns (bound, inclusive)
+    # a date without a time is the whole day: the dates before the next day
+    if not isinstance(end_date, str):
+        # date or datetime
+        end_date = end_date.isoformat()
+
+    if len(end_date) == DATE_ONLY_LENGTH:
+        next_day = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+        return next_day.strftime('%Y-%m-%d'), False
+
+    return end_date, True
+
+
+class BucketSearchIndex:
+    def __init__(self, clip_vector_store, use_faiss=True):
+        self.clip_vector_store = clip_vector_store
+        self.dim = clip_vector_store.dim
+        self.lock = threading.Lock()
+
+        # number of rows of the store that are in the index
+        self.num_indexed = 0
+
+        # the graph is built by a background thread and can be behind num_indexed,
+        # the rows that aren't in it yet are searched exactly
+        self.faiss_index = None
+        self.faiss_index_path = os.path.join(clip_vector_store.store_directory, CLIP_SEARCH_INDEX_FILE_NAME)
+        self.graph_build_thread = None
+        self.graph_build_pending = False
+        self.graph_build_lock = threading.Lock()
+        if use_faiss and faiss is not None:
+            self.faiss_index = self.load_faiss_index()
+
+        # 1 / norm of every indexed row, used by the exact search
+        # so the memory mapped matrix never needs to be copied
+        self.inverse_norms = np.zeros(0, dtype=np.float32)
+
+        # dataset & date of every row
+        self.dataset_names = []
+        self.dataset_name_to_id = {}
+        self.row_dataset_ids = np.zeros(0, dtype=np.int32)
+        # iso date strings, empty when the date is not known
+        self.row_dates = np.zeros(0, dtype=DATE_DTYPE)
+        self.image_metadata = {}
+
+        self.metadata_path = os.path.join(clip_vector_store.store_directory, CLIP_VECTOR_METADATA_ROWS_FILE_NAME)
+        self.metadata_lock = threading.Lock()
+        self.load_metadata()
+        self.metadata_file = open(self.metadata_path, 'a')
+
+    def create_faiss_index(self):
+        faiss_index = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_fp16, HNSW_NUM_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+        faiss_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+
+        return faiss_index
+
+    def load_faiss_index(self):
+        if os.path.exists(self.faiss_index_path):
+            try:
+                faiss_index = faiss.read_index(self.faiss_index_path)
+                # the store is append only, the graph holds its first rows
+                if faiss_index.d == self.dim and faiss_index.ntotal <= len(self.clip_vector_store):
+                    faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+                    print(f'loaded the search index {self.faiss_index_path} with {faiss_index.ntotal} vectors')
+                    return faiss_index
+            except Exception as e:
+                print(f'Error loading the search index {self.faiss_index_path}: {e}')
+
+        return self.create_faiss_index()
+
+    def save_faiss_index(self):
+        # only the build thread changes the graph, it can be written without the lock
+        temp_path = f'{self.faiss_index_path}.{os.getpid()}.tmp'
+        faiss.write_index(self.faiss_index, temp_path)
+        os.replace(temp_path, self.faiss_index_path)
+
+    def load_metadata(self):
+        if not os.path.exists(self.metadata_path):
+            return
+
+        with open(self.metadata_path, 'r') as file:
+            for line in file:
+                try:
+                    metadata = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line
+                    continue
+                self.image_metadata[metadata['image_path']] = (metadata['dataset'], metadata['date'])
+
+    def set_image_metadata(self, image_path, dataset, date):
+        with self.metadata_lock:
+            if self.image_metadata.get(image_path) == (dataset, date):
+                return
+
+            self.image_metadata[image_path] = (dataset, date)
+            self.metadata_file.write(json.dumps({'image_path': image_path, 'dataset': dataset, 'date': date}) + '\n')
+            self.metadata_file.flush()
+
+        with self.lock:
+            # the row might already be indexed
+            row = self.clip_vector_store.get_row(image_path)
+            if row is not None and row < self.num_indexed:
+                self.row_dataset_ids[row] = self.get_dataset_id(dataset)
+                self.row_dates[row] = date if date is not None else ''
+
+    def get_dataset_id(self, dataset):
+        if dataset not in self.dataset_name_to_id:
+            self.dataset_name_to_id[dataset] = len(self.dataset_names)
+            self.dataset_names.append(dataset)
+
+        return self.dataset_name_to_id[dataset]
+
+    def get_row_metadata(self, image_path):
+        if image_path in self.image_metadata:
+            return self.image_metadata[image_path]
+
+        # images are stored as dataset/xxxx/xxxxxx.jpg
+        return image_path.split('/')[0], None
+
+    def get_normalized_rows(self, start, end):
+        rows = np.asarray(self.clip_vector_store.get_matrix()[start:end], dtype=np.float32)
+        norms = np.linalg.norm(rows, axis=1)
+        norms[norms == 0] = 1.0
+
+        return rows / norms[:, None], (1.0 / norms).astype(np.float32)
+
+    def update(self):
+        # adds the rows appended to the store since the last update to the filters and the exact search,
+        # the graph is updated in the background
+        with self.lock:
+            num_rows = len(self.clip_vector_store)
+            if num_rows <= self.num_indexed:
+                return 0
+
+            inverse_norms_list = [self.inverse_norms]
+            for start in range(self.num_indexed, num_rows, EXACT_SEARCH_CHUNK_SIZE):
+                _, inverse_norms = self.get_normalized_rows(start, min(start + EXACT_SEARCH_CHUNK_SIZE, num_rows))
+                inverse_norms_list.append(inverse_norms)
+
+            with self.metadata_lock:
+                row_metadata_list = [self.get_row_metadata(self.clip_vector_store.row_to_path[row])
+                                     for row in range(self.num_indexed, num_rows)]
+
+            self.inverse_norms = np.concatenate(inverse_norms_list)
+            self.row_dataset_ids = np.concatenate([self.row_dataset_ids,
+                                                   np.array([self.get_dataset_id(dataset) for dataset, _ in row_metadata_list],
+                                                            dtype=np.int32)])
+            self.row_dates = np.concatenate([self.row_dates,
+                                             np.array([date if date is not None else '' for _, date in row_metadata_list],
+                                                      dtype=DATE_DTYPE)])
+
+            num_added = num_rows - self.num_indexed
+            self.num_indexed = num_rows
+
+        self.start_graph_build()
+
+        return num_added
+
+    def start_graph_build(self):
+        if self.faiss_index is None:
+            return
+
+        with self.graph_build_lock:
+            # a running build picks up the new rows before it stops
+            self.graph_build_pending = True
+            if self.graph_build_thread is not None:
+                return
+
+            self.graph_build_thread = threading.Thread(target=self.build_graph, daemon=True)
+            self.graph_build_thread.start()
+
+    def build_graph(self):
+        while True:
+            with self.graph_build_lock:
+                if not self.graph_build_pending:
+                    self.graph_build_thread = None
+                    return
+                self.graph_build_pending = False
+
+            try:
+                self.add_rows_to_graph()
+            except Exception as e:
+                print(f'Error building the search graph {self.faiss_index_path}: {e}')
+
+    def add_rows_to_graph(self):
+        # adds the indexed rows that aren't in the graph yet, one chunk per lock
+        num_added = 0
+        while True:
+            with self.lock:
+                start = self.faiss_index.ntotal
+                end = min(start + GRAPH_BUILD_CHUNK_SIZE, self.num_indexed)
+            if start >= end:
+                break
+
+            normalized_rows, _ = self.get_normalized_rows(start, end)
+            with self.lock:
+                if not self.faiss_index.is_trained:
+                    self.faiss_index.train(normalized_rows)
+                self.faiss_index.add(np.ascontiguousarray(normalized_rows))
+            num_added += end - start
+
+        if num_added > 0:
+            try:
+                self.save_faiss_index()
+            except Exception as e:
+                print(f'Error saving the search index {self.faiss_index_path}: {e}')
+            print(f'added {num_added} clip vectors to the search graph {self.faiss_index_path}')
+
+    def get_filter_mask(self, dataset_list, start_date, end_date):
+        # returns None when nothing is filtered
+        if not dataset_list and start_date is None and end_date is None:
+            return None
+
+        mask = np.ones(self.num_indexed, dtype=bool)
+
+        if dataset_list:
+            dataset_id_list = [self.dataset_name_to_id[dataset] for dataset in dataset_list
+                               if dataset in self.dataset_name_to_id]
+            mask &= np.isin(self.row_dataset_ids, dataset_id_list)
+
+        if start_date is not None or end_date is not None:
+            # dates are iso strings, so they compare in order
+            # images without a known date never match a date filter
+            mask &= self.row_dates != ''
+            if start_date is not None:
+                mask &= self.row_dates >= start_date
+            if end_date is not None:
+                end_date_bound, inclusive = get_end_date_bound(end_date)
+                if inclusive:
+                    mask &= self.row_dates <= end_date_bound
+                else:
+                    mask &= self.row_dates < end_date_bound
+
+        return mask
+
+    def search_exact(self, query, k, mask, start_row=0):
+        # searches the rows from start_row
+        matrix = self.clip_vector_store.get_matrix()[:self.num_indexed]
+
+        scores = np.empty(self.num_indexed - start_row, dtype=np.float32)
+        for start in range(start_row, self.num_indexed, EXACT_SEARCH_CHUNK_SIZE):
+            end = min(start + EXACT_SEARCH_CHUNK_SIZE, self.num_indexed)
+            chunk = np.asarray(matrix[start:end], dtype=np.float32)
+            scores[start - start_row:end - start_row] = (chunk @ query) * self.inverse_norms[start:end]
+
+        candidate_rows = np.arange(start_row, self.num_indexed)
+        if mask is not None:
+            candidate_rows = candidate_rows[mask[start_row:]]
+            scores = scores[mask[start_row:]]
+
+        k = min(k, len(candidate_rows))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        top_k = np.argpartition(-scores, k - 1)[:k]
+        top_k = top_k[np.argsort(-scores[top_k])]
+
+        return candidate_rows[top_k], scores[top_k]
+
+    def search_graph(self, query, k, mask):
+        num_graph_rows = self.faiss_index.ntotal
+        if mask is not None:
+            mask = mask[:num_graph_rows]
+        num_candidates = mask.sum() if mask is not None else num_graph_rows
+        oversample_factor = SEARCH_OVERSAMPLE_FACTOR if mask is not None else 1
+
+        while True:
+            num_neighbors = min(k * oversample_factor, num_graph_rows)
+            scores, rows = self.faiss_index.search(query[None, :], num_neighbors)
+            scores, rows = scores[0], rows[0]
+
+            valid = rows >= 0
+            if mask is not None:
+                valid &= mask[np.maximum(rows, 0)]
+            rows, scores = rows[valid], scores[valid]
+
+            if len(rows) >= min(k, num_candidates) or num_neighbors >= num_graph_rows:
+                return rows[:k], scores[:k]
+
+            if oversample_factor >= SEARCH_MAX_OVERSAMPLE_FACTOR:
+                # the filter is too selective for the graph
+                # an exact search over the few candidates is cheaper
+                exact_mask = np.zeros(self.num_indexed, dtype=bool)
+                exact_mask[:num_graph_rows] = mask if mask is not None else True
+                return self.search_exact(query, k, exact_mask)
+
+            oversample_factor *= 4
+
+    def search_approximate(self, query, k, mask):
+        num_graph_rows = self.faiss_index.ntotal
+        if num_graph_rows == 0:
+            return self.search_exact(query, k, mask)
+
+        rows, scores = self.search_graph(query, k, mask)
+        if num_graph_rows >= self.num_indexed:
+            return rows, scores
+
+        # rows that the background build didn't add to the graph yet
+        tail_rows, tail_scores = self.search_exact(query, k, mask, start_row=num_graph_rows)
+        rows = np.concatenate([rows, tail_rows])
+        scores = np.concatenate([scores, tail_scores])
+        top_k = np.argsort(-scores, kind='stable')[:k]
+
+        return rows[top_k], scores[top_k]
+
+    def search(self, query_clip_vector, k, dataset_list=None, start_date=None, end_date=None):
+        # the rows are added by the syncs (update), searches never index anything
+        query = np.asarray(query_clip_vector, dtype=np.float32).reshape(-1)
+        assert query.shape == (self.dim,), f"Expected size ({self.dim},), but got {query.shape}"
+        query = query / max(np.linalg.norm(query), 1e-12)
+
+        with self.lock:
+            if self.num_indexed == 0 or k <= 0:
+                return []
+
+            mask = self.get_filter_mask(dataset_list, start_date, end_date)
+
+            if self.faiss_index is not None:
+                rows, scores = self.search_approximate(query, k, mask)
+            else:
+                rows, scores = self.search_exact(query, k, mask)
+
+            result = []
+            for row, score in zip(rows.tolist(), scores.tolist()):
+                result.append({
+                    'image_path': self.clip_vector_store.row_to_path[row],
+                    'dataset': self.dataset_names[self.row_dataset_ids[row]],
+                    'date': str(self.row_dates[row]) or None,
+                    'similarity_score': score,
+                })
+
+            return result
+
+
+class ClipSearchIndex:
+    def __init__(self, clip_cache, use_faiss=True):
+        self.clip_cache = clip_cache
+        self.use_faiss = use_faiss
+        self.bucket_index_dictionary_lock = threading.Lock()
+        self.bucket_index_dictionary = {}
+
+    def get_bucket_index(self, bucket):
+        with self.bucket_index_dictionary_lock:
+            if bucket not in self.bucket_index_dictionary:
+                clip_vector_store = self.clip_cache.get_clip_vector_store(bucket)
+                self.bucket_index_dictionary[bucket] = BucketSearchIndex(clip_vector_store, self.use_faiss)
+
+            return self.bucket_index_dictionary[bucket]
+
+    def set_image_metadata(self, bucket, image_path, dataset, date):
+        self.get_bucket_index(bucket).set_image_metadata(image_path, dataset, date)
+
+    def update(self, bucket):
+        num_added = self.get_bucket_index(bucket).update()
+        if num_added > 0:
+            print(f'added {num_added} clip vectors to the {bucket} search index')
+
+        return num_added
+
+    def search(self, bucket, query_clip_vector, k, dataset_list=None, start_date=None, end_date=None):
+        return self.get_bucket_index(bucket).search(query_clip_vector, k, dataset_list, start_date, end_date)
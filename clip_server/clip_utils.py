@@ -1,36 +1,46 @@
 import sys
 import msgpack
+from minio.error import S3Error
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
-from utility.minio.cmd import get_file_from_minio, is_object_exists
 
-
-def get_image_clip_from_minio(minio_client, image_path, bucket_name):
+def get_image_clip_vector_path(image_path):
     # Removes the last 4 characters from the path
     # image.jpg => image
     base_path = image_path.rstrip(image_path[-4:])
 
     # finds the clip file associated with the image
-    image_clip_vector_path = f'{base_path}_clip_kandinsky.msgpack'
-
-    print(f'image clip vector path : {image_clip_vector_path}')
-    # get the clip.msgpack from minio
-    file_exists = is_object_exists(minio_client, bucket_name, image_clip_vector_path)
+    return f'{base_path}_clip_kandinsky.msgpack'
 
-    if not file_exists:
-        print(f'{image_clip_vector_path} does not exist')
-        return None
 
-    clip_vector_data_msgpack = get_file_from_minio(minio_client, bucket_name, image_clip_vector_path)
+def get_image_clip_from_minio(minio_client, image_path, bucket_name):
+    image_clip_vector_path = get_image_clip_vector_path(image_path)
 
-    if clip_vector_data_msgpack is None:
-        print(f'image not found {image_path}')
+    # get the clip.msgpack from minio
+    # a missing object is reported by the get itself
+    # so there is no need for a stat_object round trip before
+    response = None
+    try:
+        response = minio_client.get_object(bucket_name, image_clip_vector_path)
+
+        # read file_data_into memory
+        clip_vector_data_msgpack_memory = response.read()
+    except S3Error as e:
+        if e.code in ['NoSuchKey', 'NoSuchBucket']:
+            print(f'{image_clip_vector_path} does not exist')
+        else:
+            print(f'image not found {image_path}: {e}')
         return None
-
-    # read file_data_into memory
-    clip_vector_data_msgpack_memory = clip_vector_data_msgpack.read()
+    except Exception as e:
+        print(f'image not found {image_path}: {e}')
+        return None
+    finally:
+        if response is not None:
+            # give the connection back to the pool
+            response.close()
+            response.release_conn()
 
     try:
         # uncompress the msgpack data
@@ -41,4 +51,4 @@ def get_image_clip_from_minio(minio_client, image_path, bucket_name):
     except Exception as e:
         print('Exception details : ', e)
 
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,197 @@
+import os
+import json
+import threading
+import numpy as np
+
+
+# the store keeps all the clip vectors of one bucket
+# in a single contiguous matrix on the hard drive
+#
+# <store_directory>/clip_vectors.bin        raw matrix (capacity, dim)
+# <store_directory>/clip_vector_paths.txt   one image path per line, line i => row i
+# <store_directory>/clip_vector_store.json  dim & dtype of the matrix
+#
+# the matrix file is memory mapped, so lookups return
+# zero copy numpy views and the vectors are only paged in when used
+# new vectors are written into the free rows of the mapped file
+# when the file is full we grow it (doubling the capacity) and remap it
+# the file is never rewritten
+
+CLIP_VECTOR_MATRIX_FILE_NAME = 'clip_vectors.bin'
+CLIP_VECTOR_PATHS_FILE_NAME = 'clip_vector_paths.txt'
+CLIP_VECTOR_METADATA_FILE_NAME = 'clip_vector_store.json'
+
+DEFAULT_CLIP_VECTOR_DIM = 1280
+DEFAULT_CLIP_VECTOR_DTYPE = 'float16'
+DEFAULT_INITIAL_CAPACITY = 1024
+
+
+class ClipVectorStore:
+    def __init__(self, store_directory, dim=DEFAULT_CLIP_VECTOR_DIM, dtype=DEFAULT_CLIP_VECTOR_DTYPE,
+                 initial_capacity=DEFAULT_INITIAL_CAPACITY):
+        self.store_directory = store_directory
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.initial_capacity = initial_capacity
+
+        self.matrix_path = os.path.join(store_directory, CLIP_VECTOR_MATRIX_FILE_NAME)
+        self.paths_path = os.path.join(store_directory, CLIP_VECTOR_PATHS_FILE_NAME)
+        self.metadata_path = os.path.join(store_directory, CLIP_VECTOR_METADATA_FILE_NAME)
+
+        self.lock = threading.Lock()
+        # image_path => row index
+        self.path_to_row = {}
+        # row index => image_path
+        self.row_to_path = []
+        self.num_rows = 0
+        self.capacity = 0
+        self.matrix = None
+        self.paths_file = None
+
+        self.load()
+
+    def load(self):
+        os.makedirs(self.store_directory, exist_ok=True)
+
+        # the metadata wins over the constructor arguments
+        # so that an existing store is always read with its own layout
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'r') as file:
+                metadata = json.load(file)
+            self.dim = metadata['dim']
+            self.dtype = np.dtype(metadata['dtype'])
+        else:
+            with open(self.metadata_path, 'w') as file:
+                json.dump({'dim': self.dim, 'dtype': self.dtype.name}, file)
+
+        row_size = self.dim * self.dtype.itemsize
+
+        matrix_file_size = 0
+        if os.path.exists(self.matrix_path):
+            matrix_file_size = os.path.getsize(self.matrix_path)
+        rows_in_matrix_file = matrix_file_size // row_size
+
+        # the paths file is written after the vector
+        # so a row only counts if its path line was fully written
+        if os.path.exists(self.paths_path):
+            with open(self.paths_path, 'r') as file:
+                for line in file:
+                    if not line.endswith('\n'):
+                        # partially written line, the server died while appending
+                        break
+                    if len(self.row_to_path) >= rows_in_matrix_file:
+                        break
+                    image_path = line[:-1]
+                    self.path_to_row[image_path] = len(self.row_to_path)
+                    self.row_to_path.append(image_path)
+
+        self.num_rows = len(self.row_to_path)
+
+        # drop any partially written line at the end of the paths file
+        self.rewrite_paths_file_if_truncated()
+
+        capacity = max(rows_in_matrix_file, self.initial_capacity)
+        self.map_matrix(capacity)
+
+        self.paths_file = open(self.paths_path, 'a')
+
+        print(f'loaded clip vector store {self.store_directory} with {self.num_rows} vectors')
+
+    def rewrite_paths_file_if_truncated(self):
+        if not os.path.exists(self.paths_path):
+            return
+
+        expected_size = sum(len(path.encode('utf-8')) + 1 for path in self.row_to_path)
+        if os.path.getsize(self.paths_path) == expected_size:
+            return
+
+        with open(self.paths_path, 'r+') as file:
+            file.truncate(expected_size)
+
+    def map_matrix(self, capacity):
+        # grow the file on the hard drive
+        # the new rows are sparse zeros, nothing is rewritten
+        file_size = capacity * self.dim * self.dtype.itemsize
+        with open(self.matrix_path, 'ab') as file:
+            if file.tell() < file_size:
+                file.truncate(file_size)
+
+        # views handed out before the remap keep the old mapping alive
+        self.matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.num_rows
+
+    def __contains__(self, image_path):
+        return image_path in self.path_to_row
+
+    def get_row(self, image_path):
+        return self.path_to_row.get(image_path)
+
+    def get_clip_vector(self, image_path):
+        # returns a (1, dim) view into the memory mapped matrix
+        # same shape as the clip vectors stored in minio
+        with self.lock:
+            row = self.path_to_row.get(image_path)
+            if row is None:
+                return None
+
+            return self.matrix[row:row + 1]
+
+    def get_clip_vectors(self, image_path_list):
+        # returns the (n, dim) matrix of the vectors found
+        # and the indices of image_path_list they belong to
+        with self.lock:
+            found_index_list = []
+            row_list = []
+            for index, image_path in enumerate(image_path_list):
+                row = self.path_to_row.get(image_path)
+                if row is not None:
+                    found_index_list.append(index)
+                    row_list.append(row)
+
+            rows = np.asarray(row_list, dtype=np.int64)
+            return self.matrix[rows], found_index_list
+
+    def get_matrix(self):
+        # zero copy view of all the stored vectors
+        with self.lock:
+            return self.matrix[:self.num_rows]
+
+    def add_clip_vector(self, image_path, clip_vector):
+        clip_vector = np.asarray(clip_vector, dtype=self.dtype).reshape(-1)
+        assert clip_vector.shape == (self.dim,), f"Expected size ({self.dim},), but got {clip_vector.shape}"
+
+        with self.lock:
+            row = self.path_to_row.get(image_path)
+            if row is not None:
+                return row
+
+            if self.num_rows >= self.capacity:
+                self.matrix.flush()
+                self.map_matrix(self.capacity * 2)
+
+            row = self.num_rows
+            self.matrix[row] = clip_vector
+
+            # the path is written last
+            # this is the commit point of the row
+            self.paths_file.write(image_path + '\n')
+            self.paths_file.flush()
+
+            self.path_to_row[image_path] = row
+            self.row_to_path.append(image_path)
+            self.num_rows = row + 1
+
+            return row
+
+    def flush(self):
+        with self.lock:
+            self.matrix.flush()
+            self.paths_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.matrix.flush()
+            self.paths_file.close()
@@ -4,6 +4,7 @@ import pymongo
 from dotenv import dotenv_values
 from api.api_clip import router as clip_router
 from server_state import ClipServer
+from clip_constants import CLIP_SYNC_INTERVAL_IN_SECONDS, CLIP_VECTOR_DOWNLOAD_WORKERS
 from utility.minio import cmd
 import multiprocessing
 import uvicorn
@@ -30,24 +31,22 @@ def get_minio_client(minio_address, minio_access_key, minio_secret_key):
     while minio_client is None:
         # check minio server
         if cmd.is_minio_server_accessible(minio_address):
-            minio_client = cmd.connect_to_minio_client(minio_ip_addr=minio_address, access_key=minio_access_key, secret_key=minio_secret_key)
+            # one pooled connection per download thread
+            minio_client = cmd.connect_to_minio_client(minio_ip_addr=minio_address, access_key=minio_access_key, secret_key=minio_secret_key,
+                                                       max_pool_size=CLIP_VECTOR_DOWNLOAD_WORKERS)
             return minio_client
 
-# Gets list of completed jobs
-# For each image that is not in dictionary
+# Gets the images added since the last sync
+# For each image that is not in the cache
 # We will download from minio
 def check_new_images_and_download(clip_server):
     while True:
-        # TODO(): orchestration must provide an api
-        # TODO(): that will take in num_jobs & offset
-        # TODO(): so that we dont download millions of jobs each time
-        clip_server.download_all_clip_vectors("external")
-        clip_server.download_all_clip_vectors("extracts")
-        clip_server.download_all_clip_vectors("datasets")
+        # Sleep between two syncs
+        time.sleep(CLIP_SYNC_INTERVAL_IN_SECONDS)
 
-        # Sleep for 2 hours
-        sleep_time_in_seconds = 2.0 * 60 * 60
-        time.sleep(sleep_time_in_seconds)
+        clip_server.sync_clip_vectors("external")
+        clip_server.sync_clip_vectors("extracts")
+        clip_server.sync_clip_vectors("datasets")
 
 
 @app.on_event("startup")
@@ -61,16 +60,25 @@ def startup_db_client():
     app.clip_server = ClipServer(app.device, app.minio_client)
     app.clip_server.load_clip_model()
 
-    # downloads all clip vectors for external, extracts and datasets buckets
-    app.clip_server.download_all_clip_vectors("external")
-    app.clip_server.download_all_clip_vectors("extracts")
-    app.clip_server.download_all_clip_vectors("datasets")
+    # maps the clip vectors cached on the hard drive
+    # only the vectors that are missing will be downloaded
+    app.clip_server.clip_cache.load_all_clip_vector_stores()
+
+    # downloads the clip vectors of the images added since the last sync
+    # for external, extracts and datasets buckets
+    app.clip_server.sync_clip_vectors("external")
+    app.clip_server.sync_clip_vectors("extracts")
+    app.clip_server.sync_clip_vectors("datasets")
 
     # spawn a thread that will check if there are
     # new images clip_vectors & download them
     thread = threading.Thread(target=check_new_images_and_download, args=(app.clip_server,))
     thread.start()
 
+@app.on_event("shutdown")
+def shutdown_clip_cache():
+    app.clip_server.clip_cache.flush()
+
 if __name__ == "__main__":
 
     # get number of cores
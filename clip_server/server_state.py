@@ -1,6 +1,5 @@
 from io import BytesIO
 import sys
-import msgpack
 import time
 import numpy as np
 import torch
@@ -12,12 +11,12 @@ sys.path.insert(0, base_directory)
 from kandinsky.models.clip_text_encoder.clip_text_encoder import KandinskyCLIPTextEmbedder
 from utility.clip.clip import ClipModel
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
-from utility.minio.cmd import get_file_from_minio, is_object_exists
 from utility.path import separate_bucket_and_file_path
 from clip_cache import ClipCache
-from clip_constants import CLIP_CACHE_DIRECTORY
-from utility.http.request import http_get_list_completed_jobs
-from utility.http.external_images_request import http_get_external_image_list, http_get_extract_image_list
+from clip_search_index import ClipSearchIndex
+from clip_constants import CLIP_CACHE_DIRECTORY, CLIP_SYNC_PAGE_SIZE, CLIP_SYNC_MAX_RETRY_IMAGES
+from utility.http.request import http_get_list_completed_jobs, http_get_completed_jobs_since_cursor
+from utility.http.external_images_request import http_get_external_image_list, http_get_extract_image_list, http_get_external_images_since_cursor, http_get_extracts_since_cursor
 
 class Phrase:
     def __init__(self, id, phrase):
@@ -35,11 +34,11 @@ class ClipServer:
         self.id_counter = 0
         self.phrase_dictionary = {}
         self.clip_vector_dictionary = {}
-        self.image_clip_vector_cache = {}
         self.clip_model = KandinskyCLIPTextEmbedder(device=device)
         self.kandinsky_clip_model= KandinskyCLIPImageEncoder(device=device)
         self.device = device
         self.clip_cache = ClipCache(device, minio_client, CLIP_CACHE_DIRECTORY)
+        self.clip_search_index = ClipSearchIndex(self.clip_cache)
 
     def load_clip_model(self):
         self.clip_model.load_submodels()
@@ -113,49 +112,24 @@ class ClipServer:
 
 
     def get_image_clip_from_minio(self, image_path, bucket_name):
-
-        # if its in the cache return from cache
-        if image_path in self.image_clip_vector_cache:
-            clip_vector = self.image_clip_vector_cache[image_path]
-            return clip_vector
-
-        # Removes the last 4 characters from the path
-        # image.jpg => image
-        base_path = image_path.rstrip(image_path[-4:])
-
-        # finds the clip file associated with the image
-        image_clip_vector_path = f'{base_path}_clip_kandinsky.msgpack'
-
-        print(f'image clip vector path : {image_clip_vector_path}')
-        # get the clip.msgpack from minio
-        file_exists = is_object_exists(self.minio_client, bucket_name, image_clip_vector_path)
-
-        if not file_exists:
-            print(f'{image_clip_vector_path} does not exist')
+        # goes through the clip cache
+        # only downloads from minio if the vector is not cached
+        clip_vector = self.clip_cache.get_clip_vector(bucket_name, image_path)
+        if clip_vector is None:
             return None
 
-        clip_vector_data_msgpack = get_file_from_minio(self.minio_client, bucket_name, image_clip_vector_path)
-
-        if clip_vector_data_msgpack is None:
-            print(f'image not found {image_path}')
-            return None
-
-        # read file_data_into memory
-        clip_vector_data_msgpack_memory = clip_vector_data_msgpack.read()
-
-        try:
-            # uncompress the msgpack data
-            clip_vector = msgpack.unpackb(clip_vector_data_msgpack_memory)
-            clip_vector = clip_vector["clip-feature-vector"]
-            # add to chache
-            self.image_clip_vector_cache[image_path] = clip_vector
+        return clip_vector.tolist()
 
-            return clip_vector
-        except Exception as e:
-            print('Exception details : ', e)
+    def get_image_clip_vector_list(self, bucket, image_path_list):
+        # the vectors that are not cached are downloaded concurrently
+        # images without clip vector get None
+        clip_vector_list = [None] * len(image_path_list)
 
-        return None
+        clip_vector_matrix, found_index_list = self.clip_cache.get_clip_vectors(bucket, image_path_list)
+        for row, index in enumerate(found_index_list):
+            clip_vector_list[index] = clip_vector_matrix[row:row + 1].tolist()
 
+        return clip_vector_list
 
     def compute_cosine_match_value(self, phrase, bucket, image_path):
         print('computing cosine match value for ', phrase, ' and ', image_path)
@@ -209,6 +183,11 @@ class ClipServer:
         return similarity.item()
 
     def compute_cosine_match_value_list(self, phrase, bucket, image_path_list):
+        similarity_list, _ = self.compute_cosine_match_value_list_with_timing(phrase, bucket, image_path_list)
+
+        return similarity_list
+
+    def compute_cosine_match_value_list_with_timing(self, phrase, bucket, image_path_list):
 
         num_images = len(image_path_list)
 
@@ -218,77 +197,91 @@ class ClipServer:
 
         # vector full of zeroes of size=num_images
         cosine_match_list = [0] * num_images
+        timing = {
+            'num_images': num_images,
+            'num_found': 0,
+            'gather_time': 0.0,
+            'compute_time': 0.0,
+            'total_time': 0.0,
+        }
 
         phrase_cip_vector_struct = self.get_clip_vector(phrase)
         # the score is zero if we cant find the phrase clip vector
         if phrase_cip_vector_struct is None:
             print(f'phrase {phrase} not found ')
-            return cosine_match_list
-
-        phrase_clip_vector_numpy = phrase_cip_vector_struct.clip_vector
-
-        # convert numpy array to tensors
-        phrase_clip_vector = torch.tensor(phrase_clip_vector_numpy, dtype=torch.float32, device=self.device)
-
-         #check the vector size
-        assert phrase_clip_vector.size() == (1, 1280), f"Expected size (1, 1280), but got {phrase_clip_vector.size()}"
-
-        # Normalizing the tensor
-        normalized_phrase_clip_vector = torch.nn.functional.normalize(phrase_clip_vector, p=2, dim=1)
-
-        # removing the extra dimension
-        # from shape (1, 768) => (768)
-        normalized_phrase_clip_vector = normalized_phrase_clip_vector.squeeze(0)
-
-        # for each batch do
-        for image_index in range(0, num_images):
-            image_path = image_path_list[image_index]
-            image_clip_vector = self.get_image_clip_vector(bucket, image_path)
-            # if the clip_vector was not found
-            # or couldn't load for some network reason
-            # we must provide an empty vector as replacement
-            if image_clip_vector is None:
-                # this syntax is weird but its just list full of zeros
-                cosine_match_list[image_index] = 0
-                continue
-
-            # now that we have the clip vectors we need to construct our tensors
-            image_clip_vector = torch.tensor(image_clip_vector, dtype=torch.float32, device=self.device)
+            return cosine_match_list, timing
+
+        # gather all the image clip vectors in one matrix
+        # the ones that are not cached are downloaded concurrently
+        # if the clip_vector was not found
+        # or couldn't load for some network reason
+        # the score stays zero
+        image_clip_vector_matrix, found_index_list = self.clip_cache.get_clip_vectors(bucket, image_path_list)
+        gather_end_time = time.time()
+
+        num_found = len(found_index_list)
+        if num_found > 0:
+            with torch.no_grad():
+                # convert numpy array to tensors
+                phrase_clip_vector = torch.tensor(phrase_cip_vector_struct.clip_vector, dtype=torch.float32, device=self.device)
+
+                #check the vector size
+                assert phrase_clip_vector.size() == (1, 1280), f"Expected size (1, 1280), but got {phrase_clip_vector.size()}"
+
+                image_clip_vectors = torch.from_numpy(np.ascontiguousarray(image_clip_vector_matrix)).to(device=self.device, dtype=torch.float32)
+
+                #check the matrix size
+                assert image_clip_vectors.size() == (num_found, 1280), f"Expected size ({num_found}, 1280), but got {image_clip_vectors.size()}"
+
+                # Normalizing the tensors
+                normalized_phrase_clip_vector = torch.nn.functional.normalize(phrase_clip_vector, p=2, dim=1)
+                normalized_image_clip_vectors = torch.nn.functional.normalize(image_clip_vectors, p=2, dim=1)
+
+                # cosine similarity of every image in one matmul
+                # (num_found, 1280) x (1280, 1) => (num_found)
+                similarity = torch.matmul(normalized_image_clip_vectors, normalized_phrase_clip_vector.t()).squeeze(1)
+                similarity_list = similarity.cpu().tolist()
+
+            for index, similarity_value in zip(found_index_list, similarity_list):
+                cosine_match_list[index] = similarity_value
+
+            del phrase_clip_vector
+            del image_clip_vectors
+            del normalized_phrase_clip_vector
+            del normalized_image_clip_vectors
+            del similarity
 
-            #check the vector size
-            assert image_clip_vector.size() == (1, 1280), f"Expected size (1, 1280), but got {image_clip_vector.size()}"
+        # Record the end time
+        end_time = time.time()
 
-            normalized_image_clip_vector = torch.nn.functional.normalize(image_clip_vector, p=2, dim=1)
-            # removing the extra dimension
-            # from shape (1, 768) => (768)
-            normalized_image_clip_vector = normalized_image_clip_vector.squeeze(0)
+        timing['num_found'] = num_found
+        timing['gather_time'] = gather_end_time - start_time
+        timing['compute_time'] = end_time - gather_end_time
+        timing['total_time'] = end_time - start_time
 
-            # cosine similarity
-            similarity = torch.dot(normalized_phrase_clip_vector, normalized_image_clip_vector)
-            similarity_value = similarity.item()
-            cosine_match_list[image_index] = similarity_value
+        print(f"Function execution time: {timing['total_time']:.4f} seconds "
+              f"(gather {timing['gather_time']:.4f}, compute {timing['compute_time']:.4f}, "
+              f"found {num_found} out of {num_images})")
 
-            # cleanup
-            del image_clip_vector
-            del normalized_image_clip_vector
-            del similarity
-            # After your GPU-related operations, clean up the GPU memory
-            torch.cuda.empty_cache()
+        return cosine_match_list, timing
 
-        del phrase_clip_vector
-        del normalized_phrase_clip_vector
-        # After your GPU-related operations, clean up the GPU memory
-        torch.cuda.empty_cache()
+    def search_images(self, phrase, bucket, k, dataset_list=None, start_date=None, end_date=None):
+        start_time = time.time()
 
-        # Record the end time
-        end_time = time.time()
+        # registered phrases are already computed
+        # any other phrase is computed on the fly
+        phrase_cip_vector_struct = self.get_clip_vector(phrase)
+        if phrase_cip_vector_struct is not None:
+            phrase_clip_vector = phrase_cip_vector_struct.clip_vector
+        else:
+            phrase_clip_vector = self.compute_clip_vector(phrase)
 
-        # Calculate the elapsed time
-        elapsed_time = end_time - start_time
+        result = self.clip_search_index.search(bucket, phrase_clip_vector, k, dataset_list, start_date, end_date)
 
-        print(f"Function execution time: {elapsed_time:.4f} seconds")
+        elapsed_time = time.time() - start_time
+        print(f"Search execution time: {elapsed_time:.4f} seconds")
 
-        return cosine_match_list
+        return result
 
     def compute_clip_vector(self, text):
         _, clip_vector_gpu, _ = self.clip_model.compute_embeddings(text)
@@ -326,32 +319,142 @@ class ClipServer:
         for job in completed_jobs:
             print(f'processing job {job_index} our of {num_jobs}')
             job_index = job_index + 1
-            if bucket=="datasets":
-                input_dict = job['task_input_dict']
 
-                # Jobs must have input dictionary
-                if input_dict is None:
-                    continue
+            image_info = self.get_job_image_info(bucket, job)
+            if image_info is None:
+                continue
 
-                # Jobs must have target dataset
-                if 'dataset' not in input_dict:
-                    continue
+            image_path, dataset, date = image_info
+
+            # this will download the clip vector from minio
+            # and will also add it to clip cache
+            self.clip_cache.get_clip_vector(bucket, image_path)
+
+            # dataset & date are used to filter the search results
+            self.clip_search_index.set_image_metadata(bucket, image_path, dataset, date)
+
+        # add the new vectors to the search index
+        self.clip_search_index.update(bucket)
+
+    def get_job_image_info(self, bucket, job):
+        # returns the image path, dataset and date of the job
+        # or None if the job has no image
+        if bucket=="datasets":
+            input_dict = job.get('task_input_dict')
+
+            # Jobs must have input dictionary
+            if input_dict is None:
+                return None
+
+            # Jobs must have target dataset
+            if 'dataset' not in input_dict:
+                return None
+
+            # Jobs must have output image path
+            if 'file_path' not in input_dict:
+                return None
+
+            dataset = input_dict['dataset']
+            file_path = input_dict['file_path']
+
+            image_path = f'{dataset}/{file_path}'
+
+            return image_path, dataset, job.get('task_creation_time')
+
+        if bucket in ['external', 'extracts']:
+            if not job.get('file_path'):
+                return None
 
-                # Jobs must have output image path
-                if 'file_path' not in input_dict:
+            _ , image_path = separate_bucket_and_file_path(job['file_path'])
+
+            return image_path, job.get('dataset'), job.get('upload_date')
+
+        return None
+
+    def sync_clip_vectors(self, bucket):
+        # only downloads the clip vectors of the images
+        # added since the last sync of the bucket
+        # the cursor of the orchestration feed is stored on the hard drive
+        # so a restart continues where the last sync stopped
+        if bucket=="datasets":
+            get_images_since_cursor = http_get_completed_jobs_since_cursor
+        elif bucket=="external":
+            get_images_since_cursor = http_get_external_images_since_cursor
+        elif bucket=="extracts":
+            get_images_since_cursor = http_get_extracts_since_cursor
+        else:
+            print(f"Bucket name {bucket} not recognized")
+            return None
+
+        start_time = time.time()
+
+        sync_state = self.clip_cache.load_sync_state(bucket)
+        if sync_state is None:
+            sync_state = {'cursor': None, 'missing_images': []}
+
+        cursor = sync_state['cursor']
+        if cursor is not None and not str(cursor).isdigit():
+            # cursor of the old feed paged on the _id, the feed is walked again
+            # from the start, the cached clip vectors aren't downloaded again
+            cursor = None
+
+        # images of the previous syncs that had no clip vector yet
+        retry_image_list = sync_state['missing_images']
+        missing_image_list = []
+        if len(retry_image_list) > 0:
+            not_found_image_path_list = set(self.clip_cache.download_clip_vectors(bucket, [image['image_path'] for image in retry_image_list]))
+            missing_image_list = [image for image in retry_image_list if image['image_path'] in not_found_image_path_list]
+
+        num_images = 0
+        while True:
+            image_list, next_cursor = get_images_since_cursor(cursor, CLIP_SYNC_PAGE_SIZE)
+            if image_list is None:
+                print(f'Could not get the new images of {bucket}')
+                break
+
+            if len(image_list) == 0:
+                break
+
+            image_path_list = []
+            for image in image_list:
+                image_info = self.get_job_image_info(bucket, image)
+                if image_info is None:
                     continue
 
-                dataset = input_dict['dataset']
-                file_path = input_dict['file_path']
+                image_path, dataset, date = image_info
+                image_path_list.append(image_path)
 
-                image_path = f'{dataset}/{file_path}'
+                # dataset & date are used to filter the search results
+                self.clip_search_index.set_image_metadata(bucket, image_path, dataset, date)
 
-            elif bucket in ['external', 'extracts']:
-                _ , image_path = separate_bucket_and_file_path(job['file_path'])
+            not_found_image_path_list = self.clip_cache.download_clip_vectors(bucket, image_path_list)
+            missing_image_list.extend({'image_path': image_path} for image_path in not_found_image_path_list)
 
-            # this will download the clip vector from minio
-            # and will also add it to clip cache
-            self.clip_cache.get_clip_vector(bucket, image_path)
+            num_images += len(image_list)
+            cursor = next_cursor
+
+            # save the progress after every page
+            sync_state = {
+                'cursor': cursor,
+                'missing_images': missing_image_list[-CLIP_SYNC_MAX_RETRY_IMAGES:]
+            }
+            self.clip_cache.save_sync_state(bucket, sync_state)
+
+            print(f'synced {num_images} new images of {bucket}')
+
+            if len(image_list) < CLIP_SYNC_PAGE_SIZE:
+                break
+
+        self.clip_cache.save_sync_state(bucket, {
+            'cursor': cursor,
+            'missing_images': missing_image_list[-CLIP_SYNC_MAX_RETRY_IMAGES:]
+        })
 
+        # add the new vectors to the search index
+        self.clip_search_index.update(bucket)
 
+        elapsed_time = time.time() - start_time
+        print(f'synced {num_images} new images of {bucket} in {elapsed_time:.4f} seconds, '
+              f'{len(missing_image_list)} clip vectors still missing')
 
+        return num_images
@@ -17,6 +17,7 @@ from utility.minio import cmd
 from training_worker.ab_ranking.model import constants
 from data_loader.ab_data import ABData
 from data_loader.utils import *
+from data_loader.feature_shards import load_feature_shards, get_features_path, get_features_vector
 
 
 class ABRankingDatasetLoader:
@@ -31,7 +32,8 @@ class ABRankingDatasetLoader:
                  pooling_strategy=constants.AVERAGE_POOLING,
                  normalize_vectors=True,
                  target_option=constants.TARGET_1_AND_0,
-                 duplicate_flip_option=constants.DUPLICATE_AND_FLIP_ALL):
+                 duplicate_flip_option=constants.DUPLICATE_AND_FLIP_ALL,
+                 use_feature_shards=True):
         self.dataset_name = dataset_name
         self.input_type = input_type
 
@@ -63,10 +65,30 @@ class ABRankingDatasetLoader:
         self.training_ab_data_paths_list = []
         self.validation_ab_data_paths_list = []
         self.current_training_data_index = 0
-        self.training_image_pair_data_arr = []
-        self.validation_image_pair_data_arr = []
         self.datapoints_per_sec = 0
 
+        # features of every image, one row per image hash
+        self.image_hash_to_feature_row = {}
+        self.feature_vectors = []
+        self.features_matrix = None
+        self.features_tensor = None
+        self.pinned_batch_buffers = {}
+
+        # pairs, as the feature rows of image x & y and the target
+        # shuffling only permutes training_order
+        self.training_x_rows = np.zeros(0, dtype=np.int64)
+        self.training_y_rows = np.zeros(0, dtype=np.int64)
+        self.training_targets = np.zeros((0, 1), dtype=np.float32)
+        self.training_order = np.zeros(0, dtype=np.int64)
+        self.training_image_hashes_arr = np.zeros(0, dtype=object)
+        self.validation_x_rows = np.zeros(0, dtype=np.int64)
+        self.validation_y_rows = np.zeros(0, dtype=np.int64)
+        self.validation_targets = np.zeros((0, 1), dtype=np.float32)
+
+        # features packed by data_loader/feature_shards.py
+        self.use_feature_shards = use_feature_shards
+        self.feature_shards = None
+
         # for chronological data scores graph
         self.training_data_paths_indices = []
         self.validation_data_paths_indices = []
@@ -98,6 +120,12 @@ class ABRankingDatasetLoader:
 
         self.total_selection_datapoints = len_dataset
 
+        # packed features of the dataset, see data_loader/feature_shards.py
+        # images missing from the shards are read from their .msgpack
+        if self.use_feature_shards:
+            self.feature_shards = load_feature_shards(self.minio_client, self.dataset_name, self.input_type,
+                                                      self.pooling_strategy)
+
         # test
         # dataset = dataset[:5]
 
@@ -109,7 +137,7 @@ class ABRankingDatasetLoader:
         validation_data_paths_indices = []
         validation_ab_data_list = []
         training_ab_data_list = []
-        validation_indices = sample(range(0, len_dataset - 1), num_validations)
+        validation_indices = set(sample(range(0, len_dataset - 1), num_validations))
         for i in range(len_dataset):
             if i in validation_indices:
                 validation_ab_data_list.append(dataset[i])
@@ -127,6 +155,7 @@ class ABRankingDatasetLoader:
         # always load to ram
         self.load_all_training_data(self.training_ab_data_paths_list, pre_shuffle=pre_shuffle)
         self.load_all_validation_data(self.validation_ab_data_paths_list)
+        self.build_features_matrix()
         self.total_num_data = self.validation_data_total + self.training_data_total
 
         print("Dataset loaded...")
@@ -145,6 +174,18 @@ class ABRankingDatasetLoader:
 
         return selected_index_0_count, selected_index_1_count, total_count
 
+    def get_image_features(self, image_path, image_hash):
+        # returns the features vector of an image and where it was read from
+        # the packed feature shards are used when they have the image
+        if self.feature_shards is not None and image_hash in self.feature_shards:
+            return self.feature_shards.get_features(image_hash), "feature shards ({})".format(image_hash)
+
+        bucket, features_path = get_features_path(image_path, self.dataset_name, self.input_type, self.pooling_strategy)
+        features_data = get_object_with_bucket(self.minio_client, bucket, features_path)
+        features_vector = get_features_vector(msgpack.unpackb(features_data), self.input_type)
+
+        return features_vector, features_path
+
     def get_selection_datapoint_image_pair(self, dataset, index=0):
         image_pairs = []
         ab_data = dataset
@@ -153,58 +194,8 @@ class ABRankingDatasetLoader:
         file_path_img_1 = ab_data.image_1_path
         file_path_img_2 = ab_data.image_2_path
 
-        input_type_extension = "-text-embedding.msgpack"
-        if self.input_type == constants.CLIP:
-            input_type_extension = "_clip.msgpack"
-        elif self.input_type == constants.KANDINSKY_CLIP:
-            input_type_extension = "_clip_kandinsky.msgpack"
-        elif self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE, constants.EMBEDDING_NEGATIVE]:
-            # replace with new /embeddings
-            file_path_img_1 = file_path_img_1.replace(self.dataset_name,
-                                                      os.path.join(self.dataset_name, "embeddings/text-embedding"))
-            file_path_img_2 = file_path_img_2.replace(self.dataset_name,
-                                                      os.path.join(self.dataset_name, "embeddings/text-embedding"))
-
-            input_type_extension = "-text-embedding.msgpack"
-            if self.pooling_strategy == constants.AVERAGE_POOLING:
-                input_type_extension = "-text-embedding-average-pooled.msgpack"
-            elif self.pooling_strategy == constants.MAX_POOLING:
-                input_type_extension = "-text-embedding-max-pooled.msgpack"
-            elif self.pooling_strategy == constants.MAX_ABS_POOLING:
-                input_type_extension = "-text-embedding-signed-max-pooled.msgpack"
-
-        # get .msgpack data
-        features_path_img_1 = file_path_img_1.replace(".jpg", input_type_extension)
-        bucket_img_1, features_path_img_1 = separate_bucket_and_file_path(features_path_img_1)
-
-        features_path_img_2 = file_path_img_2.replace(".jpg", input_type_extension)
-        bucket_img_2, features_path_img_2 = separate_bucket_and_file_path(features_path_img_2)
-
-        features_img_1_data = get_object_with_bucket(self.minio_client, bucket_img_1, features_path_img_1)
-        features_img_1_data = msgpack.unpackb(features_img_1_data)
-        features_vector_img_1 = []
-
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_1.extend(features_img_1_data["positive_embedding"]["__ndarray__"])
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_1.extend(features_img_1_data["negative_embedding"]["__ndarray__"])
-        if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
-            features_vector_img_1.extend(features_img_1_data["clip-feature-vector"])
-
-        features_vector_img_1 = np.array(features_vector_img_1)
-        
-        features_img_2_data = get_object_with_bucket(self.minio_client, bucket_img_2, features_path_img_2)
-        features_img_2_data = msgpack.unpackb(features_img_2_data)
-        features_vector_img_2 = []
-
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_2.extend(features_img_2_data["positive_embedding"]["__ndarray__"])
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_2.extend(features_img_2_data["negative_embedding"]["__ndarray__"])
-        if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
-            features_vector_img_2.extend(features_img_2_data["clip-feature-vector"])
-
-        features_vector_img_2 = np.array(features_vector_img_2)
+        features_vector_img_1, features_path_img_1 = self.get_image_features(file_path_img_1, ab_data.hash_image_1)
+        features_vector_img_2, features_path_img_2 = self.get_image_features(file_path_img_2, ab_data.hash_image_2)
 
         # check if feature is nan
         if np.isnan(features_vector_img_1).all():
@@ -250,11 +241,31 @@ class ABRankingDatasetLoader:
 
         return image_pairs, index, selected_img_hash, other_img_hash
 
-    def load_all_training_data(self, paths_list, pre_shuffle=True):
-        print("Loading all training data to ram...")
-        start_time = time.time()
-        new_training_data_paths_indices = []
-        training_image_hashes = []
+    def add_image_features(self, image_hash, features_vector):
+        # returns the row of the image in the features matrix
+        row = self.image_hash_to_feature_row.get(image_hash)
+        if row is None:
+            row = len(self.feature_vectors)
+            self.image_hash_to_feature_row[image_hash] = row
+            self.feature_vectors.append(features_vector)
+
+        return row
+
+    def build_features_matrix(self):
+        # every image is stored once, the pairs only keep the rows of their images
+        self.features_matrix = np.stack(self.feature_vectors).astype(np.float32)
+        self.features_tensor = torch.from_numpy(self.features_matrix)
+        self.feature_vectors = []
+        print("features matrix shape=", self.features_matrix.shape)
+
+    def load_image_pairs(self, paths_list, data_paths_indices):
+        # returns the feature rows of x & y, the targets,
+        # the datapoint index and the image hash of x of every pair
+        x_rows = []
+        y_rows = []
+        targets = []
+        new_data_paths_indices = []
+        image_hashes = []
 
         with ThreadPoolExecutor(max_workers=5) as executor:
             futures = []
@@ -267,36 +278,41 @@ class ABRankingDatasetLoader:
             for future in tqdm(as_completed(futures), total=len(paths_list)):
                 image_pairs, index, selected_img_hash, other_img_hash = future.result()
                 for pair in image_pairs:
-                    self.training_image_pair_data_arr.append(pair)
-                    new_training_data_paths_indices.append(self.training_data_paths_indices[index])
-
                     if pair[2] == [1.0]:
-                        training_image_hashes.append(selected_img_hash)
+                        x_hash, y_hash = selected_img_hash, other_img_hash
                     else:
-                        training_image_hashes.append(other_img_hash)
+                        x_hash, y_hash = other_img_hash, selected_img_hash
 
-        self.training_data_paths_indices = new_training_data_paths_indices
+                    x_rows.append(self.add_image_features(x_hash, pair[0]))
+                    y_rows.append(self.add_image_features(y_hash, pair[1]))
+                    targets.append(pair[2])
+                    new_data_paths_indices.append(data_paths_indices[index])
+                    image_hashes.append(x_hash)
 
-        len_training_data_paths = len(self.training_data_paths_indices)
-        if pre_shuffle is False:
-            self.training_data_paths_indices_shuffled = self.training_data_paths_indices
-            self.training_image_hashes = training_image_hashes
+        return (np.array(x_rows, dtype=np.int64),
+                np.array(y_rows, dtype=np.int64),
+                np.array(targets, dtype=np.float32).reshape(-1, 1),
+                np.array(new_data_paths_indices, dtype=np.int64),
+                np.array(image_hashes, dtype=object))
 
+    def load_all_training_data(self, paths_list, pre_shuffle=True):
+        print("Loading all training data to ram...")
+        start_time = time.time()
+
+        (self.training_x_rows,
+         self.training_y_rows,
+         self.training_targets,
+         self.training_data_paths_indices,
+         self.training_image_hashes_arr) = self.load_image_pairs(paths_list, self.training_data_paths_indices)
+
+        len_training_data_paths = len(self.training_targets)
+
+        # only the order is shuffled, the pairs stay where they are
+        if pre_shuffle is False:
+            self.training_order = np.arange(len_training_data_paths)
         else:
-            # shuffle
-            shuffled_training_data = []
-            shuffled_training_data_indices = []
-            shuffled_training_image_hashes = []
-            index_shuf = list(range(len_training_data_paths))
-            shuffle(index_shuf)
-            for i in index_shuf:
-                shuffled_training_data.append(self.training_image_pair_data_arr[i])
-                shuffled_training_data_indices.append(self.training_data_paths_indices[i])
-                shuffled_training_image_hashes.append(training_image_hashes[i])
-
-            self.training_data_paths_indices_shuffled = shuffled_training_data_indices
-            self.training_image_pair_data_arr = shuffled_training_data
-            self.training_image_hashes = shuffled_training_image_hashes
+            self.training_order = np.random.permutation(len_training_data_paths)
+        self.update_training_order_lists()
 
         self.training_data_total = len_training_data_paths
         time_elapsed = time.time() - start_time
@@ -307,90 +323,82 @@ class ABRankingDatasetLoader:
         print("Loading all validation data to ram...")
         start_time = time.time()
 
-        new_validation_data_paths_indices = []
-        validation_image_hashes = []
-
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = []
-
-            count = 0
-            for path in paths_list:
-                futures.append(executor.submit(self.get_selection_datapoint_image_pair, dataset=path, index=count))
-                count += 1
-
-            for future in tqdm(as_completed(futures), total=len(paths_list)):
-                image_pairs, index, selected_img_hash, other_img_hash = future.result()
-                for pair in image_pairs:
-                    self.validation_image_pair_data_arr.append(pair)
-                    new_validation_data_paths_indices.append(self.validation_data_paths_indices[index])
-
-                    if pair[2] == [1.0]:
-                        validation_image_hashes.append(selected_img_hash)
-                    else:
-                        validation_image_hashes.append(other_img_hash)
-
-        self.validation_data_paths_indices = new_validation_data_paths_indices
+        (validation_x_rows,
+         validation_y_rows,
+         validation_targets,
+         validation_data_paths_indices,
+         validation_image_hashes) = self.load_image_pairs(paths_list, self.validation_data_paths_indices)
 
-        # shuffle
-        shuffled_validation_data = []
-        shuffled_validation_data_indices = []
-        shuffle_validation_image_hashes = []
-        len_validation_data_paths = len(self.validation_data_paths_indices)
-        index_shuf = list(range(len_validation_data_paths))
-        shuffle(index_shuf)
-        for i in index_shuf:
-            shuffled_validation_data.append(self.validation_image_pair_data_arr[i])
-            shuffled_validation_data_indices.append(self.validation_data_paths_indices[i])
-            shuffle_validation_image_hashes.append(validation_image_hashes[i])
+        # shuffle once
+        validation_order = np.random.permutation(len(validation_targets))
+        self.validation_x_rows = validation_x_rows[validation_order]
+        self.validation_y_rows = validation_y_rows[validation_order]
+        self.validation_targets = validation_targets[validation_order]
 
-        self.validation_data_paths_indices_shuffled = shuffled_validation_data_indices
-        self.validation_image_pair_data_arr = shuffled_validation_data
-        self.validation_data_total = len_validation_data_paths
-        self.validation_image_hashes = shuffle_validation_image_hashes
+        self.validation_data_paths_indices = validation_data_paths_indices.tolist()
+        self.validation_data_paths_indices_shuffled = validation_data_paths_indices[validation_order].tolist()
+        self.validation_image_hashes = validation_image_hashes[validation_order].tolist()
+        self.validation_data_total = len(validation_targets)
 
         time_elapsed = time.time() - start_time
         print("Time elapsed: {0}s".format(format(time_elapsed, ".2f")))
 
+    def update_training_order_lists(self):
+        # lists in training order, for the scores graphs and residuals
+        self.training_data_paths_indices_shuffled = self.training_data_paths_indices[self.training_order].tolist()
+        self.training_image_hashes = self.training_image_hashes_arr[self.training_order].tolist()
+
     def shuffle_training_data(self):
         print("Shuffling training data...")
         # shuffle
-        new_shuffled_indices = []
-        shuffled_training = []
-        shuffled_training_image_hashes = []
-        index_shuf = list(range(len(self.training_image_pair_data_arr)))
-        shuffle(index_shuf)
-        for i in index_shuf:
-            shuffled_training.append(self.training_image_pair_data_arr[i])
-            new_shuffled_indices.append(self.training_data_paths_indices_shuffled[i])
-            shuffled_training_image_hashes.append(self.training_image_hashes[i])
+        self.training_order = self.training_order[np.random.permutation(len(self.training_order))]
+        self.update_training_order_lists()
 
-        self.training_data_paths_indices_shuffled = new_shuffled_indices
-        self.training_image_pair_data_arr = shuffled_training
-        self.training_image_hashes = shuffled_training_image_hashes
+    def get_features(self, rows, buffer_name, device=None):
+        # gathers the features of the rows into one tensor
+        rows = torch.from_numpy(rows)
+        if device is None or torch.device(device).type != "cuda":
+            return torch.index_select(self.features_tensor, 0, rows)
 
-    # ------------------------------- For AB Ranking Efficient Net -------------------------------
-    def get_next_training_feature_vectors_and_target_efficient_net(self, num_data, device=None):
-        image_x_feature_vectors = []
-        image_y_feature_vectors = []
-        target_probabilities = []
+        # for the gpu, gather into a reused pinned buffer
+        # so the copy to the device is a single dma transfer
+        buffer = self.pinned_batch_buffers.get(buffer_name)
+        if buffer is None or buffer.shape[0] < len(rows):
+            buffer = torch.empty((len(rows), *self.features_tensor.shape[1:]), dtype=torch.float32).pin_memory()
+            self.pinned_batch_buffers[buffer_name] = buffer
 
-        for _ in range(num_data):
-            training_image_pair_data = self.training_image_pair_data_arr[self.current_training_data_index]
-            image_x_feature_vector, image_y_feature_vector, target_probability = split_ab_data_vectors(
-                training_image_pair_data)
-            image_x_feature_vectors.append(image_x_feature_vector)
-            image_y_feature_vectors.append(image_y_feature_vector)
-            target_probabilities.append(target_probability)
-            self.current_training_data_index += 1
+        features = buffer[:len(rows)]
+        torch.index_select(self.features_tensor, 0, rows, out=features)
 
-        image_x_feature_vectors = np.array(image_x_feature_vectors, dtype=np.float32)
-        image_y_feature_vectors = np.array(image_y_feature_vectors, dtype=np.float32)
+        return features.to(device)
 
-        target_probabilities = np.array(target_probabilities)
+    def get_next_training_batch(self, num_data, device=None):
+        batch_indices = self.training_order[self.current_training_data_index:self.current_training_data_index + num_data]
+        self.current_training_data_index += num_data
 
-        image_x_feature_vectors = torch.tensor(image_x_feature_vectors).to(torch.float)
-        image_y_feature_vectors = torch.tensor(image_y_feature_vectors).to(torch.float)
-        target_probabilities = torch.tensor(target_probabilities).to(torch.float)
+        image_x_feature_vectors = self.get_features(self.training_x_rows[batch_indices], "x", device)
+        image_y_feature_vectors = self.get_features(self.training_y_rows[batch_indices], "y", device)
+        target_probabilities = torch.from_numpy(self.training_targets[batch_indices])
+
+        if device is not None:
+            target_probabilities = target_probabilities.to(device)
+
+        return image_x_feature_vectors, image_y_feature_vectors, target_probabilities
+
+    def get_validation_batch(self, device=None):
+        image_x_feature_vectors = self.get_features(self.validation_x_rows, "validation_x", device)
+        image_y_feature_vectors = self.get_features(self.validation_y_rows, "validation_y", device)
+        target_probabilities = torch.from_numpy(self.validation_targets)
+
+        if device is not None:
+            target_probabilities = target_probabilities.to(device)
+
+        return image_x_feature_vectors, image_y_feature_vectors, target_probabilities
+
+    # ------------------------------- For AB Ranking Efficient Net -------------------------------
+    def get_next_training_feature_vectors_and_target_efficient_net(self, num_data, device=None):
+        image_x_feature_vectors, image_y_feature_vectors, target_probabilities = self.get_next_training_batch(num_data,
+                                                                                                             device)
 
         if self.normalize_vectors:
             image_x_feature_vectors = torch_normalize(image_x_feature_vectors, p=1.0, dim=2)
@@ -405,34 +413,10 @@ class ABRankingDatasetLoader:
         image_x_feature_vectors = image_x_feature_vectors.unsqueeze(1)
         image_y_feature_vectors = image_y_feature_vectors.unsqueeze(1)
 
-        if device is not None:
-            image_x_feature_vectors = image_x_feature_vectors.to(device)
-            image_y_feature_vectors = image_y_feature_vectors.to(device)
-            target_probabilities = target_probabilities.to(device)
-
         return image_x_feature_vectors, image_y_feature_vectors, target_probabilities
 
     def get_validation_feature_vectors_and_target_efficient_net(self):
-        image_x_feature_vectors = []
-        image_y_feature_vectors = []
-        target_probabilities = []
-
-        # get ab data
-        for i in range(len(self.validation_image_pair_data_arr)):
-            validation_image_pair_data = self.validation_image_pair_data_arr[i]
-            image_x_feature_vector, image_y_feature_vector, target_probability = split_ab_data_vectors(
-                validation_image_pair_data)
-            image_x_feature_vectors.append(image_x_feature_vector)
-            image_y_feature_vectors.append(image_y_feature_vector)
-            target_probabilities.append(target_probability)
-
-        image_x_feature_vectors = np.array(image_x_feature_vectors, dtype=np.float32)
-        image_y_feature_vectors = np.array(image_y_feature_vectors, dtype=np.float32)
-        target_probabilities = np.array(target_probabilities)
-
-        image_x_feature_vectors = torch.tensor(image_x_feature_vectors).to(torch.float)
-        image_y_feature_vectors = torch.tensor(image_y_feature_vectors).to(torch.float)
-        target_probabilities = torch.tensor(target_probabilities).to(torch.float)
+        image_x_feature_vectors, image_y_feature_vectors, target_probabilities = self.get_validation_batch()
         print("feature shape =", image_x_feature_vectors.shape)
 
         if self.normalize_vectors:
@@ -455,73 +439,23 @@ class ABRankingDatasetLoader:
 
     # ------------------------------- For AB Ranking Linear -------------------------------
     def get_next_training_feature_vectors_and_target_linear(self, num_data, device=None):
-        
-        image_x_feature_vectors = []
-        image_y_feature_vectors = []
-        target_probabilities = []
-
-        for _ in range(num_data):
-            training_image_pair_data = self.training_image_pair_data_arr[self.current_training_data_index]
-            image_x_feature_vector, image_y_feature_vector, target_probability = split_ab_data_vectors(
-                training_image_pair_data)
-            image_x_feature_vectors.append(image_x_feature_vector)
-            image_y_feature_vectors.append(image_y_feature_vector)
-            target_probabilities.append(target_probability)
-            self.current_training_data_index += 1
-
-        image_x_feature_vectors = np.array(image_x_feature_vectors, dtype=np.float32)
-        image_y_feature_vectors = np.array(image_y_feature_vectors, dtype=np.float32)
-
-        target_probabilities = np.array(target_probabilities)
-
-        image_x_feature_vectors = torch.tensor(image_x_feature_vectors).to(torch.float)
-        image_y_feature_vectors = torch.tensor(image_y_feature_vectors).to(torch.float)
-
-        target_probabilities = torch.tensor(target_probabilities).to(torch.float)
+        image_x_feature_vectors, image_y_feature_vectors, target_probabilities = self.get_next_training_batch(num_data,
+                                                                                                             device)
 
         # then concatenate
         image_x_feature_vectors = image_x_feature_vectors.reshape(len(image_x_feature_vectors), -1)
         image_y_feature_vectors = image_y_feature_vectors.reshape(len(image_y_feature_vectors), -1)
 
-        if device is not None:
-            image_x_feature_vectors = image_x_feature_vectors.to(device)
-            image_y_feature_vectors = image_y_feature_vectors.to(device)
-            target_probabilities = target_probabilities.to(device)
-
         return image_x_feature_vectors, image_y_feature_vectors, target_probabilities
 
     def get_validation_feature_vectors_and_target_linear(self, device=None):
-        image_x_feature_vectors = []
-        image_y_feature_vectors = []
-        target_probabilities = []
-
-        # get ab data
-        for i in range(len(self.validation_image_pair_data_arr)):
-            validation_image_pair_data = self.validation_image_pair_data_arr[i]
-            image_x_feature_vector, image_y_feature_vector, target_probability = split_ab_data_vectors(
-                validation_image_pair_data)
-            image_x_feature_vectors.append(image_x_feature_vector)
-            image_y_feature_vectors.append(image_y_feature_vector)
-            target_probabilities.append(target_probability)
-
-        image_x_feature_vectors = np.array(image_x_feature_vectors, dtype=np.float32)
-        image_y_feature_vectors = np.array(image_y_feature_vectors, dtype=np.float32)
-        target_probabilities = np.array(target_probabilities)
-
-        image_x_feature_vectors = torch.tensor(image_x_feature_vectors).to(torch.float)
-        image_y_feature_vectors = torch.tensor(image_y_feature_vectors).to(torch.float)
-        target_probabilities = torch.tensor(target_probabilities).to(torch.float)
+        image_x_feature_vectors, image_y_feature_vectors, target_probabilities = self.get_validation_batch(device)
 
         # then concatenate
         image_x_feature_vectors = image_x_feature_vectors.reshape(len(image_x_feature_vectors), -1)
         image_y_feature_vectors = image_y_feature_vectors.reshape(len(image_y_feature_vectors), -1)
         print("feature shape after reshape=", image_x_feature_vectors.shape)
 
-        if device is not None:
-            image_x_feature_vectors = image_x_feature_vectors.to(device)
-            image_y_feature_vectors = image_y_feature_vectors.to(device)
-            target_probabilities = target_probabilities.to(device)
-
         return image_x_feature_vectors, image_y_feature_vectors, target_probabilities
 
     # ------------------------------- For Hyperparamter Search -------------------------------
@@ -0,0 +1,260 @@
+import os
+import sys
+import io
+import json
+import time
+import numpy as np
+import msgpack
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+
+from utility.minio import cmd
+from training_worker.ab_ranking.model import constants
+from data_loader.utils import get_object, get_object_with_bucket, get_aggregated_selection_datapoints
+from utility.path import separate_bucket_and_file_path
+
+# the features of the images of a dataset, packed in a few big .npy files
+#
+# datasets/<dataset>/features/shards/<feature name>/index.json        features shape & image hashes of every shard
+# datasets/<dataset>/features/shards/<feature name>/shard-00000.npy   (num rows, *features shape) float32 array
+#
+# row i of a shard are the features of the image hash i of that shard in the index
+# the features keep the shape they have in the .msgpack files, (1, 1280) for clip vectors
+# the index is uploaded after the shards, so it only references complete shards
+
+FEATURE_SHARDS_PATH = "features/shards"
+FEATURE_SHARDS_INDEX_FILE_NAME = "index.json"
+DEFAULT_FEATURE_SHARD_SIZE = 50000
+FEATURE_SHARDS_DOWNLOAD_WORKERS = 16
+
+
+def get_feature_name(input_type, pooling_strategy=constants.AVERAGE_POOLING):
+    if input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE, constants.EMBEDDING_NEGATIVE]:
+        if pooling_strategy == constants.AVERAGE_POOLING:
+            return "{}-average-pooled".format(input_type)
+        elif pooling_strategy == constants.MAX_POOLING:
+            return "{}-max-pooled".format(input_type)
+        elif pooling_strategy == constants.MAX_ABS_POOLING:
+            return "{}-signed-max-pooled".format(input_type)
+
+    return input_type
+
+
+def get_features_path(image_path, dataset_name, input_type, pooling_strategy=constants.AVERAGE_POOLING):
+    # returns the bucket and the path of the .msgpack features of an image
+    input_type_extension = "-text-embedding.msgpack"
+    if input_type == constants.CLIP:
+        input_type_extension = "_clip.msgpack"
+    elif input_type == constants.KANDINSKY_CLIP:
+        input_type_extension = "_clip_kandinsky.msgpack"
+    elif input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE, constants.EMBEDDING_NEGATIVE]:
+        # replace with new /embeddings
+        image_path = image_path.replace(dataset_name, os.path.join(dataset_name, "embeddings/text-embedding"))
+
+        input_type_extension = "-text-embedding.msgpack"
+        if pooling_strategy == constants.AVERAGE_POOLING:
+            input_type_extension = "-text-embedding-average-pooled.msgpack"
+        elif pooling_strategy == constants.MAX_POOLING:
+            input_type_extension = "-text-embedding-max-pooled.msgpack"
+        elif pooling_strategy == constants.MAX_ABS_POOLING:
+            input_type_extension = "-text-embedding-signed-max-pooled.msgpack"
+
+    features_path = image_path.replace(".jpg", input_type_extension)
+
+    return separate_bucket_and_file_path(features_path)
+
+
+def get_features_vector(features_data, input_type):
+    # features_data is the unpacked .msgpack of an image
+    features_vector = []
+    if input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
+        features_vector.extend(features_data["positive_embedding"]["__ndarray__"])
+    if input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
+        features_vector.extend(features_data["negative_embedding"]["__ndarray__"])
+    if input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
+        features_vector.extend(features_data["clip-feature-vector"])
+
+    return np.array(features_vector)
+
+
+def get_feature_shards_prefix(dataset_name, feature_name):
+    return os.path.join(dataset_name, FEATURE_SHARDS_PATH, feature_name)
+
+
+class FeatureShards:
+    def __init__(self, features_shape=(0,)):
+        self.features_shape = tuple(features_shape)
+        # image hash => row of the matrix
+        self.hash_to_row = {}
+        self.matrix = np.zeros((0, *self.features_shape), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.hash_to_row)
+
+    def __contains__(self, image_hash):
+        return image_hash in self.hash_to_row
+
+    def get_features(self, image_hash):
+        row = self.hash_to_row.get(image_hash)
+        if row is None:
+            return None
+
+        return self.matrix[row]
+
+    def get_features_matrix(self, image_hash_list):
+        # all the hashes must be in the shards
+        rows = np.array([self.hash_to_row[image_hash] for image_hash in image_hash_list], dtype=np.int64)
+
+        return self.matrix[rows]
+
+
+def load_feature_shards_index(minio_client, dataset_name, feature_name):
+    index_path = os.path.join(get_feature_shards_prefix(dataset_name, feature_name), FEATURE_SHARDS_INDEX_FILE_NAME)
+    if not cmd.is_object_exists(minio_client, "datasets", index_path):
+        return None
+
+    return json.loads(get_object(minio_client, index_path))
+
+
+def load_feature_shards(minio_client, dataset_name, input_type, pooling_strategy=constants.AVERAGE_POOLING):
+    # returns None if the shards of the dataset were never built
+    start_time = time.time()
+    feature_name = get_feature_name(input_type, pooling_strategy)
+    index = load_feature_shards_index(minio_client, dataset_name, feature_name)
+    if index is None:
+        print("No feature shards found for {} {}".format(dataset_name, feature_name))
+        return None
+
+    prefix = get_feature_shards_prefix(dataset_name, feature_name)
+    shards = index["shards"]
+    num_rows = sum(len(shard["image_hashes"]) for shard in shards)
+
+    feature_shards = FeatureShards(index["features_shape"])
+    feature_shards.matrix = np.empty((num_rows, *feature_shards.features_shape), dtype=np.float32)
+
+    print("Loading {} feature shards of {} {}...".format(len(shards), dataset_name, feature_name))
+    row = 0
+    for shard in tqdm(shards):
+        data = get_object(minio_client, os.path.join(prefix, shard["file_name"]))
+        shard_matrix = np.load(io.BytesIO(data))
+        assert shard_matrix.shape == (len(shard["image_hashes"]), *feature_shards.features_shape), \
+            "Error: shard {} doesn't match the index".format(shard["file_name"])
+
+        feature_shards.matrix[row:row + len(shard_matrix)] = shard_matrix
+        for image_hash in shard["image_hashes"]:
+            # later shards win
+            feature_shards.hash_to_row[image_hash] = row
+            row += 1
+
+    print("Loaded features of {} images".format(len(feature_shards)))
+    print("Time elapsed: {0}s".format(format(time.time() - start_time, ".2f")))
+
+    return feature_shards
+
+
+def get_image_features(minio_client, image_path, image_hash, dataset_name, input_type, pooling_strategy):
+    bucket, features_path = get_features_path(image_path, dataset_name, input_type, pooling_strategy)
+    try:
+        features_data = get_object_with_bucket(minio_client, bucket, features_path)
+    except Exception as e:
+        print("Error getting features of {}: {}".format(features_path, e))
+        return image_hash, None
+
+    features_vector = get_features_vector(msgpack.unpackb(features_data), input_type)
+    if len(features_vector) == 0 or np.isnan(features_vector).all():
+        print("Features from {} are empty or nan.".format(features_path))
+        return image_hash, None
+
+    return image_hash, features_vector
+
+
+def upload_feature_shard(minio_client, prefix, file_name, shard_matrix):
+    buffer = io.BytesIO()
+    np.save(buffer, shard_matrix)
+    buffer.seek(0)
+    cmd.upload_data(minio_client, "datasets", os.path.join(prefix, file_name), buffer)
+
+
+def build_feature_shards(minio_client,
+                         dataset_name,
+                         input_type,
+                         pooling_strategy=constants.AVERAGE_POOLING,
+                         shard_size=DEFAULT_FEATURE_SHARD_SIZE,
+                         num_workers=FEATURE_SHARDS_DOWNLOAD_WORKERS):
+    # packs the features of every image in the selection datapoints of the dataset
+    # images that are already in a shard are skipped, so it can be run again
+    # when new selection datapoints are added
+    start_time = time.time()
+    feature_name = get_feature_name(input_type, pooling_strategy)
+    prefix = get_feature_shards_prefix(dataset_name, feature_name)
+
+    index = load_feature_shards_index(minio_client, dataset_name, feature_name)
+    if index is None:
+        index = {"features_shape": None, "dtype": "float32", "shards": []}
+
+    packed_hashes = set()
+    for shard in index["shards"]:
+        packed_hashes.update(shard["image_hashes"])
+
+    # image hash => image path
+    image_paths = {}
+    for ab_data in get_aggregated_selection_datapoints(minio_client, dataset_name):
+        for image_hash, image_path in [(ab_data.hash_image_1, ab_data.image_1_path),
+                                       (ab_data.hash_image_2, ab_data.image_2_path)]:
+            if image_hash not in packed_hashes:
+                image_paths[image_hash] = image_path
+
+    print("{} images already packed, {} new images".format(len(packed_hashes), len(image_paths)))
+    if len(image_paths) == 0:
+        return index
+
+    new_hashes = list(image_paths.keys())
+    num_missing = 0
+    for start in range(0, len(new_hashes), shard_size):
+        shard_hashes = []
+        shard_vectors = []
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = []
+            for image_hash in new_hashes[start:start + shard_size]:
+                futures.append(executor.submit(get_image_features,
+                                               minio_client=minio_client,
+                                               image_path=image_paths[image_hash],
+                                               image_hash=image_hash,
+                                               dataset_name=dataset_name,
+                                               input_type=input_type,
+                                               pooling_strategy=pooling_strategy))
+
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                image_hash, features_vector = future.result()
+                if features_vector is None:
+                    num_missing += 1
+                    continue
+
+                shard_hashes.append(image_hash)
+                shard_vectors.append(features_vector)
+
+        if len(shard_hashes) == 0:
+            continue
+
+        shard_matrix = np.stack(shard_vectors).astype(np.float32)
+        if index["features_shape"] is None:
+            index["features_shape"] = list(shard_matrix.shape[1:])
+        assert list(shard_matrix.shape[1:]) == index["features_shape"], \
+            "Error: features shape {} doesn't match the shards shape {}".format(shard_matrix.shape[1:], index["features_shape"])
+
+        file_name = "shard-{:05}.npy".format(len(index["shards"]))
+        upload_feature_shard(minio_client, prefix, file_name, shard_matrix)
+        index["shards"].append({"file_name": file_name, "image_hashes": shard_hashes})
+
+        # the index is the commit point of the shard
+        index_data = io.BytesIO(json.dumps(index).encode('utf-8'))
+        cmd.upload_data(minio_client, "datasets", os.path.join(prefix, FEATURE_SHARDS_INDEX_FILE_NAME), index_data)
+
+    print("Images without features = {}".format(num_missing))
+    print("Time elapsed: {0}s".format(format(time.time() - start_time, ".2f")))
+
+    return index
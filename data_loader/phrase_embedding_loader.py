@@ -19,13 +19,30 @@ from data_loader.utils import get_object, get_phrases_from_prompt, get_datasets
 from data_loader.generated_image_data import GeneratedImageData
 from stable_diffusion.model.clip_text_embedder import CLIPTextEmbedder
 from utility.clip.clip_text_embedder import tensor_attention_pooling
+from data_loader.phrase_embedding_store import PhraseEmbeddingStore
+
+# the phrase embeddings of a dataset are uploaded in chunks holding only the phrases added since the last upload
+# datasets/<dataset>/output/phrase-embeddings/average-pooled/manifest.json       embedding dim & chunks in order
+# datasets/<dataset>/output/phrase-embeddings/average-pooled/chunk-00000.npz     phrase_arr, float16 embeddings_arr
+# the manifest is uploaded after the chunk, so it only references complete chunks
+# datasets without a manifest are loaded from the latest dated -phrase-embeddings-average-pooled.npz
+PHRASE_EMBEDDINGS_PATH = "output/phrase-embeddings"
+PHRASE_EMBEDDING_CHUNKS_PATH = "output/phrase-embeddings/average-pooled"
+PHRASE_EMBEDDINGS_MANIFEST_FILE_NAME = "manifest.json"
+# chunks loaded in the local store, kept in the cache directory
+LOCAL_CHUNKS_FILE_NAME = "chunks.json"
+PHRASE_ENCODE_BATCH_SIZE = 64
+PHRASE_UPLOAD_EVERY_ROWS = 30000
+PHRASE_CHUNKS_DOWNLOAD_WORKERS = 8
+
 
 class PhraseEmbeddingLoader:
     def __init__(self,
                  dataset_name,
                  minio_ip_addr=None,
                  minio_access_key=None,
-                 minio_secret_key=None,):
+                 minio_secret_key=None,
+                 cache_directory=None):
         self.dataset_name = dataset_name
 
         self.minio_access_key = minio_access_key
@@ -34,41 +51,100 @@ class PhraseEmbeddingLoader:
                                                  minio_secret_key=self.minio_secret_key,
                                                  minio_ip_addr=minio_ip_addr)
 
-        self.phrase_index_dict = {}
-        self.phrase_arr = np.array([])
-        self.phrase_embedding_arr = np.array([])
+        # with a cache directory the embeddings are kept on disk
+        # and only the chunks uploaded since the last run are downloaded
+        self.cache_directory = cache_directory
+        self.store = PhraseEmbeddingStore(directory=cache_directory)
+        self.manifest = {"embedding_dim": self.store.embedding_dim, "dtype": "float16", "chunks": []}
+        # rows of the store that are in the uploaded chunks
+        self.num_uploaded_rows = 0
 
         self.text_embedder = None
 
+    @property
+    def phrase_index_dict(self):
+        return self.store.phrase_index_dict
+
+    @property
+    def phrase_arr(self):
+        return np.array(self.store.phrases)
+
+    @property
+    def phrase_embedding_arr(self):
+        return self.store.get_embeddings_matrix()
+
+    def get_chunks_prefix(self):
+        return os.path.join(self.dataset_name, PHRASE_EMBEDDING_CHUNKS_PATH)
+
+    def load_local_chunks(self):
+        if self.cache_directory is None:
+            return []
 
-    def load_phrase_embeddings(self):
-        count = 0
-        while True:
-            # try current date
-            date_now = datetime.now(tz=timezone("Asia/Hong_Kong")) - timedelta(days=count)
-            date_now = date_now.strftime('%Y-%m-%d')
-            full_path = os.path.join(self.dataset_name, "output/phrase-embeddings", "{}-phrase-embeddings-average-pooled.npz".format(date_now))
-            print(f"Getting phrase embeddings: ", full_path)
+        local_chunks_path = os.path.join(self.cache_directory, LOCAL_CHUNKS_FILE_NAME)
+        if not os.path.exists(local_chunks_path):
+            return []
 
-            # check if exists
-            if  cmd.is_object_exists(self.minio_client, "datasets", full_path):
-                data = get_object(self.minio_client, full_path)
-                data_buffer = io.BytesIO(data)
-                npz_data = np.load(data_buffer, allow_pickle=True)
-                self.phrase_arr = npz_data["phrase_arr"]
-                self.phrase_embedding_arr = npz_data["embeddings_arr"]
-                print("phrase arr shape=", self.phrase_arr.shape)
-                print("embedding arr shape=", self.phrase_embedding_arr.shape)
+        with open(local_chunks_path, 'r') as file:
+            return json.load(file)
 
-                # add keys to phrase index dict
-                for i in range(len(self.phrase_arr)):
-                    phrase = self.phrase_arr[i]
-                    self.phrase_index_dict[phrase] = i
+    def save_local_chunks(self):
+        if self.cache_directory is None:
+            return
+
+        local_chunks_path = os.path.join(self.cache_directory, LOCAL_CHUNKS_FILE_NAME)
+        with open(local_chunks_path + ".tmp", 'w') as file:
+            json.dump(self.manifest["chunks"], file)
+        os.replace(local_chunks_path + ".tmp", local_chunks_path)
+
+    def load_npz(self, path):
+        data = get_object(self.minio_client, path)
+        npz_data = np.load(io.BytesIO(data), allow_pickle=True)
+
+        return npz_data["phrase_arr"].tolist(), npz_data["embeddings_arr"]
+
+    def load_phrase_embedding_chunks(self):
+        manifest = json.loads(get_object(self.minio_client, os.path.join(self.get_chunks_prefix(), PHRASE_EMBEDDINGS_MANIFEST_FILE_NAME)))
+        chunks = manifest["chunks"]
+
+        # the local store can be reused if it has the first chunks of the manifest and nothing else
+        local_chunks = self.load_local_chunks()
+        num_local_rows = sum(chunk["num_rows"] for chunk in local_chunks)
+        if local_chunks != chunks[:len(local_chunks)] or num_local_rows != len(self.store):
+            self.store.clear()
+            local_chunks = []
+
+        new_chunks = chunks[len(local_chunks):]
+        print("{} phrase embedding chunks, {} to download".format(len(chunks), len(new_chunks)))
+
+        with ThreadPoolExecutor(max_workers=PHRASE_CHUNKS_DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(self.load_npz, os.path.join(self.get_chunks_prefix(), chunk["file_name"]))
+                       for chunk in new_chunks]
+            # appended in the order of the manifest
+            for future in tqdm(futures):
+                phrases, embeddings = future.result()
+                self.store.append(phrases, embeddings)
+
+        self.manifest = manifest
+        self.num_uploaded_rows = len(self.store)
+        self.save_local_chunks()
+
+    def load_phrase_embeddings(self, all_objects):
+        # latest dated npz, the dates sort in order
+        npz_paths = sorted(path for path in all_objects if path.endswith("-phrase-embeddings-average-pooled.npz"))
+        if len(npz_paths) == 0:
+            print("No phrase embeddings data for the dataset in minio server")
+            return
 
-                print("Phrase embeddings data loaded...")
-                return
+        full_path = npz_paths[-1]
+        print(f"Getting phrase embeddings: ", full_path)
+        phrases, embeddings = self.load_npz(full_path)
 
-            count += 1
+        self.store.clear()
+        self.store.append(phrases, embeddings)
+        # the first upload puts every phrase in a chunk
+        self.num_uploaded_rows = 0
+        self.save_local_chunks()
+        print("Phrase embeddings data loaded...")
 
     def load_dataset_phrases(self):
         start_time = time.time()
@@ -78,112 +154,89 @@ class PhraseEmbeddingLoader:
         if self.dataset_name not in dataset_list:
             raise Exception("Dataset is not in minio server")
 
-
         # check if there is a phrase embedding data
-        phrase_embeddings_prefix = os.path.join(self.dataset_name, "output/phrase-embeddings")
+        phrase_embeddings_prefix = os.path.join(self.dataset_name, PHRASE_EMBEDDINGS_PATH)
         all_objects = cmd.get_list_of_objects_with_prefix(self.minio_client, 'datasets', phrase_embeddings_prefix)
-        if len(all_objects) != 0:
-            # then load phrase embeddings
-            self.load_phrase_embeddings()
-            print("Data loaded...")
-            print("Time elapsed: {0}s".format(format(time.time() - start_time, ".2f")))
-        else:
+        if len(all_objects) == 0:
             print("No phrase embeddings data for the dataset in minio server")
             return
 
-    def upload_phrases_embedding_npz(self):
-        date_now = datetime.now(tz=timezone("Asia/Hong_Kong")).strftime('%Y-%m-%d')
-        filename = "{}-phrase-embeddings-average-pooled.npz".format(date_now)
-        phrase_embedding_path = os.path.join(self.dataset_name, "output/phrase-embeddings", filename)
-
-        compressed_array = io.BytesIO()
-        np.savez_compressed(compressed_array,
-                            phrase_arr=self.phrase_arr,
-                            embeddings_arr=self.phrase_embedding_arr)
-
-        compressed_array.seek(0)
+        manifest_path = os.path.join(self.get_chunks_prefix(), PHRASE_EMBEDDINGS_MANIFEST_FILE_NAME)
+        if manifest_path in all_objects:
+            self.load_phrase_embedding_chunks()
+        else:
+            self.load_phrase_embeddings(all_objects)
 
-        cmd.upload_data(self.minio_client, 'datasets', phrase_embedding_path, compressed_array)
+        print("phrase embeddings shape=", self.phrase_embedding_arr.shape)
+        print("Data loaded...")
+        print("Time elapsed: {0}s".format(format(time.time() - start_time, ".2f")))
 
-    def update_dataset_phrases(self, phrases_arr):
-        # load text embedder
-        text_embedder = CLIPTextEmbedder()
-        text_embedder.load_submodels()
-        self.text_embedder = text_embedder
+    def upload_new_rows(self):
+        # uploads the phrases added since the last upload as a new chunk
+        if len(self.store) <= self.num_uploaded_rows:
+            return
 
-        print("Updating phrase embeddings data...")
-        len_phrases_arr = len(phrases_arr)
-        count_added = 0
-        max_batch_size = 64
-        batch_phrase = []
-        i = 0
-        for phrase in tqdm(phrases_arr):
-            if phrase not in self.phrase_index_dict:
-                batch_phrase.append(phrase)
-
-                if len(batch_phrase) == max_batch_size or i >= (len_phrases_arr - max_batch_size):
-                    # get embedding of phrase
-                    phrase_embeddings, _, phrase_attention_masks = text_embedder.forward_return_all(batch_phrase)
-                    phrase_average_pooled = tensor_attention_pooling(phrase_embeddings, phrase_attention_masks)
-                    phrase_average_pooled_results = phrase_average_pooled.cpu().detach().numpy()
-
-                    for i in range(len(batch_phrase)):
-                            phrase = batch_phrase[i]
-
-                            curr_len = len(self.phrase_arr)
-                            self.phrase_index_dict[phrase] = curr_len
-                            self.phrase_arr = np.append(self.phrase_arr, phrase)
-
-                    if len(self.phrase_embedding_arr) == 0:
-                        self.phrase_embedding_arr = phrase_average_pooled_results
-
-                    else:
-                        if self.phrase_embedding_arr.shape == (768,):
-                            self.phrase_embedding_arr = np.expand_dims(self.phrase_embedding_arr, axis=0)
-                        self.phrase_embedding_arr = np.append(self.phrase_embedding_arr, phrase_average_pooled_results, axis=0)
-
-                    count_added += len(batch_phrase)
-                    # update every 30k data are newly added
-                    if count_added % 30000 == 0:
-                        self.upload_phrases_embedding_npz()
-
-                    batch_phrase = []
-            i += 1
+        phrases, embeddings = self.store.get_rows(self.num_uploaded_rows)
+        file_name = "chunk-{:05}.npz".format(len(self.manifest["chunks"]))
 
-        # save after update
-        self.upload_phrases_embedding_npz()
+        compressed_array = io.BytesIO()
+        np.savez_compressed(compressed_array,
+                            phrase_arr=np.array(phrases),
+                            embeddings_arr=embeddings)
+        compressed_array.seek(0)
+        cmd.upload_data(self.minio_client, 'datasets', os.path.join(self.get_chunks_prefix(), file_name), compressed_array)
 
-    def get_embedding(self, phrase):
-        if phrase in self.phrase_index_dict:
-            index = self.phrase_index_dict[phrase]
-        else:
-            # calculate embedding
-            phrase_embeddings, _, phrase_attention_masks = self.text_embedder.forward_return_all(phrase)
-            phrase_average_pooled = tensor_attention_pooling(phrase_embeddings, phrase_attention_masks)
-            phrase_average_pooled_results = phrase_average_pooled.cpu().detach().numpy()
+        self.manifest["chunks"].append({"file_name": file_name, "num_rows": len(phrases)})
+        manifest_data = io.BytesIO(json.dumps(self.manifest).encode('utf-8'))
+        cmd.upload_data(self.minio_client, 'datasets', os.path.join(self.get_chunks_prefix(), PHRASE_EMBEDDINGS_MANIFEST_FILE_NAME), manifest_data)
 
-            curr_len = len(self.phrase_arr)
-            self.phrase_index_dict[phrase] = curr_len
-            self.phrase_arr = np.append(self.phrase_arr, phrase)
+        self.num_uploaded_rows = len(self.store)
+        self.save_local_chunks()
 
-            self.phrase_embedding_arr = np.append(self.phrase_embedding_arr, phrase_average_pooled_results, axis=0)
+    def encode_phrases(self, phrases):
+        phrase_embeddings, _, phrase_attention_masks = self.text_embedder.forward_return_all(phrases)
+        phrase_average_pooled = tensor_attention_pooling(phrase_embeddings, phrase_attention_masks)
 
-            return phrase_average_pooled_results
+        return phrase_average_pooled.cpu().detach().numpy()
 
-        return self.phrase_embedding_arr[index]
+    def add_phrases(self, phrases, upload_every_rows=None):
+        # encodes the phrases that are not in the store in batches
+        missing_phrases = [phrase for phrase in dict.fromkeys(phrases) if phrase not in self.store]
 
-    def get_embeddings(self, phrases):
-        phrase_embeddings = []
-        for phrase in phrases:
-            embedding = self.get_embedding(phrase)
-            phrase_embeddings.append(embedding)
+        for i in tqdm(range(0, len(missing_phrases), PHRASE_ENCODE_BATCH_SIZE), disable=len(missing_phrases) <= PHRASE_ENCODE_BATCH_SIZE):
+            batch_phrases = missing_phrases[i:i + PHRASE_ENCODE_BATCH_SIZE]
+            self.store.append(batch_phrases, self.encode_phrases(batch_phrases))
 
-        return phrase_embeddings
+            if upload_every_rows is not None and len(self.store) - self.num_uploaded_rows >= upload_every_rows:
+                self.upload_new_rows()
 
+        return len(missing_phrases)
 
+    def update_dataset_phrases(self, phrases_arr):
+        # load text embedder
+        if self.text_embedder is None:
+            text_embedder = CLIPTextEmbedder()
+            text_embedder.load_submodels()
+            self.text_embedder = text_embedder
 
+        print("Updating phrase embeddings data...")
+        count_added = self.add_phrases(phrases_arr, upload_every_rows=PHRASE_UPLOAD_EVERY_ROWS)
+        print("Added {} phrases".format(count_added))
 
+        # save after update
+        self.upload_new_rows()
 
+    def get_embedding(self, phrase):
+        index = self.store.get_index(phrase)
+        if index is None:
+            self.add_phrases([phrase])
+            index = self.store.get_index(phrase)
 
+        return self.store.matrix[index].astype(np.float32)
 
+    def get_embeddings(self, phrases):
+        # the missing phrases are encoded together
+        self.add_phrases(phrases)
+        indices = np.array([self.store.get_index(phrase) for phrase in phrases], dtype=np.int64)
 
+        return self.store.matrix[indices].astype(np.float32)
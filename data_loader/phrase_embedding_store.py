@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+
+# growable store of phrase embeddings
+#
+# rows are appended into a matrix whose capacity doubles when it's full,
+# so adding n phrases copies O(n) rows in total instead of the whole matrix every time
+#
+# with a directory the store is kept on disk, append-only:
+# <directory>/embeddings.f16    (capacity, embedding dim) float16 matrix, memory mapped
+# <directory>/phrases.jsonl     one json string per line, line i is the phrase of row i
+#
+# the rows are written before their phrases, so the phrases file is the commit point:
+# rows without a phrase after a crash are overwritten by the next append
+
+PHRASE_EMBEDDING_DTYPE = np.float16
+DEFAULT_PHRASE_EMBEDDING_DIM = 768
+DEFAULT_INITIAL_CAPACITY = 1024
+EMBEDDINGS_FILE_NAME = "embeddings.f16"
+PHRASES_FILE_NAME = "phrases.jsonl"
+
+
+class PhraseEmbeddingStore:
+    def __init__(self, embedding_dim=DEFAULT_PHRASE_EMBEDDING_DIM, directory=None, initial_capacity=DEFAULT_INITIAL_CAPACITY):
+        self.embedding_dim = embedding_dim
+        self.directory = directory
+        self.initial_capacity = initial_capacity
+
+        self.phrases = []
+        self.phrase_index_dict = {}
+        self.num_rows = 0
+        self.matrix = None
+        self.phrases_file = None
+
+        if directory is None:
+            self.matrix = np.zeros((initial_capacity, embedding_dim), dtype=PHRASE_EMBEDDING_DTYPE)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.open_files()
+
+    def __len__(self):
+        return self.num_rows
+
+    def __contains__(self, phrase):
+        return phrase in self.phrase_index_dict
+
+    def get_embeddings_path(self):
+        return os.path.join(self.directory, EMBEDDINGS_FILE_NAME)
+
+    def get_phrases_path(self):
+        return os.path.join(self.directory, PHRASES_FILE_NAME)
+
+    def open_files(self):
+        phrases = []
+        if os.path.exists(self.get_phrases_path()):
+            with open(self.get_phrases_path(), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        phrases.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # partially written line
+                        break
+
+        row_size = self.embedding_dim * np.dtype(PHRASE_EMBEDDING_DTYPE).itemsize
+        capacity = 0
+        if os.path.exists(self.get_embeddings_path()):
+            capacity = os.path.getsize(self.get_embeddings_path()) // row_size
+
+        # phrases whose rows didn't make it to the file are dropped
+        phrases = phrases[:capacity]
+        self.rewrite_phrases_file_if_needed(phrases)
+
+        self.phrases = phrases
+        self.phrase_index_dict = {phrase: i for i, phrase in enumerate(phrases)}
+        self.num_rows = len(phrases)
+        self.map_embeddings_file(max(capacity, self.initial_capacity))
+        self.phrases_file = open(self.get_phrases_path(), 'a', encoding='utf-8')
+
+    def rewrite_phrases_file_if_needed(self, phrases):
+        if not os.path.exists(self.get_phrases_path()):
+            return
+
+        with open(self.get_phrases_path(), 'r', encoding='utf-8') as file:
+            num_lines = sum(1 for _ in file)
+        if num_lines == len(phrases):
+            return
+
+        temp_path = self.get_phrases_path() + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for phrase in phrases:
+                file.write(json.dumps(phrase) + "\n")
+        os.replace(temp_path, self.get_phrases_path())
+
+    def map_embeddings_file(self, capacity):
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.matrix = None
+
+        row_size = self.embedding_dim * np.dtype(PHRASE_EMBEDDING_DTYPE).itemsize
+        with open(self.get_embeddings_path(), 'ab') as file:
+            file.truncate(capacity * row_size)
+
+        self.matrix = np.memmap(self.get_embeddings_path(),
+                                dtype=PHRASE_EMBEDDING_DTYPE,
+                                mode='r+',
+                                shape=(capacity, self.embedding_dim))
+
+    def get_capacity(self):
+        return self.matrix.shape[0]
+
+    def reserve(self, num_rows):
+        capacity = self.get_capacity()
+        if num_rows <= capacity:
+            return
+
+        while capacity < num_rows:
+            capacity *= 2
+
+        if self.directory is None:
+            matrix = np.zeros((capacity, self.embedding_dim), dtype=PHRASE_EMBEDDING_DTYPE)
+            matrix[:self.num_rows] = self.matrix[:self.num_rows]
+            self.matrix = matrix
+        else:
+            self.map_embeddings_file(capacity)
+
+    def append(self, phrases, embeddings):
+        # phrases already in the store are skipped, returns the number of rows added
+        embeddings = np.asarray(embeddings).reshape(len(phrases), self.embedding_dim)
+
+        new_phrases = []
+        new_rows = []
+        for i, phrase in enumerate(phrases):
+            if phrase in self.phrase_index_dict:
+                continue
+            self.phrase_index_dict[phrase] = self.num_rows + len(new_phrases)
+            new_phrases.append(phrase)
+            new_rows.append(i)
+
+        if len(new_phrases) == 0:
+            return 0
+
+        self.reserve(self.num_rows + len(new_phrases))
+        self.matrix[self.num_rows:self.num_rows + len(new_phrases)] = embeddings[new_rows]
+
+        if self.directory is not None:
+            self.matrix.flush()
+            self.phrases_file.write("".join(json.dumps(phrase) + "\n" for phrase in new_phrases))
+            self.phrases_file.flush()
+
+        self.phrases.extend(new_phrases)
+        self.num_rows += len(new_phrases)
+
+        return len(new_phrases)
+
+    def get_index(self, phrase):
+        return self.phrase_index_dict.get(phrase)
+
+    def get_embeddings_matrix(self):
+        # view of the stored rows
+        return self.matrix[:self.num_rows]
+
+    def get_rows(self, start, end=None):
+        if end is None:
+            end = self.num_rows
+
+        return self.phrases[start:end], np.array(self.matrix[start:end])
+
+    def clear(self):
+        self.phrases = []
+        self.phrase_index_dict = {}
+        self.num_rows = 0
+
+        if self.directory is not None:
+            self.phrases_file.close()
+            with open(self.get_phrases_path(), 'w', encoding='utf-8'):
+                pass
+            self.phrases_file = open(self.get_phrases_path(), 'a', encoding='utf-8')
+
+    def close(self):
+        if self.directory is not None:
+            self.matrix.flush()
+            self.phrases_file.close()
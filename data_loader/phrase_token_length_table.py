@@ -0,0 +1,146 @@
+import io
+import os
+import hashlib
+import numpy as np
+
+from utility.minio import cmd
+
+# token lengths of a phrase corpus, built once and kept next to the phrase embeddings
+# datasets/<dataset>/output/phrase-embeddings/token-lengths/<sha1 of the phrases>.npz    int16 token_lengths
+#
+# the phrase indices are bucketed by token length (sorted by length, bucket k is a contiguous slice),
+# so the phrases with length <= k are the first num_phrases_up_to[k] indices of the sorted list
+# and a phrase within a token budget is sampled with one random number, without tokenizing anything
+#
+# token lengths are counted like the tokenizer counts them for a single phrase, with the start and end tokens
+
+TOKEN_LENGTHS_PATH = "output/phrase-embeddings/token-lengths"
+TOKEN_LENGTH_DTYPE = np.int16
+TOKENIZE_BATCH_SIZE = 4096
+
+
+def get_corpus_hash(phrases):
+    corpus_hash = hashlib.sha1()
+    for phrase in phrases:
+        corpus_hash.update(phrase.encode('utf-8'))
+        corpus_hash.update(b"\n")
+
+    return corpus_hash.hexdigest()
+
+
+def compute_token_lengths(tokenizer, phrases, batch_size=TOKENIZE_BATCH_SIZE):
+    # one tokenizer call per batch, nothing is padded or truncated
+    token_lengths = np.zeros(len(phrases), dtype=TOKEN_LENGTH_DTYPE)
+    for start in range(0, len(phrases), batch_size):
+        batch_encoding = tokenizer(list(phrases[start:start + batch_size]), truncation=False, padding=False)
+        token_lengths[start:start + batch_size] = [len(input_ids) for input_ids in batch_encoding['input_ids']]
+
+    return token_lengths
+
+
+class PhraseTokenLengthTable:
+    def __init__(self, phrases, token_lengths):
+        self.phrases = phrases
+        self.token_lengths = np.asarray(token_lengths, dtype=TOKEN_LENGTH_DTYPE)
+        self.phrase_index_dict = {phrase: i for i, phrase in enumerate(phrases)}
+
+        # phrase indices bucketed by token length
+        self.sorted_indices = np.argsort(self.token_lengths, kind='stable')
+        sorted_token_lengths = self.token_lengths[self.sorted_indices]
+        self.max_token_length = int(sorted_token_lengths[-1]) if len(phrases) > 0 else 0
+        # num_phrases_up_to[k] is the number of phrases with token length <= k
+        self.num_phrases_up_to = np.searchsorted(sorted_token_lengths,
+                                                 np.arange(self.max_token_length + 1),
+                                                 side='right')
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def get_token_length(self, phrase):
+        index = self.phrase_index_dict.get(phrase)
+        if index is None:
+            return None
+
+        return int(self.token_lengths[index])
+
+    def get_bucket(self, token_length):
+        # indices of the phrases with exactly token_length tokens
+        if token_length < 0 or token_length > self.max_token_length:
+            return self.sorted_indices[:0]
+
+        start = self.num_phrases_up_to[token_length - 1] if token_length > 0 else 0
+        return self.sorted_indices[start:self.num_phrases_up_to[token_length]]
+
+    def count_up_to(self, max_token_lengths):
+        max_token_lengths = np.clip(np.asarray(max_token_lengths), -1, self.max_token_length)
+        counts = self.num_phrases_up_to[np.maximum(max_token_lengths, 0)]
+
+        return np.where(max_token_lengths < 0, 0, counts)
+
+    def sample_indices(self, max_token_lengths, rng=np.random):
+        # one phrase index per max token length, uniform over the phrases with length <= max
+        # -1 where no phrase fits
+        counts = self.count_up_to(max_token_lengths)
+        positions = (rng.random_sample(counts.shape) * counts).astype(np.int64)
+        positions = np.minimum(positions, np.maximum(counts - 1, 0))
+
+        return np.where(counts > 0, self.sorted_indices[positions], -1)
+
+    def sample(self, max_token_length, rng=np.random):
+        # returns (phrase index, phrase), or (None, None) if no phrase fits
+        index = int(self.sample_indices(np.array([max_token_length]), rng)[0])
+        if index < 0:
+            return None, None
+
+        return index, self.phrases[index]
+
+    def save(self, minio_client, dataset_name):
+        buffer = io.BytesIO()
+        np.savez(buffer, token_lengths=self.token_lengths)
+        buffer.seek(0)
+        cmd.upload_data(minio_client, 'datasets', get_token_lengths_path(dataset_name, self.phrases), buffer)
+
+
+def get_token_lengths_path(dataset_name, phrases):
+    return os.path.join(dataset_name, TOKEN_LENGTHS_PATH, get_corpus_hash(phrases) + ".npz")
+
+
+def load_phrase_token_length_table(minio_client, dataset_name, phrases, tokenizer=None, known_token_lengths=None):
+    # loads the table of the phrase corpus from minio, or builds and uploads it
+    # known_token_lengths is a phrase => token length dict (the token lengths of the phrase scores csv, etc.),
+    # the other phrases are tokenized in batches
+    path = get_token_lengths_path(dataset_name, phrases)
+    if cmd.is_object_exists(minio_client, 'datasets', path):
+        data = cmd.get_file_from_minio(minio_client, 'datasets', path)
+        with np.load(io.BytesIO(data.read())) as npz:
+            token_lengths = npz['token_lengths']
+        if len(token_lengths) == len(phrases):
+            print("Loaded the token lengths of {} phrases from {}".format(len(phrases), path))
+            return PhraseTokenLengthTable(phrases, token_lengths)
+
+    if known_token_lengths is None:
+        known_token_lengths = {}
+
+    token_lengths = np.zeros(len(phrases), dtype=TOKEN_LENGTH_DTYPE)
+    missing_indices = []
+    for index, phrase in enumerate(phrases):
+        token_length = known_token_lengths.get(phrase)
+        if token_length is None or token_length != token_length:
+            # missing or nan
+            missing_indices.append(index)
+        else:
+            token_lengths[index] = token_length
+
+    if len(missing_indices) > 0:
+        if tokenizer is None:
+            raise Exception("{} phrases have no token length and there is no tokenizer to compute them".format(len(missing_indices)))
+        print("Computing the token lengths of {} phrases".format(len(missing_indices)))
+        token_lengths[missing_indices] = compute_token_lengths(tokenizer, [phrases[i] for i in missing_indices])
+
+    table = PhraseTokenLengthTable(phrases, token_lengths)
+    try:
+        table.save(minio_client, dataset_name)
+    except Exception as e:
+        print("Error uploading the phrase token lengths: {}".format(e))
+
+    return table
@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import time
+import msgpack
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
@@ -20,78 +21,127 @@ def get_datasets(minio_client):
     return datasets
 
 
-def get_ab_data(minio_client, path, index):
-    # load json object from minio
-    data = get_object(minio_client, path)
-    decoded_data = data.decode().replace("'", '"')
-    item = json.loads(decoded_data)
+# selection datapoints are written one json per datapoint in <ranking prefix>/aggregate/
+# the aggregator packs them per day in <ranking prefix>/daily/<date>.msgpack
+# and lists the packed days in <ranking prefix>/daily/manifest.json
+#
+# every packed datapoint keeps the file name and etag of its json,
+# so a json that was changed (flagged) or added after packing is read on its own
+SELECTION_DATAPOINTS_AGGREGATE_PATH = "aggregate"
+SELECTION_DATAPOINTS_DAILY_PATH = "daily"
+SELECTION_DATAPOINTS_MANIFEST_FILE_NAME = "manifest.json"
+SELECTION_DATAPOINTS_DOWNLOAD_WORKERS = 16
 
-    flagged = False
-    if "flagged" in item:
-        flagged = item["flagged"]
 
-    ab_data = ABData.deserialize(item)
+def get_dataset_ranking_prefix(dataset_name):
+    return os.path.join(dataset_name, "data/ranking")
 
-    return ab_data, flagged, index
 
+def get_rank_ranking_prefix(rank_model_id):
+    return "ranks/{:05}/data/ranking".format(rank_model_id)
 
-def get_aggregated_selection_datapoints(minio_client, dataset_name):
-    prefix = os.path.join(dataset_name, "data/ranking/aggregate")
-    dataset_paths = cmd.get_list_of_objects_with_prefix(minio_client, "datasets", prefix=prefix)
 
-    print("Get selection datapoints contents and filter out flagged datapoints...")
-    ab_data_list = [None] * len(dataset_paths)
-    flagged_count = 0
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        count = 0
-        for path in dataset_paths:
-            futures.append(executor.submit(get_ab_data, minio_client=minio_client, path=path, index=count))
-            count += 1
-
-        for future in tqdm(as_completed(futures), total=len(dataset_paths)):
-            ab_data, flagged, index = future.result()
-            if not flagged:
-                ab_data_list[index] = ab_data
-            else:
-                flagged_count += 1
+def get_daily_file_path(ranking_prefix, date):
+    return os.path.join(ranking_prefix, SELECTION_DATAPOINTS_DAILY_PATH, "{}.msgpack".format(date))
+
+
+def get_manifest_path(ranking_prefix):
+    return os.path.join(ranking_prefix, SELECTION_DATAPOINTS_DAILY_PATH, SELECTION_DATAPOINTS_MANIFEST_FILE_NAME)
+
+
+def list_objects_with_etags(minio_client, prefix):
+    # object path => etag, in a single listing
+    objects = minio_client.list_objects(DATASETS_BUCKET, prefix=prefix, recursive=True)
+    return {obj.object_name: obj.etag for obj in objects}
+
+
+def parse_selection_datapoint(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        # some old datapoints were written with python's str() of the dict
+        return json.loads(data.decode().replace("'", '"'))
+
+
+def load_daily_manifest(minio_client, ranking_prefix):
+    manifest_path = get_manifest_path(ranking_prefix)
+    if not cmd.is_object_exists(minio_client, DATASETS_BUCKET, manifest_path):
+        return {"days": {}}
+
+    return json.loads(get_object(minio_client, manifest_path))
+
+
+def load_daily_file(minio_client, ranking_prefix, date):
+    return msgpack.unpackb(get_object(minio_client, get_daily_file_path(ranking_prefix, date)))
+
+
+def get_selection_datapoint(minio_client, path):
+    return path, parse_selection_datapoint(get_object(minio_client, path))
+
+
+def load_selection_datapoints(minio_client, ranking_prefix):
+    # returns the datapoint dicts sorted by the path of their json
+    # the packed days take a handful of reads, only the jsons not packed are read one by one
+    aggregate_prefix = os.path.join(ranking_prefix, SELECTION_DATAPOINTS_AGGREGATE_PATH)
+    listed_etags = list_objects_with_etags(minio_client, aggregate_prefix + "/")
+    manifest = load_daily_manifest(minio_client, ranking_prefix)
 
+    datapoints = {}
+    with ThreadPoolExecutor(max_workers=SELECTION_DATAPOINTS_DOWNLOAD_WORKERS) as executor:
+        futures = {}
+        for date in manifest["days"]:
+            futures[executor.submit(load_daily_file, minio_client, ranking_prefix, date)] = date
+
+        for future in as_completed(futures):
+            day = manifest["days"][futures[future]]
+            for entry in future.result()["datapoints"]:
+                path = os.path.join(aggregate_prefix, entry["file_name"])
+                if path in listed_etags:
+                    if listed_etags[path] != entry["etag"]:
+                        # changed after it was packed
+                        continue
+                elif not day["originals_removed"]:
+                    # the json was deleted after it was packed
+                    continue
+
+                datapoints[path] = entry["data"]
+
+        unpacked_paths = [path for path in listed_etags if path not in datapoints]
+        print("{} packed selection datapoints, {} to download".format(len(datapoints), len(unpacked_paths)))
+
+        futures = [executor.submit(get_selection_datapoint, minio_client, path) for path in unpacked_paths]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            path, item = future.result()
+            datapoints[path] = item
+
+    return [datapoints[path] for path in sorted(datapoints.keys())]
+
+
+def get_unflagged_ab_data(datapoints):
     unflagged_ab_data = []
-    for data in tqdm(ab_data_list):
-        if data is not None:
-            unflagged_ab_data.append(data)
+    flagged_count = 0
+    for item in datapoints:
+        if item.get("flagged", False):
+            flagged_count += 1
+            continue
+
+        unflagged_ab_data.append(ABData.deserialize(item))
 
     print("Total flagged selection datapoints = {}".format(flagged_count))
     return unflagged_ab_data
 
-def get_aggregated_selection_datapoints_v1(minio_client, rank_model_id):
-    prefix = "ranks/{:05}/data/ranking/aggregate".format(rank_model_id)
-    dataset_paths = cmd.get_list_of_objects_with_prefix(minio_client, "datasets", prefix=prefix)
 
+def get_aggregated_selection_datapoints(minio_client, dataset_name):
     print("Get selection datapoints contents and filter out flagged datapoints...")
-    ab_data_list = [None] * len(dataset_paths)
-    flagged_count = 0
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        count = 0
-        for path in dataset_paths:
-            futures.append(executor.submit(get_ab_data, minio_client=minio_client, path=path, index=count))
-            count += 1
-
-        for future in tqdm(as_completed(futures), total=len(dataset_paths)):
-            ab_data, flagged, index = future.result()
-            if not flagged:
-                ab_data_list[index] = ab_data
-            else:
-                flagged_count += 1
+    datapoints = load_selection_datapoints(minio_client, get_dataset_ranking_prefix(dataset_name))
 
-    unflagged_ab_data = []
-    for data in tqdm(ab_data_list):
-        if data is not None:
-            unflagged_ab_data.append(data)
+    return get_unflagged_ab_data(datapoints)
 
-    print("Total flagged selection datapoints = {}".format(flagged_count))
-    return unflagged_ab_data
+def get_aggregated_selection_datapoints_v1(minio_client, rank_model_id):
+    print("Get selection datapoints contents and filter out flagged datapoints...")
+    datapoints = load_selection_datapoints(minio_client, get_rank_ranking_prefix(rank_model_id))
+
+    return get_unflagged_ab_data(datapoints)
 
 
 def get_object(client, file_path):
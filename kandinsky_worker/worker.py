@@ -561,10 +561,9 @@ def process_jobs(worker_state):
                     
                     job_completion_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status_img2img, args=(
-                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data))
-                    thread.start()
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_image_data_and_update_job_status_img2img,
+                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data)
 
                 elif task_type == 'inpainting_kandinsky':
                     output_file_path, output_file_hash, img_data, inpainting_latent, seed = run_inpainting_generation_task(worker_state,
@@ -587,12 +586,11 @@ def process_jobs(worker_state):
                                                                           generation_task.task_input_dict[
                                                                               "negative_decoder_prompt"],
                                                                           worker_state.clip_text_embedder)
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_image_data_and_update_job_status,
                         worker_state, job, generation_task, seed, inpainting_latent, output_file_path, output_file_hash, job_completion_time,
                         img_data, prompt_embedding, prompt_embedding_average_pooled, prompt_embedding_max_pooled,
-                        prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'image_generation_kandinsky':
                     output_file_path, output_file_hash, img_data, latent, seed = run_image_generation_task(worker_state,
@@ -616,22 +614,20 @@ def process_jobs(worker_state):
                                                                               "negative_decoder_prompt"],
                                                                           worker_state.clip_text_embedder)
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_image_data_and_update_job_status,
                         worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash,
                         job_completion_time, img_data, prompt_embedding, prompt_embedding_average_pooled,
-                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'clip_calculation_task_kandinsky':
                     output_file_path, output_file_hash, clip_data = run_clip_calculation_task(worker_state,
                                                                                               generation_task,
                                                                                               model_type="kandinsky")
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_data_and_update_job_status, args=(
-                        worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client,))
-                    thread.start()
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_data_and_update_job_status,
+                        worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client)
 
                 else:
                     e = "job with task type '" + task_type + "' is not supported"
@@ -647,6 +643,7 @@ def process_jobs(worker_state):
             last_job_time = job_end_time
             job_elapsed_time = job_end_time - job_start_time
             info(thread_state, f"job took {job_elapsed_time:.4f} seconds to execute.")
+            worker_state.upload_service.print_stats()
 
         else:
             # If there was no job, go to sleep for a while
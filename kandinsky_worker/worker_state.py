@@ -9,6 +9,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio.cmd import get_minio_client
+from utility.minio.upload_service import UploadService
 from configs.model_config import ModelPathConfig
 from kandinsky.model_paths import PRIOR_MODEL_PATH, INPAINT_DECODER_MODEL_PATH, DECODER_MODEL_PATH
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
@@ -39,6 +40,8 @@ class WorkerState:
         self.minio_client = get_minio_client(minio_access_key, minio_secret_key)
         self.queue_size = queue_size
         self.job_queue = queue.Queue()
+        # uploads of the generated data, bounded so the jobs wait when minio can't keep up
+        self.upload_service = UploadService(name="worker uploads")
         self.self_training_data={}
         self.dataset_list=[]
     
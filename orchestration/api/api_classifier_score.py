@@ -1,6 +1,6 @@
 from fastapi import Request, APIRouter, Query
-from .api_utils import PrettyJSONResponse, ErrorCode, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountResponse
-from orchestration.api.mongo_schemas import ClassifierScore, ListClassifierScore, ClassifierScoreRequest, ClassifierScoreV1, ListClassifierScore1, ListClassifierScore2, ListClassifierScore3, BatchClassifierScoreRequest
+from .api_utils import PrettyJSONResponse, ErrorCode, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountResponse, BulkWriteResponse, bulk_upsert_ndjson_body
+from orchestration.api.mongo_schemas import ClassifierScore, ListClassifierScore, ClassifierScoreRequest, ClassifierScoreV1, ListClassifierScore1, ListClassifierScore2, ListClassifierScore3, BatchClassifierScoreRequest, ClassifierScoreRequestV1
 from fastapi.encoders import jsonable_encoder
 import uuid
 from typing import Optional
@@ -1119,6 +1119,59 @@ async def set_image_classifier_score_v2(
         )
 
 
+def get_classifier_score_update_operation(item: dict):
+    try:
+        classifier_score = ClassifierScoreRequestV1(**item)
+    except (ValueError, TypeError):
+        return None
+
+    query = {
+        "classifier_id": classifier_score.classifier_id,
+        "uuid": classifier_score.job_uuid,
+        "image_source": classifier_score.image_source
+    }
+
+    new_score_data = {
+        "uuid": classifier_score.job_uuid,
+        "classifier_id": classifier_score.classifier_id,
+        "tag_id": classifier_score.tag_id,
+        "score": classifier_score.score,
+        "image_hash": classifier_score.image_hash,
+        "creation_time": datetime.utcnow().isoformat(),
+        "image_source": classifier_score.image_source
+    }
+
+    return UpdateOne(query, {"$set": new_score_data}, upsert=True)
+
+
+@router.post("/pseudotag-classifier-scores/set-image-classifier-scores-bulk", 
+             status_code=200,
+             response_model=StandardSuccessResponseV1[BulkWriteResponse],
+             description="Set classifier image scores in bulk. The body is newline delimited json, one ClassifierScoreRequestV1 per line",
+             tags=["pseudotag-classifier-scores"], 
+             responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def set_image_classifier_scores_bulk(request: Request):
+    # the body is a stream, it can't be read by createInstance
+    api_response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+
+    try:
+        counts = await bulk_upsert_ndjson_body(request,
+                                               request.app.image_classifier_scores_collection,
+                                               get_classifier_score_update_operation)
+
+        return api_response_handler.create_success_response_v1(
+            response_data=counts,
+            http_status_code=200  
+        )
+    
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR, 
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.post("/pseudotag-classifier-scores/set-image-classifier-score-list-v1", 
              status_code=200,
              response_model=StandardSuccessResponseV1[ListClassifierScore3],
@@ -134,6 +134,38 @@ def http_clip_server_get_cosine_similarity_list(bucket: str, image_path_list: Li
             response.close()
     return None
 
+def http_clip_server_search_images(bucket: str, phrase: str, k: int, dataset_list: Optional[List[str]] = None,
+                                   start_date: Optional[str] = None, end_date: Optional[str] = None):
+    url = f'{CLIP_SERVER_ADDRESS}/search-images'
+    params = {
+        'bucket': bucket,
+        'phrase': phrase,
+        'k': k,
+    }
+    if dataset_list:
+        params['dataset'] = dataset_list
+    if start_date:
+        params['start_date'] = start_date
+    if end_date:
+        params['end_date'] = end_date
+
+    response = None
+    try:
+        response = requests.get(url, params=params)
+
+        if response.status_code == 200:
+            result_json = response.json()
+            return result_json
+
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return None
+
 # ----------------------------------------------------------------------------
 
 
@@ -718,3 +750,62 @@ async def get_random_image_similarity_date_range_v1(
             error_string=str(e),
             http_status_code=500
         )
+
+
+@router.get("/clip/get-top-k-images-with-clip-search",
+            tags=["clip"],
+            description="Gets the k images of the whole dataset(s) that best match the 'phrase' param, using the nearest neighbor index of the clip server, and returns the list sorted by the similarity score.",
+            response_model=StandardSuccessResponseV1[ListSimilarityScoreTask],
+            responses=ApiResponseHandlerV1.listErrors([400, 422, 500]))
+async def get_top_k_images_with_clip_search(
+    request: Request,
+    phrase: str = Query(..., description="Phrase to compare similarity with"),
+    k: int = Query(20, description="Number of images to return"),
+    dataset: Optional[List[str]] = Query(None, description="Dataset(s) to filter images"),
+    similarity_threshold: float = Query(0, description="Minimum similarity score the images must have to be returned"),
+    start_date: str = None,
+    end_date: str = None
+):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    try:
+        if k <= 0:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string="k must be positive",
+                http_status_code=400
+            )
+
+        search_result = http_clip_server_search_images("datasets", phrase, k, dataset, start_date, end_date)
+
+        if search_result is None or 'images' not in search_result:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.OTHER_ERROR,
+                error_string="Error retrieving similarity scores",
+                http_status_code=500
+            )
+
+        similarity_scores = {}
+        for image in search_result['images']:
+            if image['similarity_score'] >= similarity_threshold:
+                similarity_scores['datasets/' + image['image_path']] = image['similarity_score']
+
+        # one query for all the jobs of the result
+        jobs = list(request.app.completed_jobs_collection.find(
+            {'task_output_file_dict.output_file_path': {'$in': list(similarity_scores.keys())}},
+            {'_id': 0}
+        ))
+
+        for job in jobs:
+            job["similarity_score"] = similarity_scores[job["task_output_file_dict"]["output_file_path"]]
+
+        jobs.sort(key=lambda job: job["similarity_score"], reverse=True)
+
+        return response_handler.create_success_response_v1(response_data={"images": jobs}, http_status_code=200)
+
+    except Exception as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
@@ -29,38 +29,49 @@ def get_datasets(request: Request):
     return objects
 
 
-@router.get("/dataset/sequential-id/{dataset}",tags = ['deprecated3'], description= "changed with /datasets/get-sequential-ids" )
-def get_sequential_id(request: Request, dataset: str, limit: int = 1):
-    sequential_id_arr = []
-
-    # find
-    sequential_id = request.app.dataset_sequential_id_collection.find_one({"dataset_name": dataset})
-    if sequential_id is None:
-        # create one
-        new_sequential_id = SequentialID(dataset)
-
-        # get the sequential id arr
-        for i in range(limit):
-            sequential_id_arr.append(new_sequential_id.get_sequential_id())
-
-        # add to collection
-        request.app.dataset_sequential_id_collection.insert_one(new_sequential_id.to_dict())
+def reserve_sequential_ids(request: Request, dataset: str, amount: int = 1):
+    # reserves a contiguous block of sequential ids in one atomic counter update
+    # so concurrent requests never get the same ids
+    max_num_files = 1000
+
+    # number of folders started up to a file count, file 0 starts in the first folder
+    def folders_started(file_count):
+        return {"$floor": {"$divide": [{"$max": [file_count, 0]}, max_num_files]}}
+
+    default_sequential_id = SequentialID(dataset)
+    old_file_count = {"$ifNull": ["$file_count", default_sequential_id.file_count]}
+    old_subfolder_count = {"$ifNull": ["$subfolder_count", default_sequential_id.subfolder_count]}
+    new_file_count = {"$add": [old_file_count, amount]}
+
+    previous = request.app.dataset_sequential_id_collection.find_one_and_update(
+        {"dataset_name": dataset},
+        [{"$set": {
+            "dataset_name": dataset,
+            "subfolder_count": {"$add": [old_subfolder_count,
+                                         {"$subtract": [folders_started(new_file_count), folders_started(old_file_count)]}]},
+            "file_count": new_file_count,
+        }}],
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
 
-        return sequential_id_arr
+    # rebuild the ids of the block from the counter before the update
+    if previous is None:
+        sequential_id = default_sequential_id
+    else:
+        sequential_id = SequentialID(previous["dataset_name"], previous.get("subfolder_count", default_sequential_id.subfolder_count),
+                                     previous.get("file_count", default_sequential_id.file_count))
 
-    # if found
-    found_sequential_id = SequentialID(sequential_id["dataset_name"], sequential_id["subfolder_count"],
-                                       sequential_id["file_count"])
-    # get the sequential id arr
-    for i in range(limit):
-        sequential_id_arr.append(found_sequential_id.get_sequential_id())
+    sequential_id_arr = []
+    for i in range(amount):
+        sequential_id_arr.append(sequential_id.get_sequential_id())
 
-    new_values = {"$set": found_sequential_id.to_dict()}
+    return sequential_id_arr
 
-    # # update existing sequential id
-    request.app.dataset_sequential_id_collection.update_one({"dataset_name": dataset}, new_values)
 
-    return sequential_id_arr
+@router.get("/dataset/sequential-id/{dataset}",tags = ['deprecated3'], description= "changed with /datasets/get-sequential-ids" )
+def get_sequential_id(request: Request, dataset: str, limit: int = 1):
+    return reserve_sequential_ids(request, dataset, limit)
 
 @router.delete("/dataset/delete-sequential-id", 
                tags = ['deprecated3'],
@@ -697,7 +708,6 @@ async def get_all_sequential_ids(request: Request):
             responses=ApiResponseHandlerV1.listErrors([400,422, 500]))
 async def get_sequential_id_1(request: Request, dataset: str = Query(..., description="Name of the dataset"), amount: int = Query(default=1, ge=1)):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
-    sequential_id_arr = []
 
     try:
         # Check if dataset exists in the collection or object list
@@ -713,28 +723,7 @@ async def get_sequential_id_1(request: Request, dataset: str = Query(..., descri
             )
 
 
-        sequential_id = request.app.dataset_sequential_id_collection.find_one({"dataset_name": dataset})
-        
-
-        if sequential_id is None:
-            # create one
-            new_sequential_id = SequentialID(dataset)
-            # get the sequential id arr
-            for i in range(amount):
-                sequential_id_arr.append(new_sequential_id.get_sequential_id())
-            # add to collection
-            request.app.dataset_sequential_id_collection.insert_one(new_sequential_id.to_dict())
-
-        else:
-            # if found, use the found sequential id
-            found_sequential_id = SequentialID(sequential_id["dataset_name"], sequential_id.get("subfolder_count", 0),
-                                               sequential_id.get("file_count", 0))
-            for i in range(amount):
-                sequential_id_arr.append(found_sequential_id.get_sequential_id())
-
-            new_values = {"$set": found_sequential_id.to_dict()}
-            # update existing sequential id
-            request.app.dataset_sequential_id_collection.update_one({"dataset_name": dataset}, new_values)
+        sequential_id_arr = reserve_sequential_ids(request, dataset, amount)
 
         # Return the sequential IDs
         return response_handler.create_success_response_v1(
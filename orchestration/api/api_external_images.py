@@ -2,7 +2,7 @@
 from fastapi import APIRouter, Body, Request, HTTPException, Query, status
 from typing import Optional
 from utility.path import separate_bucket_and_file_path
-from .api_utils import ApiResponseHandlerV1, StandardSuccessResponseV1, ErrorCode, WasPresentResponse, DeletedCount, validate_date_format, TagListForImages, TagCountResponse, TagListForImagesV1
+from .api_utils import ApiResponseHandlerV1, StandardSuccessResponseV1, ErrorCode, WasPresentResponse, DeletedCount, validate_date_format, TagListForImages, TagCountResponse, TagListForImagesV1, list_documents_since_cursor, set_cursor_seq
 from .mongo_schemas import ExternalImageData, ImageHashRequest, ListExternalImageData, ListImageHashRequest, ExternalImageDataV1, ListExternalImageDataV1, ListDatasetV1, ListExternalImageDataWithSimilarityScore, Dataset, ListExternalImageDataV2, ListDataset
 from orchestration.api.mongo_schema.tag_schemas import ExternalImageTag, ListExternalImageTag, ImageTag, ListImageTag
 from typing import List
@@ -74,6 +74,7 @@ async def add_external_image_data(request: Request, image_data: ExternalImageDat
                                                 image_data.image_format)
         
         # Insert the new image data into the collection
+        set_cursor_seq(request.app.counters_collection, request.app.external_images_collection, image_data_dict)
         request.app.external_images_collection.insert_one(image_data_dict)
         image_data_dict.pop('_id', None)
 
@@ -137,6 +138,7 @@ async def add_external_image_data_list(request: Request, image_data_list: List[E
                                                         image_data.image_format)
                 
                 # Insert the new image data into the collection
+                set_cursor_seq(request.app.counters_collection, request.app.external_images_collection, image_data_dict)
                 request.app.external_images_collection.insert_one(image_data_dict)
                 # update sequential id
                 loop = asyncio.get_event_loop()
@@ -228,6 +230,46 @@ async def get_external_image_data_list(request: Request, body: ListImageHashRequ
         )
      
         
+@router.get("/external-images/list-images-since-cursor",
+            description="List the external images added after the given cursor, in the order they were added. Only the fields needed to locate the image are returned. Pass the returned 'next_cursor' on the next call to get only the new images; leave the cursor empty to start from the first image.",
+            tags=["external-images"],
+            responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def list_external_images_since_cursor(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous call"),
+    limit: int = Query(10000, description="Maximum number of images returned")
+):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+    try:
+        projection = {
+            "uuid": 1,
+            "image_hash": 1,
+            "dataset": 1,
+            "file_path": 1,
+            "upload_date": 1,
+        }
+        image_data_list, next_cursor = list_documents_since_cursor(request.app.external_images_collection, cursor, limit, projection)
+
+        return api_response_handler.create_success_response_v1(
+            response_data={"data": image_data_list, "next_cursor": next_cursor},
+            http_status_code=200
+        )
+
+    except ValueError:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="Invalid cursor",
+            http_status_code=422
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.get("/external-images/get-all-external-image-list", 
             description="Get all external image data. If 'dataset' parameter is set, it only returns images from that dataset, and if the 'size' parameter is set, a random sample of that size will be returned.",
             tags=["external-images"],  
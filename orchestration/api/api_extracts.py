@@ -3,7 +3,7 @@ from fastapi import APIRouter, Request,  Query, HTTPException, status
 from utility.path import separate_bucket_and_file_path
 from .mongo_schemas import ExtractImageData, ListExtractImageData, Dataset, ListExtractImageDataV1, ListDataset , ListExtractImageDataWithScore, ExtractImageDataV1
 from pymongo import ReturnDocument
-from .api_utils import ApiResponseHandlerV1, StandardSuccessResponseV1, ErrorCode, WasPresentResponse, TagCountResponse, get_minio_file_path, get_next_external_dataset_seq_id, update_external_dataset_seq_id, validate_date_format, TagListForImages, TagListForImagesV1,PrettyJSONResponse
+from .api_utils import ApiResponseHandlerV1, StandardSuccessResponseV1, ErrorCode, WasPresentResponse, TagCountResponse, get_minio_file_path, get_next_external_dataset_seq_id, update_external_dataset_seq_id, validate_date_format, TagListForImages, TagListForImagesV1,PrettyJSONResponse, list_documents_since_cursor, set_cursor_seq
 from orchestration.api.mongo_schema.tag_schemas import ListExternalImageTag, ImageTag
 from datetime import datetime
 from typing import Optional
@@ -137,7 +137,8 @@ async def add_extract(request: Request, image_data: ExtractImageData):
                                                     image_data.dataset, 
                                                     'jpg')
             
-            request.app.extracts_collection.insert_one(image_data.to_dict())
+            image_data_dict = set_cursor_seq(request.app.counters_collection, request.app.extracts_collection, image_data.to_dict())
+            request.app.extracts_collection.insert_one(image_data_dict)
         else:
             return api_response_handler.create_error_response_v1(
                 error_code=ErrorCode.INVALID_PARAMS,
@@ -191,6 +192,7 @@ async def add_extract(request: Request, image_data: ExtractImageDataV1):
             image_data_dict['file_path'] = get_minio_file_path(next_seq_id, "extracts", image_data.dataset, 'jpg')
 
             
+            set_cursor_seq(request.app.counters_collection, request.app.extracts_collection, image_data_dict)
             request.app.extracts_collection.insert_one(image_data_dict)
             image_data_dict.pop('_id', None)
             
@@ -215,6 +217,46 @@ async def add_extract(request: Request, image_data: ExtractImageDataV1):
             http_status_code=500
         )      
 
+@router.get("/extracts/list-extracts-since-cursor",
+            description="List the extracted images added after the given cursor, in the order they were added. Only the fields needed to locate the image are returned. Pass the returned 'next_cursor' on the next call to get only the new images; leave the cursor empty to start from the first image.",
+            tags=["extracts"],
+            responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def list_extracts_since_cursor(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous call"),
+    limit: int = Query(10000, description="Maximum number of images returned")
+):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+    try:
+        projection = {
+            "uuid": 1,
+            "image_hash": 1,
+            "dataset": 1,
+            "file_path": 1,
+            "upload_date": 1,
+        }
+        image_data_list, next_cursor = list_documents_since_cursor(request.app.extracts_collection, cursor, limit, projection)
+
+        return api_response_handler.create_success_response_v1(
+            response_data={"data": image_data_list, "next_cursor": next_cursor},
+            http_status_code=200
+        )
+
+    except ValueError:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="Invalid cursor",
+            http_status_code=422
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.get("/extracts/get-all-extracts-list", 
             description="Get all extracted images. If 'dataset' parameter is set, it only returns images from that dataset, and if the 'size' parameter is set, a random sample of that size will be returned.",
             tags=["extracts"],  
@@ -1,13 +1,148 @@
 import bson.int64
+import threading
+from collections import OrderedDict
+from pymongo import UpdateOne, ReturnDocument
 from fastapi import APIRouter, Request, Response
 from .api_utils import PrettyJSONResponse, validate_date_format, ApiResponseHandler, ErrorCode, StandardSuccessResponseV1, ApiResponseHandlerV1, WasPresentResponse
-from .mongo_schemas import ImageHashRequest, ImageHash, ListImageHash, GlobalId
+from .mongo_schemas import ImageHashRequest, ImageHash, ListImageHash, GlobalId, ListImageHashRequest
 from decimal import Decimal
 from typing import List
 from bson.decimal128 import Decimal128
 router = APIRouter()
 
-next_image_global_id = 0
+# image global ids are reserved in contiguous blocks from this counter
+# of the counters collection, it's seeded with the highest id in use on startup
+IMAGE_GLOBAL_ID_COUNTER = "image_global_id"
+# hashes looked up / inserted with one query
+IMAGE_HASHES_BATCH_SIZE = 10000
+# image hash => image global id, the global id of a hash never changes
+# so the cache never needs to be invalidated, 0 disables it
+IMAGE_GLOBAL_ID_CACHE_SIZE = 1000000
+
+image_global_id_cache = OrderedDict()
+image_global_id_cache_lock = threading.Lock()
+
+
+def get_cached_image_global_id(image_hash):
+    with image_global_id_cache_lock:
+        image_global_id = image_global_id_cache.get(image_hash)
+        if image_global_id is not None:
+            image_global_id_cache.move_to_end(image_hash)
+
+        return image_global_id
+
+
+def cache_image_global_ids(image_hash_to_global_id):
+    if IMAGE_GLOBAL_ID_CACHE_SIZE <= 0:
+        return
+
+    with image_global_id_cache_lock:
+        for image_hash, image_global_id in image_hash_to_global_id.items():
+            image_global_id_cache[image_hash] = image_global_id
+            image_global_id_cache.move_to_end(image_hash)
+
+        while len(image_global_id_cache) > IMAGE_GLOBAL_ID_CACHE_SIZE:
+            image_global_id_cache.popitem(last=False)
+
+
+def reserve_image_global_ids(request: Request, count):
+    # atomically reserves count contiguous global ids, returns the first one
+    counter = request.app.counters_collection.find_one_and_update(
+        {"_id": IMAGE_GLOBAL_ID_COUNTER},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+
+    last_image_global_id = int(counter["seq"])
+    request.app.max_image_global_id = max(request.app.max_image_global_id, last_image_global_id)
+
+    return last_image_global_id - count + 1
+
+
+def find_image_global_ids(request: Request, image_hash_list):
+    image_hash_to_global_id = {}
+    cursor = request.app.image_hashes_collection.find(
+        {"image_hash": {"$in": image_hash_list}},
+        {"_id": 0, "image_hash": 1, "image_global_id": 1})
+    for doc in cursor:
+        # with duplicated hashes the lowest id is the one in use
+        image_global_id = int(doc["image_global_id"])
+        previous_global_id = image_hash_to_global_id.get(doc["image_hash"])
+        if previous_global_id is None or image_global_id < previous_global_id:
+            image_hash_to_global_id[doc["image_hash"]] = image_global_id
+
+    return image_hash_to_global_id
+
+
+def get_image_global_id(request: Request, image_hash):
+    # read-through the cache, returns None if the hash is not registered
+    image_global_id = get_cached_image_global_id(image_hash)
+    if image_global_id is not None:
+        return image_global_id
+
+    image_hash_to_global_id = find_image_global_ids(request, [image_hash])
+    cache_image_global_ids(image_hash_to_global_id)
+
+    return image_hash_to_global_id.get(image_hash)
+
+
+def register_image_hashes(request: Request, image_hash_list):
+    # returns image hash => image global id for every hash of the list
+    # the hashes that are not registered get ids from one counter reservation per batch
+    # and are inserted with one unordered bulk write
+    image_hash_list = list(dict.fromkeys(image_hash_list))
+    image_hash_to_global_id = {}
+
+    for start in range(0, len(image_hash_list), IMAGE_HASHES_BATCH_SIZE):
+        batch = image_hash_list[start:start + IMAGE_HASHES_BATCH_SIZE]
+
+        missing_hashes = []
+        for image_hash in batch:
+            image_global_id = get_cached_image_global_id(image_hash)
+            if image_global_id is None:
+                missing_hashes.append(image_hash)
+            else:
+                image_hash_to_global_id[image_hash] = image_global_id
+
+        if len(missing_hashes) == 0:
+            continue
+
+        existing_global_ids = find_image_global_ids(request, missing_hashes)
+        image_hash_to_global_id.update(existing_global_ids)
+        cache_image_global_ids(existing_global_ids)
+
+        new_hashes = [image_hash for image_hash in missing_hashes if image_hash not in existing_global_ids]
+        if len(new_hashes) == 0:
+            continue
+
+        first_image_global_id = reserve_image_global_ids(request, len(new_hashes))
+        operations = []
+        for i, image_hash in enumerate(new_hashes):
+            image_hash_data = ImageHash(image_hash=image_hash, image_global_id=first_image_global_id + i)
+            # a hash registered by another request since the lookup keeps its id
+            operations.append(UpdateOne({"image_hash": image_hash},
+                                        {"$setOnInsert": image_hash_data.to_dict_for_mongodb()},
+                                        upsert=True))
+
+        result = request.app.image_hashes_collection.bulk_write(operations, ordered=False)
+
+        new_global_ids = {}
+        raced_hashes = []
+        for i, image_hash in enumerate(new_hashes):
+            if i in result.upserted_ids:
+                new_global_ids[image_hash] = first_image_global_id + i
+            else:
+                raced_hashes.append(image_hash)
+
+        if len(raced_hashes) > 0:
+            # their reserved ids are left unused
+            new_global_ids.update(find_image_global_ids(request, raced_hashes))
+
+        image_hash_to_global_id.update(new_global_ids)
+        cache_image_global_ids(new_global_ids)
+
+    return image_hash_to_global_id
+
 
 @router.post("/image-hashes/add-image-hash-v1",
              tags=["image-hashes"], 
@@ -23,17 +158,10 @@ async def add_image_hash(request: Request, image_hash_request: ImageHashRequest)
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     
     try:
+        image_hash_to_global_id = register_image_hashes(request, [image_hash_request.image_hash])
         image_hash = ImageHash(
-            image_global_id=request.app.max_image_global_id + 1,
+            image_global_id=image_hash_to_global_id[image_hash_request.image_hash],
             image_hash=image_hash_request.image_hash)
-        
-        existed_image_hash = request.app.image_hashes_collection.find_one({"image_hash": image_hash_request.image_hash})
-        
-        if existed_image_hash is None:
-            request.app.image_hashes_collection.insert_one(image_hash.to_dict_for_mongodb())
-            request.app.max_image_global_id += 1
-        else:
-            image_hash.image_global_id = existed_image_hash["image_global_id"]
 
         return response_handler.create_success_response_v1(
             response_data=image_hash.to_dict(),
@@ -46,6 +174,33 @@ async def add_image_hash(request: Request, image_hash_request: ImageHashRequest)
             error_string=f"Failed to add image hash: {str(e)}",
             http_status_code=500
         )
+
+
+@router.post("/image-hashes/add-image-hashes-bulk",
+             tags=["image-hashes"],
+             description="Registers a list of image hashes, the new hashes get contiguous image global ids. "
+                         "Returns the image global id of every hash of the list, registered before or not",
+             response_model=StandardSuccessResponseV1[ListImageHash],
+             responses=ApiResponseHandlerV1.listErrors([422,500]))
+async def add_image_hashes_bulk(request: Request, image_hash_request: ListImageHashRequest):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    try:
+        image_hash_to_global_id = register_image_hashes(request, image_hash_request.image_hash_list)
+        image_hashes = [ImageHash(image_hash=image_hash, image_global_id=image_global_id).to_dict()
+                        for image_hash, image_global_id in image_hash_to_global_id.items()]
+
+        return response_handler.create_success_response_v1(
+            response_data={"data": image_hashes},
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=f"Failed to add image hashes: {str(e)}",
+            http_status_code=500
+        )
     
 
 @router.get("/image-hashes/update_all_image_hashes",
@@ -62,12 +217,15 @@ async def update_all_image_hashes(request: Request):
         completed_jobs = list(request.app.completed_jobs_collection.find(
             {}, 
             {"task_output_file_dict.output_file_hash": 1, "task_type": 1}))
+        image_hash_list = []
         for job_data in completed_jobs:
             
             if not job_data or 'task_output_file_dict' not in job_data or 'output_file_hash' not in job_data['task_output_file_dict']:
                 continue
 
-            await add_image_hash(request, ImageHashRequest(image_hash=job_data["task_output_file_dict"]['output_file_hash']))
+            image_hash_list.append(job_data["task_output_file_dict"]['output_file_hash'])
+
+        register_image_hashes(request, image_hash_list)
 
         # get image hashes with image_global_id
         image_hashes = list(request.app.image_hashes_collection.find(
@@ -105,12 +263,15 @@ async def update_all_image_hashes_v1(request: Request):
         completed_jobs = list(request.app.completed_jobs_collection.find(
             {}, 
             {"task_output_file_dict.output_file_hash": 1, "task_type": 1}))
+        image_hash_list = []
         for job_data in completed_jobs:
             
             if not job_data or 'task_output_file_dict' not in job_data or 'output_file_hash' not in job_data['task_output_file_dict']:
                 continue
 
-            await add_image_hash(request, ImageHashRequest(image_hash=job_data["task_output_file_dict"]['output_file_hash']))
+            image_hash_list.append(job_data["task_output_file_dict"]['output_file_hash'])
+
+        register_image_hashes(request, image_hash_list)
 
         # get image hashes with image_global_id
         image_hashes = list(request.app.image_hashes_collection.find(
@@ -265,15 +426,13 @@ async def get_image_hash_by_global_id(request: Request, image_hash: str):
 
     try:
         
-        image_hash_data = request.app.image_hashes_collection.find_one({
-            "image_hash": image_hash
-        }, {
-            "image_global_id": 1
-        })
+        image_global_id = get_image_global_id(request, image_hash)
+        if image_global_id is None:
+            raise Exception("image hash {} not found".format(image_hash))
 
         # Return the fetched data with a success response
         return response_handler.create_success_response_v1(
-            response_data=image_hash_data["image_global_id"], 
+            response_data=image_global_id, 
             http_status_code=200
         )
 
@@ -296,15 +455,13 @@ async def get_image_hash_by_global_id_v1(request: Request, image_hash: str):
 
     try:
         
-        image_hash_data = request.app.image_hashes_collection.find_one({
-            "image_hash": image_hash
-        }, {
-            "image_global_id": 1
-        })
+        image_global_id = get_image_global_id(request, image_hash)
+        if image_global_id is None:
+            raise Exception("image hash {} not found".format(image_hash))
 
         # Return the fetched data with a success response
         return response_handler.create_success_response_v1(
-            response_data={"image_global_id": image_hash_data["image_global_id"]}, 
+            response_data={"image_global_id": image_global_id}, 
             http_status_code=200
         )
 
@@ -10,7 +10,8 @@ from utility.minio import cmd
 import uuid
 from datetime import datetime, timedelta
 from orchestration.api.mongo_schemas import KandinskyTask, Task, ListSigmaScoreResponse, ListTask, JobInfoResponse, ListTaskV1
-from orchestration.api.api_dataset import get_sequential_id
+from orchestration.api.api_dataset import get_sequential_id, reserve_sequential_ids
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
 from .api_utils import PrettyJSONResponse, DoneResponse
 from typing import List
@@ -18,7 +19,7 @@ import json
 import paramiko
 from typing import Optional, Dict
 import csv
-from .api_utils import ApiResponseHandler, ErrorCode, StandardSuccessResponse, AddJob, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountLastHour, CountResponse
+from .api_utils import ApiResponseHandler, ErrorCode, StandardSuccessResponse, AddJob, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountLastHour, CountResponse, list_documents_since_cursor, set_cursor_seq
 from pymongo import UpdateMany, ASCENDING, DESCENDING
 from bson import ObjectId
 import time
@@ -520,7 +521,8 @@ def update_job_completed(request: Request, task: Task):
         return False
     
     # add to completed
-    request.app.completed_jobs_collection.insert_one(task.to_dict())
+    completed_job = set_cursor_seq(request.app.counters_collection, request.app.completed_jobs_collection, task.to_dict())
+    request.app.completed_jobs_collection.insert_one(completed_job)
 
     # remove from in progress
     request.app.in_progress_jobs_collection.delete_one({"uuid": task.uuid})
@@ -1118,35 +1120,201 @@ async def get_job(request: Request, task_type=None, model_type="sd_1_5"):
     if model_type:
         base_query["task_type"] = {"$regex": model_type} 
     
-    # Prioritize jobs where task_input_dict.dataset is "variants"
-    priority_query = base_query.copy()
-    priority_query["task_input_dict.dataset"] = {"$in": ["variants", "test-generations"]}
-    
-    job = request.app.pending_jobs_collection.find_one(priority_query, sort=[("task_creation_time", pymongo.ASCENDING)])
-    
-    # If no priority job is found, fallback to the base query
-    if job is None:
-        job = request.app.pending_jobs_collection.find_one(base_query, sort=[("task_creation_time", pymongo.ASCENDING)])
+    # the job is claimed in place before it is moved
+    # so two workers can never claim the same job
+    jobs = claim_pending_jobs(request, base_query, 1, datetime.now().isoformat())
 
-    if job is None:
+    if not jobs:
         return api_response_handler.create_error_response_v1(
             error_code=ErrorCode.ELEMENT_NOT_FOUND,
             error_string="job not found",
             http_status_code=404
         )
 
-    # Proceed with the rest of the endpoint as before
-    request.app.pending_jobs_collection.delete_one({"uuid": job["uuid"]})
-    job.pop('_id', None)
-    job["task_start_time"] = datetime.now().isoformat()
-    request.app.in_progress_jobs_collection.insert_one(job)
-    job = convert_objectid_to_str(job)
+    job = jobs[0]
     
     return api_response_handler.create_success_response_v1(
                 response_data=job,
                 http_status_code=200
             )
-    
+
+
+# datasets whose jobs are claimed first
+PRIORITY_DATASETS = ["variants", "test-generations"]
+
+# default time a worker has to complete a leased job
+# before it goes back to the pending queue
+DEFAULT_JOB_LEASE_SECONDS = 60 * 60
+
+# expired leases are checked at most once per interval
+EXPIRED_LEASES_CHECK_INTERVAL_SECONDS = 60
+last_expired_leases_check_time = 0
+
+# pending jobs being moved to in-progress are marked with the id and time of the claim
+PENDING_CLAIM_ID_FIELD = "claim_id"
+PENDING_CLAIM_TIME_FIELD = "claim_time"
+# a claim still in pending after this long was interrupted
+STALE_CLAIM_SECONDS = 5 * 60
+
+
+def claim_pending_jobs(request: Request, base_query: dict, count: int, task_start_time: str, lease_expiry_time: Optional[str] = None):
+    # moves up to count pending jobs to in-progress
+    # the jobs are first marked with a claim id in pending, the update is atomic per job
+    # so no two callers get the same job, and they are only deleted from pending
+    # once they are in in-progress, so a failed move never loses a job
+    pending_jobs_collection = request.app.pending_jobs_collection
+    in_progress_jobs_collection = request.app.in_progress_jobs_collection
+
+    claim_id = uuid.uuid4().hex
+    claim_time = datetime.now().isoformat()
+
+    unclaimed_query = base_query.copy()
+    unclaimed_query[PENDING_CLAIM_ID_FIELD] = {"$exists": False}
+
+    # Prioritize jobs where task_input_dict.dataset is "variants"
+    priority_query = unclaimed_query.copy()
+    priority_query["task_input_dict.dataset"] = {"$in": PRIORITY_DATASETS}
+
+    num_claimed = 0
+    for query in [priority_query, unclaimed_query]:
+        if num_claimed >= count:
+            break
+
+        candidates = pending_jobs_collection.find(query, {"_id": 1}).sort("task_creation_time", pymongo.ASCENDING).limit(count - num_claimed)
+        candidate_ids = [candidate["_id"] for candidate in candidates]
+        if not candidate_ids:
+            continue
+
+        # candidates claimed by another caller in the meantime are skipped
+        result = pending_jobs_collection.update_many(
+            {"_id": {"$in": candidate_ids}, PENDING_CLAIM_ID_FIELD: {"$exists": False}},
+            {"$set": {PENDING_CLAIM_ID_FIELD: claim_id, PENDING_CLAIM_TIME_FIELD: claim_time}})
+        num_claimed += result.modified_count
+
+    if num_claimed == 0:
+        return []
+
+    jobs = list(pending_jobs_collection.find({PENDING_CLAIM_ID_FIELD: claim_id}).sort("task_creation_time", pymongo.ASCENDING))
+    for job in jobs:
+        job.pop(PENDING_CLAIM_ID_FIELD, None)
+        job.pop(PENDING_CLAIM_TIME_FIELD, None)
+        job["task_start_time"] = task_start_time
+        if lease_expiry_time is not None:
+            job["lease_expiry_time"] = lease_expiry_time
+
+    # the jobs keep their _id, so a partial insert can be undone
+    job_ids = [job["_id"] for job in jobs]
+    try:
+        in_progress_jobs_collection.insert_many(jobs)
+    except Exception:
+        in_progress_jobs_collection.delete_many({"_id": {"$in": job_ids}})
+        pending_jobs_collection.update_many({PENDING_CLAIM_ID_FIELD: claim_id},
+                                            {"$unset": {PENDING_CLAIM_ID_FIELD: "", PENDING_CLAIM_TIME_FIELD: ""}})
+        raise
+
+    pending_jobs_collection.delete_many({PENDING_CLAIM_ID_FIELD: claim_id})
+
+    for job in jobs:
+        job.pop('_id', None)
+
+    return jobs
+
+
+def release_stale_claims(request: Request):
+    # a claim still in pending after STALE_CLAIM_SECONDS was interrupted
+    # the jobs that got to in-progress are deleted from pending, the others are released
+    stale_time = (datetime.now() - timedelta(seconds=STALE_CLAIM_SECONDS)).isoformat()
+    stale_ids = [job["_id"] for job in request.app.pending_jobs_collection.find({PENDING_CLAIM_TIME_FIELD: {"$lt": stale_time}}, {"_id": 1})]
+    if not stale_ids:
+        return 0
+
+    moved_ids = [job["_id"] for job in request.app.in_progress_jobs_collection.find({"_id": {"$in": stale_ids}}, {"_id": 1})]
+    if moved_ids:
+        request.app.pending_jobs_collection.delete_many({"_id": {"$in": moved_ids}})
+
+    result = request.app.pending_jobs_collection.update_many(
+        {"_id": {"$in": stale_ids}, PENDING_CLAIM_TIME_FIELD: {"$lt": stale_time}},
+        {"$unset": {PENDING_CLAIM_ID_FIELD: "", PENDING_CLAIM_TIME_FIELD: ""}})
+
+    print(f"{len(moved_ids)} interrupted claims removed from pending, {result.modified_count} released")
+
+    return result.modified_count
+
+
+def requeue_expired_leases(request: Request):
+    # moves the in-progress jobs whose lease expired back to pending
+    # so the jobs of a dead worker are done by another one
+    global last_expired_leases_check_time
+
+    now = time.time()
+    if now - last_expired_leases_check_time < EXPIRED_LEASES_CHECK_INTERVAL_SECONDS:
+        return 0
+    last_expired_leases_check_time = now
+
+    release_stale_claims(request)
+
+    expired_query = {"lease_expiry_time": {"$lt": datetime.now().isoformat()}}
+    expired_jobs = list(request.app.in_progress_jobs_collection.find(expired_query))
+    if not expired_jobs:
+        return 0
+
+    for job in expired_jobs:
+        job.pop('lease_expiry_time', None)
+        job["task_start_time"] = None
+
+    # the jobs are written to pending before they are deleted from in-progress
+    # keyed on their _id, so a requeue interrupted in between is redone without duplicates
+    request.app.pending_jobs_collection.bulk_write(
+        [ReplaceOne({"_id": job["_id"]}, job, upsert=True) for job in expired_jobs], ordered=False)
+
+    expired_query["_id"] = {"$in": [job["_id"] for job in expired_jobs]}
+    request.app.in_progress_jobs_collection.delete_many(expired_query)
+
+    num_requeued = len(expired_jobs)
+    print(f"{num_requeued} jobs with expired lease moved back to pending")
+
+    return num_requeued
+
+
+@router.get("/queue/image-generation/lease-jobs",
+            status_code=200,
+            tags=["jobs-standardized"],
+            description="Moves up to 'count' pending jobs to in-progress in one call. Each job is claimed atomically in pending before it is moved, so no two workers get the same job. If a leased job is not completed or failed within 'lease_seconds', it goes back to the pending queue.",
+            response_model=StandardSuccessResponseV1[ListTask],
+            responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def lease_jobs(request: Request,
+                     task_type: Optional[str] = None,
+                     model_type: Optional[str] = "sd_1_5",
+                     count: int = Query(1, ge=1, le=1000, description="Maximum number of jobs to lease"),
+                     lease_seconds: int = Query(DEFAULT_JOB_LEASE_SECONDS, ge=1, description="Time to complete the jobs before they go back to pending")):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    try:
+        requeue_expired_leases(request)
+
+        base_query = {}
+        if task_type:
+            base_query["task_type"] = task_type
+        if model_type:
+            base_query["task_type"] = {"$regex": model_type}
+
+        start_time = datetime.now()
+        lease_expiry_time = (start_time + timedelta(seconds=lease_seconds)).isoformat()
+
+        jobs = claim_pending_jobs(request, base_query, count, start_time.isoformat(), lease_expiry_time)
+
+        return api_response_handler.create_success_response_v1(
+            response_data={"jobs": jobs},
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
 
 @router.post("/queue/image-generation/add-job",
     description="Adds an image generation job to the pending queue. If no UUID is provided, an UUID is generated automatically. If no file path is provided, or the provided file path is \"\", '[auto]' or '[default]', the file path is generated automatically.",
@@ -1240,23 +1408,8 @@ async def add_job(request: Request, kandinsky_task: KandinskyTask):
             task.task_input_dict["file_path"] = new_file_path
         
         # upload input image embeddings to minIO
-        image_embedding_data={
-            "job_uuid": task.uuid,
-            "dataset": task.task_input_dict["dataset"],
-            "image_embedding": kandinsky_task.positive_embedding,
-            "negative_image_embedding": kandinsky_task.negative_embedding
-        }
-        
-        output_file_path = os.path.join(task.task_input_dict["dataset"], task.task_input_dict['file_path'])
-        image_embeddings_path = output_file_path.replace(".jpg", "_embedding.msgpack")
-
-        msgpack_string = msgpack.packb(image_embedding_data, default=encode_ndarray, use_bin_type=True, use_single_float=True)
-
-        buffer = io.BytesIO()
-        buffer.write(msgpack_string)
-        buffer.seek(0)
-
-        cmd.upload_data(request.app.minio_client, "datasets", image_embeddings_path, buffer) 
+        upload_kandinsky_job_embedding(request.app.minio_client, task, kandinsky_task.positive_embedding,
+                                       kandinsky_task.negative_embedding)
 
         request.app.pending_jobs_collection.insert_one(task.to_dict())
 
@@ -1275,6 +1428,149 @@ async def add_job(request: Request, kandinsky_task: KandinskyTask):
             http_status_code=500
         )
  
+def assign_job_file_paths(request: Request, task_list: List[Task]):
+    # the tasks without file path get one from their dataset
+    # the ids of each dataset are reserved in one counter update
+    tasks_per_dataset = {}
+    for task in task_list:
+        if task.task_input_dict is None or "dataset" not in task.task_input_dict:
+            continue
+
+        if "file_path" not in task.task_input_dict or task.task_input_dict["file_path"] in ['', "[auto]", "[default]"]:
+            tasks_per_dataset.setdefault(task.task_input_dict["dataset"], []).append(task)
+
+    for dataset_name, dataset_task_list in tasks_per_dataset.items():
+        sequential_id_arr = reserve_sequential_ids(request, dataset_name, len(dataset_task_list))
+        for task, sequential_id in zip(dataset_task_list, sequential_id_arr):
+            task.task_input_dict["file_path"] = "{}.jpg".format(sequential_id)
+
+
+def upload_kandinsky_job_embedding(minio_client, task: Task, positive_embedding, negative_embedding):
+    image_embedding_data={
+        "job_uuid": task.uuid,
+        "dataset": task.task_input_dict["dataset"],
+        "image_embedding": positive_embedding,
+        "negative_image_embedding": negative_embedding
+    }
+
+    output_file_path = os.path.join(task.task_input_dict["dataset"], task.task_input_dict['file_path'])
+    image_embeddings_path = output_file_path.replace(".jpg", "_embedding.msgpack")
+
+    msgpack_string = msgpack.packb(image_embedding_data, default=encode_ndarray, use_bin_type=True, use_single_float=True)
+
+    buffer = io.BytesIO()
+    buffer.write(msgpack_string)
+    buffer.seek(0)
+
+    cmd.upload_data(minio_client, "datasets", image_embeddings_path, buffer)
+
+
+# number of concurrent embedding uploads of a bulk kandinsky add
+KANDINSKY_EMBEDDING_UPLOAD_WORKERS = 16
+
+
+@router.post("/queue/image-generation/add-jobs",
+    description="Adds a list of image generation jobs to the pending queue in one request. Each job follows the rules of /queue/image-generation/add-job: if no UUID is provided, an UUID is generated, and if no file path is provided, or the provided file path is \"\", '[auto]' or '[default]', the file path is generated automatically. The sequential ids of each dataset are reserved in one block.",
+    status_code=200,
+    tags=["jobs-standardized"],
+    response_model=StandardSuccessResponseV1[List[AddJob]],
+    responses=ApiResponseHandlerV1.listErrors([422, 500]),
+)
+async def add_jobs(request: Request, task_list: List[Task]):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+    try:
+        creation_time = datetime.now()
+
+        for task in task_list:
+            if task.uuid in ["", None]:
+                task.uuid = str(uuid.uuid4())
+
+            task.task_creation_time = creation_time
+
+            requires_dataset = task.task_input_dict is None or (
+                "file_path" not in task.task_input_dict or task.task_input_dict["file_path"] in ['', "[auto]", "[default]"]
+            )
+
+            if requires_dataset and (task.task_input_dict is None or "dataset" not in task.task_input_dict):
+                return api_response_handler.create_error_response_v1(
+                    error_code=ErrorCode.INVALID_PARAMS,
+                    error_string="Dataset name is required when file_path is blank or set to '[auto]' or '[default]'.",
+                    http_status_code=422,
+                )
+
+        assign_job_file_paths(request, task_list)
+
+        if task_list:
+            request.app.pending_jobs_collection.insert_many([task.dict() for task in task_list], ordered=False)
+
+        creation_time_iso = creation_time.isoformat()
+        return api_response_handler.create_success_response_v1(
+            response_data=[{"uuid": task.uuid, "creation_time": creation_time_iso} for task in task_list],
+            http_status_code=200,
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500,
+        )
+
+
+@router.post("/queue/image-generation/add-kandinsky-jobs",
+             description="Adds a list of kandinsky jobs to the pending queue in one request. Each job follows the rules of /queue/image-generation/add-kandinsky-job. The sequential ids of each dataset are reserved in one block and the embeddings are uploaded concurrently.",
+             status_code=200,
+             tags=["jobs-standardized"],
+             response_model=StandardSuccessResponseV1[List[AddJob]],
+             responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def add_kandinsky_jobs(request: Request, kandinsky_task_list: List[KandinskyTask]):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+    try:
+        creation_time = datetime.now()
+
+        task_list = []
+        for kandinsky_task in kandinsky_task_list:
+            task = kandinsky_task.job
+
+            if task.task_input_dict is None or not task.task_input_dict.get("dataset"):
+                return api_response_handler.create_error_response_v1(
+                    error_code=ErrorCode.INVALID_PARAMS,
+                    error_string="The 'dataset' field is required and cannot be empty.",
+                    http_status_code=422,
+                )
+
+            if task.uuid in ["", None]:
+                task.uuid = str(uuid.uuid4())
+
+            task.task_creation_time = creation_time
+            task_list.append(task)
+
+        assign_job_file_paths(request, task_list)
+
+        # upload input image embeddings to minIO
+        with ThreadPoolExecutor(max_workers=KANDINSKY_EMBEDDING_UPLOAD_WORKERS) as executor:
+            futures = [executor.submit(upload_kandinsky_job_embedding, request.app.minio_client, kandinsky_task.job,
+                                       kandinsky_task.positive_embedding, kandinsky_task.negative_embedding)
+                       for kandinsky_task in kandinsky_task_list]
+            for future in futures:
+                future.result()
+
+        if task_list:
+            request.app.pending_jobs_collection.insert_many([task.to_dict() for task in task_list], ordered=False)
+
+        creation_time_iso = creation_time.isoformat()
+        return api_response_handler.create_success_response_v1(
+            response_data=[{"uuid": task.uuid, "creation_time": creation_time_iso} for task in task_list],
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
 @router.get("/queue/image-generation/get-jobs-count-last-n-hours-v1",
             tags=["jobs-standardized"],
             response_model=StandardSuccessResponseV1[CountLastHour],
@@ -1397,6 +1693,49 @@ async def get_list_completed_jobs(
 
     return response_handler.create_success_response_v1(response_data={"jobs": jobs}, http_status_code=200)
 
+@router.get("/queue/image-generation/list-completed-jobs-since-cursor",
+            status_code=200,
+            tags=["jobs-standardized"],
+            description="List the completed jobs added after the given cursor, in the order they were completed. Only the fields needed to locate the job image are returned. Pass the returned 'next_cursor' on the next call to get only the new jobs; leave the cursor empty to start from the first job.",
+            responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def list_completed_jobs_since_cursor(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous call"),
+    limit: int = Query(10000, description="Maximum number of jobs returned")
+):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    try:
+        projection = {
+            "uuid": 1,
+            "task_type": 1,
+            "task_creation_time": 1,
+            "task_input_dict.dataset": 1,
+            "task_input_dict.file_path": 1,
+            "task_output_file_dict.output_file_path": 1,
+            "task_output_file_dict.output_file_hash": 1,
+        }
+        jobs, next_cursor = list_documents_since_cursor(request.app.completed_jobs_collection, cursor, limit, projection)
+
+        return response_handler.create_success_response_v1(
+            response_data={"jobs": jobs, "next_cursor": next_cursor},
+            http_status_code=200
+        )
+
+    except ValueError:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="Invalid cursor",
+            http_status_code=422
+        )
+
+    except Exception as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
 @router.get("/queue/image-generation/list-failed-jobs", 
             response_model=StandardSuccessResponseV1[ListTask],
             status_code = 200,
@@ -1622,6 +1961,8 @@ async def update_job_completed(request: Request, uuid: str):
             )
         
         # Move the job to the completed jobs collection
+        # the job keeps its _id, the cursor feed lists it by its completion order
+        set_cursor_seq(request.app.counters_collection, request.app.completed_jobs_collection, job)
         request.app.completed_jobs_collection.insert_one(job)
         # Remove the job from the in-progress collection
         request.app.in_progress_jobs_collection.delete_one({"uuid": uuid})
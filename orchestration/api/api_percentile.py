@@ -1,6 +1,7 @@
 from fastapi import Request, APIRouter, HTTPException
+from pymongo import UpdateOne
 from orchestration.api.mongo_schemas import RankingPercentile, ResponseRankingPercentile
-from .api_utils import PrettyJSONResponse, validate_date_format, ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1
+from .api_utils import PrettyJSONResponse, validate_date_format, ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, BulkWriteResponse, bulk_upsert_ndjson_body
 from typing import List
 
 router = APIRouter()
@@ -102,6 +103,36 @@ def set_image_rank_percentile(request: Request, ranking_percentile: RankingPerce
         return response_handler.create_error_response_v1(error_code=ErrorCode.OTHER_ERROR, error_string="Internal Server Error", http_status_code=500)
 
 
+def get_percentile_update_operation(item: dict):
+    try:
+        ranking_percentile = RankingPercentile(**item)
+    except (ValueError, TypeError):
+        return None
+
+    query = {"image_hash": ranking_percentile.image_hash, "model_id": ranking_percentile.model_id}
+    return UpdateOne(query, {"$set": ranking_percentile.to_dict()}, upsert=True)
+
+
+@router.post("/image-scores/percentiles/set-image-rank-percentiles-bulk",
+             status_code=200,
+             description="Sets the rank percentiles of many images. The body is newline delimited json, one RankingPercentile per line. "
+                         "Existing percentiles of the same image/model combination are replaced",
+             tags=["image scores"],
+             response_model=StandardSuccessResponseV1[BulkWriteResponse],
+             responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def set_image_rank_percentiles_bulk(request: Request):
+    # the body is a stream, it can't be read by createInstance
+    response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+    try:
+        counts = await bulk_upsert_ndjson_body(request,
+                                               request.app.image_percentiles_collection,
+                                               get_percentile_update_operation)
+
+        return response_handler.create_success_response_v1(response_data=counts, http_status_code=200)
+    except Exception as e:
+        return response_handler.create_error_response_v1(error_code=ErrorCode.OTHER_ERROR, error_string=str(e), http_status_code=500)
+
+
 @router.get("/image-scores/percentiles/get-image-rank-percentile", 
              status_code=200,
              description="Get image rank percentile by hash",
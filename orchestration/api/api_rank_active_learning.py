@@ -316,6 +316,28 @@ async def random_queue_pair(request: Request, rank_model_id : Optional[int] = No
             http_status_code=500
         )
 
+# rank_model_id => (classifier_id, time it was fetched)
+# ranks are rarely updated, so the classifier of a rank
+# is cached for a few minutes instead of being fetched on every pair request
+RANK_CLASSIFIER_ID_CACHE_TTL_SECONDS = 300
+rank_classifier_id_cache = {}
+
+
+def get_rank_classifier_id(request: Request, rank_model_id: int):
+    cached = rank_classifier_id_cache.get(rank_model_id)
+    if cached is not None and time.time() - cached[1] < RANK_CLASSIFIER_ID_CACHE_TTL_SECONDS:
+        return cached[0]
+
+    classifier_id = None
+    rank = request.app.rank_model_models_collection.find_one({'rank_model_id': rank_model_id}, {'classifier_id': 1})
+    if rank:
+        classifier_id = rank.get("classifier_id")
+
+    rank_classifier_id_cache[rank_model_id] = (classifier_id, time.time())
+
+    return classifier_id
+
+
 @router.get("/rank-active-learning-queue/get-random-image-pair-v1", 
             description="Gets random image pairs from the rank active learning queue, It returns the classifier score of each image as a number or null (if no score is found for the image",
             response_model=StandardSuccessResponseV1[ListRankActiveLearningPairWithScore],
@@ -353,29 +375,32 @@ async def random_queue_pair(request: Request, rank_model_id: Optional[int] = Non
         # Fetch classifier_id from rank_model_id
         classifier_id = None
         if rank_model_id is not None:
-            rank = request.app.rank_model_models_collection.find_one({'rank_model_id': rank_model_id})
-            if rank:
-                classifier_id = rank.get("classifier_id")
+            classifier_id = get_rank_classifier_id(request, rank_model_id)
 
+        # Fetch the scores of all the images with one query
+        score_dict = {}
         if classifier_id is not None:
+            job_uuid_list = []
             for pair in random_pairs:
                 images_data = pair['images_data']
                 if len(images_data) == 2:
-                    job_uuid_1 = images_data[0].get('job_uuid_1')
-                    job_uuid_2 = images_data[1].get('job_uuid_2')
-                    score_1 = request.app.image_classifier_scores_collection.find_one(
-                        {'classifier_id': classifier_id, 'job_uuid': job_uuid_1}, {'score': 1, '_id': 0}
-                    )
-                    score_2 = request.app.image_classifier_scores_collection.find_one(
-                        {'classifier_id': classifier_id, 'job_uuid': job_uuid_2}, {'score': 1, '_id': 0}
-                    )
-                    pair['score_1'] = score_1['score'] if score_1 else None
-                    pair['score_2'] = score_2['score'] if score_2 else None
-                else:
-                    pair['score_1'] = None
-                    pair['score_2'] = None
-        else:
-            for pair in random_pairs:
+                    job_uuid_list.append(images_data[0].get('job_uuid_1'))
+                    job_uuid_list.append(images_data[1].get('job_uuid_2'))
+
+            if job_uuid_list:
+                scores_cursor = request.app.image_classifier_scores_collection.find(
+                    {'classifier_id': classifier_id, 'uuid': {'$in': list(set(job_uuid_list))}},
+                    {'uuid': 1, 'score': 1, '_id': 0}
+                )
+                for score in scores_cursor:
+                    score_dict[score['uuid']] = score['score']
+
+        for pair in random_pairs:
+            images_data = pair['images_data']
+            if len(images_data) == 2:
+                pair['score_1'] = score_dict.get(images_data[0].get('job_uuid_1'))
+                pair['score_2'] = score_dict.get(images_data[1].get('job_uuid_2'))
+            else:
                 pair['score_1'] = None
                 pair['score_2'] = None
 
@@ -3,8 +3,8 @@ from fastapi import Request, APIRouter, HTTPException, Query
 from typing import Optional
 
 from pymongo import UpdateOne
-from orchestration.api.mongo_schemas import RankingScore, ResponseRankingScore, ListRankingScore
-from .api_utils import ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1
+from orchestration.api.mongo_schemas import RankingScore, ResponseRankingScore, ListRankingScore, RankingScoreBulkItem
+from .api_utils import ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, BulkWriteResponse, bulk_upsert_ndjson_body
 
 router = APIRouter()
 
@@ -191,6 +191,53 @@ async def set_image_rank_score_batch(
         )
 
 
+def get_rank_score_update_operation(item: dict):
+    try:
+        ranking_score = RankingScoreBulkItem(**item)
+    except (ValueError, TypeError):
+        return None
+
+    # same key as /image-scores/scores/set-rank-score-batch
+    query = {
+        "uuid": ranking_score.uuid,
+        "image_hash": ranking_score.image_hash,
+        "rank_model_id": ranking_score.rank_model_id
+    }
+
+    new_score_data = ranking_score.to_dict()
+    new_score_data["creation_time"] = datetime.utcnow().isoformat()
+
+    return UpdateOne(query, {"$set": new_score_data}, upsert=True)
+
+
+@router.post("/image-scores/scores/set-rank-scores-bulk",
+             status_code=200,
+             response_model=StandardSuccessResponseV1[BulkWriteResponse],
+             description="Set rank image scores in bulk. The body is newline delimited json, one RankingScoreBulkItem per line",
+             tags=["image scores"],
+             responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def set_image_rank_scores_bulk(request: Request):
+    # the body is a stream, it can't be read by createInstance
+    api_response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+
+    try:
+        counts = await bulk_upsert_ndjson_body(request,
+                                               request.app.image_rank_scores_collection,
+                                               get_rank_score_update_operation)
+
+        return api_response_handler.create_success_response_v1(
+            response_data=counts,
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.get("/image-scores/scores/get-image-rank-score", 
             description="Get image rank score by hash",
             status_code=200,
@@ -1,6 +1,7 @@
 from fastapi import Request, APIRouter, HTTPException
+from pymongo import UpdateOne
 from orchestration.api.mongo_schemas import RankingSigmaScore, ResponseRankingSigmaScore
-from .api_utils import PrettyJSONResponse, ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1
+from .api_utils import PrettyJSONResponse, ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, BulkWriteResponse, bulk_upsert_ndjson_body
 from typing import List
 
 router = APIRouter()
@@ -97,6 +98,36 @@ def set_image_rank_sigma_score(request: Request, ranking_sigma_score: RankingSig
     return response_handler.create_success_response_v1(response_data=ranking_sigma_score.dict(), http_status_code=201)
 
 
+def get_sigma_score_update_operation(item: dict):
+    try:
+        ranking_sigma_score = RankingSigmaScore(**item)
+    except (ValueError, TypeError):
+        return None
+
+    query = {"image_hash": ranking_sigma_score.image_hash, "model_id": ranking_sigma_score.model_id}
+    return UpdateOne(query, {"$set": ranking_sigma_score.to_dict()}, upsert=True)
+
+
+@router.post("/image-scores/sigma-scores/set-image-rank-sigma-scores-bulk",
+             status_code=200,
+             description="Sets the rank sigma_scores of many images. The body is newline delimited json, one RankingSigmaScore per line. "
+                         "Existing sigma_scores of the same image/model combination are replaced",
+             tags=["image scores"],
+             response_model=StandardSuccessResponseV1[BulkWriteResponse],
+             responses=ApiResponseHandlerV1.listErrors([422, 500]))
+async def set_image_rank_sigma_scores_bulk(request: Request):
+    # the body is a stream, it can't be read by createInstance
+    response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+    try:
+        counts = await bulk_upsert_ndjson_body(request,
+                                               request.app.image_sigma_scores_collection,
+                                               get_sigma_score_update_operation)
+
+        return response_handler.create_success_response_v1(response_data=counts, http_status_code=200)
+    except Exception as e:
+        return response_handler.create_error_response_v1(error_code=ErrorCode.OTHER_ERROR, error_string=str(e), http_status_code=500)
+
+
 @router.get("/image-scores/sigma-scores/get-image-rank-sigma-score", 
             status_code=200,
             description="Get image rank sigma_score by hash",
@@ -13,6 +13,8 @@ from orchestration.api.mongo_schema.pseudo_tag_schemas import ImagePseudoTag
 from orchestration.api.mongo_schemas import VideoMetaData
 from datetime import datetime
 from minio import Minio
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
 from dateutil import parser
 from datetime import datetime
 import os
@@ -211,6 +213,12 @@ class RankCountResponse(BaseModel):
 class CountResponse(BaseModel):
     count: int
 
+class BulkWriteResponse(BaseModel):
+    received: int
+    invalid: int
+    upserted: int
+    modified: int
+
 class RechableResponse(BaseModel):
     reachable: bool
 
@@ -510,6 +518,9 @@ class ApiResponseHandlerV1:
 
             
 
+# max number of operations sent in one bulk_write by the bulk endpoints
+BULK_WRITE_BATCH_SIZE = 10000
+
 def find_or_create_next_folder_and_index(client: Minio, bucket: str, base_folder: str) -> (str, int):
     """
     Finds the next folder for storing an image, creating a new one if the last is full,
@@ -634,6 +645,162 @@ def build_date_query(date_from: Optional[Union[str, datetime]] = None,
     
     return {key: date_range_query} if date_range_query else {}
 
+async def iterate_ndjson_body(request: Request):
+    """
+    Yields the json objects of a newline delimited json body, one per line.
+
+    The body is read as a stream, so the bulk endpoints never hold the whole upload in memory.
+    Lines that are not valid json are yielded as None.
+    """
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield parse_ndjson_line(line)
+
+    if buffer.strip():
+        yield parse_ndjson_line(buffer)
+
+def parse_ndjson_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+async def bulk_upsert_ndjson_body(request: Request, collection, get_update_operation, batch_size: int = BULK_WRITE_BATCH_SIZE) -> dict:
+    """
+    Upserts the json objects of a newline delimited json body into a collection.
+
+    get_update_operation turns one object into a pymongo UpdateOne, or returns None if the object is invalid.
+    The operations are sent with unordered bulk_write calls of batch_size operations.
+    Returns the counts of the BulkWriteResponse.
+    """
+    counts = {"received": 0, "invalid": 0, "upserted": 0, "modified": 0}
+    bulk_operations = []
+
+    def write_bulk_operations():
+        result = collection.bulk_write(bulk_operations, ordered=False)
+        counts["upserted"] += result.upserted_count
+        counts["modified"] += result.modified_count
+        bulk_operations.clear()
+
+    async for item in iterate_ndjson_body(request):
+        counts["received"] += 1
+        update_operation = get_update_operation(item) if isinstance(item, dict) else None
+        if update_operation is None:
+            counts["invalid"] += 1
+            continue
+
+        bulk_operations.append(update_operation)
+        if len(bulk_operations) >= batch_size:
+            write_bulk_operations()
+
+    if bulk_operations:
+        write_bulk_operations()
+
+    return counts
+
+# documents listed with list_documents_since_cursor get a sequence number from the
+# "<collection name>_cursor_seq" counter when they're inserted, and the time it was reserved
+CURSOR_SEQ_FIELD = "cursor_seq"
+CURSOR_TIME_FIELD = "cursor_time"
+# a missing sequence number is waited for this long, its insert may still be in flight
+CURSOR_SETTLE_SECONDS = 60
+CURSOR_BACKFILL_BATCH_SIZE = 10000
+
+def get_cursor_counter_id(collection):
+    return "{}_cursor_seq".format(collection.name)
+
+def reserve_cursor_seqs(counters_collection, collection, count: int) -> int:
+    """
+    Atomically reserves count contiguous sequence numbers of the collection, returns the first one.
+    """
+    counter = counters_collection.find_one_and_update(
+        {"_id": get_cursor_counter_id(collection)},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+
+    return int(counter["seq"]) - count + 1
+
+def set_cursor_seq(counters_collection, collection, document: dict) -> dict:
+    """
+    Sets the sequence number of a document that is about to be inserted in the collection.
+    """
+    document[CURSOR_SEQ_FIELD] = reserve_cursor_seqs(counters_collection, collection, 1)
+    document[CURSOR_TIME_FIELD] = time.time()
+
+    return document
+
+def backfill_cursor_seqs(counters_collection, collection, batch_size: int = CURSOR_BACKFILL_BATCH_SIZE) -> int:
+    """
+    Gives a sequence number to the documents of the collection that don't have one yet, in _id order.
+
+    Called on startup, only the documents inserted before the sequence numbers existed are updated.
+    Returns the number of updated documents.
+    """
+    num_updated = 0
+    while True:
+        documents = list(collection.find({CURSOR_SEQ_FIELD: {"$exists": False}}, {"_id": 1})
+                         .sort("_id", 1)
+                         .limit(batch_size))
+        if not documents:
+            break
+
+        first_seq = reserve_cursor_seqs(counters_collection, collection, len(documents))
+        # the filter keeps the seq of a document another worker updated first
+        update_operations = [UpdateOne({"_id": document["_id"], CURSOR_SEQ_FIELD: {"$exists": False}},
+                                       {"$set": {CURSOR_SEQ_FIELD: first_seq + i,
+                                                 CURSOR_TIME_FIELD: document["_id"].generation_time.timestamp()}})
+                             for i, document in enumerate(documents)]
+        result = collection.bulk_write(update_operations, ordered=False)
+        num_updated += result.modified_count
+
+    return num_updated
+
+def list_documents_since_cursor(collection, cursor: Optional[str], limit: int, projection: Optional[dict] = None):
+    """
+    Returns the documents whose sequence number is after the cursor, in sequence order, and the cursor of the last one.
+
+    The cursor is the sequence number of the last returned document (see set_cursor_seq),
+    the numbers are given when the documents are inserted in the collection,
+    so documents moved into the collection later than others (completed jobs) come after them
+    whatever their _id, and a client that keeps the last cursor receives every document once.
+
+    The numbers are reserved before the insert, so a number can be missing while its insert is in flight:
+    the listing stops before a missing number until the document after it is CURSOR_SETTLE_SECONDS old,
+    numbers of inserts that failed are skipped after that.
+    Raises ValueError if the cursor is not a sequence number.
+    """
+    last_seq = int(cursor) if cursor else 0
+
+    if projection is not None:
+        projection = dict(projection)
+        projection[CURSOR_SEQ_FIELD] = 1
+        projection[CURSOR_TIME_FIELD] = 1
+
+    candidates = collection.find({CURSOR_SEQ_FIELD: {"$gt": last_seq}}, projection).sort(CURSOR_SEQ_FIELD, 1).limit(limit)
+
+    settled_time = time.time() - CURSOR_SETTLE_SECONDS
+    documents = []
+    for document in candidates:
+        seq = document[CURSOR_SEQ_FIELD]
+        if seq != last_seq + 1 and document.get(CURSOR_TIME_FIELD, 0) > settled_time:
+            break
+
+        last_seq = seq
+        document.pop("_id", None)
+        document.pop(CURSOR_SEQ_FIELD, None)
+        document.pop(CURSOR_TIME_FIELD, None)
+        documents.append(document)
+
+    next_cursor = str(last_seq) if documents else cursor
+
+    return documents, next_cursor
+
 def old_date_for_migrations_to_unix_int32(dt_str):
     if 'T' not in dt_str and ' ' not in dt_str:
         dt_str += "T00:00:00.000"
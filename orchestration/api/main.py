@@ -4,7 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import pymongo
 from bson.objectid import ObjectId
 from fastapi.responses import JSONResponse
-from .api_utils import ApiResponseHandlerV1, PrettyJSONResponse, ApiResponseHandler, ErrorCode,  StandardErrorResponseV1, StandardSuccessResponse
+from .api_utils import ApiResponseHandlerV1, PrettyJSONResponse, ApiResponseHandler, ErrorCode,  StandardErrorResponseV1, StandardSuccessResponse, CURSOR_SEQ_FIELD, backfill_cursor_seqs
 from fastapi.exceptions import RequestValidationError
 from fastapi import status, Request
 from dotenv import dotenv_values
@@ -196,6 +196,21 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.pending_jobs_collection ,pending_jobs_task_type_and_dataset_index, 'pending_jobs_task_type_and_dataset_index')
 
+    pending_jobs_claim_id_index=[
+    ("claim_id", pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.pending_jobs_collection ,pending_jobs_claim_id_index, 'pending_jobs_claim_id_index')
+
+    pending_jobs_claim_time_index=[
+    ("claim_time", pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.pending_jobs_collection ,pending_jobs_claim_time_index, 'pending_jobs_claim_time_index')
+
+    in_progress_jobs_lease_expiry_time_index=[
+    ("lease_expiry_time", pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.in_progress_jobs_collection ,in_progress_jobs_lease_expiry_time_index, 'in_progress_jobs_lease_expiry_time_index')
+
     completed_jobs_uuid_index=[
     ('uuid', pymongo.ASCENDING)
     ]
@@ -377,6 +392,20 @@ def startup_db_client():
     else:
         app.max_image_global_id = 0
 
+    # new image global ids are reserved from the image_global_id counter
+    # $max so the counter never goes back when it's already ahead of the collection
+    app.counters_collection.update_one({"_id": "image_global_id"},
+                                       {"$max": {"seq": app.max_image_global_id}},
+                                       upsert=True)
+
+    # sequence numbers of the list-*-since-cursor feeds, the documents added
+    # before the feeds paged on them get theirs once, in _id order
+    for cursor_collection in [app.completed_jobs_collection, app.external_images_collection, app.extracts_collection]:
+        create_index_if_not_exists(cursor_collection, [(CURSOR_SEQ_FIELD, pymongo.ASCENDING)], '{}_cursor_seq_index'.format(cursor_collection.name))
+        num_backfilled = backfill_cursor_seqs(app.counters_collection, cursor_collection)
+        if num_backfilled > 0:
+            print("Set the cursor sequence numbers of {} documents of {}".format(num_backfilled, cursor_collection.name))
+
     # classifier scores classifier_id, tag_id, image_hash
     classifier_image_hash_index=[
     ('image_hash', pymongo.ASCENDING),
@@ -420,6 +449,13 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.image_classifier_scores_collection , classifier_image_uuid_index, 'classifier_image_uuid_index')
 
+    # classifier score of a job, used by the rank active learning pair sampler
+    classifier_image_classifier_uuid_index=[
+    ('classifier_id', pymongo.ASCENDING),
+    ('uuid', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_classifier_scores_collection , classifier_image_classifier_uuid_index, 'classifier_image_classifier_uuid_index')
+
     classifier_task_score_index = [
     ('classifier_id', pymongo.ASCENDING),
     ('task_type', pymongo.ASCENDING),
@@ -311,6 +311,26 @@ class ResponseRankingScore(BaseModel):
 class ListRankingScore(BaseModel):
     scores: List[ResponseRankingScore]  
 
+class RankingScoreBulkItem(BaseModel):
+    rank_model_id: int
+    rank_id: int
+    uuid: str
+    image_hash: str
+    score: float
+    sigma_score: float
+    image_source: str = "generated_image"
+
+    def to_dict(self):
+        return {
+            "uuid": self.uuid,
+            "rank_model_id": self.rank_model_id,
+            "rank_id": self.rank_id,
+            "score": self.score,
+            "sigma_score": self.sigma_score,
+            "image_hash": self.image_hash,
+            "image_source": self.image_source
+        }
+
 class ClassifierScore(BaseModel):
     uuid: Union[str, None]
     classifier_id: int
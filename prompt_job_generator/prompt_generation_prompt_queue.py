@@ -4,6 +4,7 @@ import math
 import random
 import threading
 import time
+import torch
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
@@ -253,32 +254,34 @@ class PromptGenerationPromptQueue:
             if scoring_model != None:
                 print(scoring_model.model_type)
             print('---------------')
-        for prompt in prompts:
+        # the prompts that fit in the clip model are scored, in batches
+        prompt_scores = [0] * len(prompts)
+        scored_indices = []
+        if scoring_model is not None and clip_text_embedder is not None:
+            text_embedding_cache = prompt_job_generator_state.text_embedding_cache
+            for i, prompt in enumerate(prompts):
+                positive_prompt_length = clip_text_embedder.compute_token_length(prompt.positive_prompt)
+                negative_prompt_length = clip_text_embedder.compute_token_length(prompt.negative_prompt)
 
-            positive_text_prompt = prompt.positive_prompt
-            negative_text_prompt = prompt.negative_prompt
+                if positive_prompt_length <= clip_text_embedder.max_length and negative_prompt_length <= clip_text_embedder.max_length:
+                    scored_indices.append(i)
 
-            prompt_score = 0
-            model_type = 'N/A'
-            if scoring_model is not None and clip_text_embedder is not None:
+            # attention pooled embeddings, the same pooling as predict_average_pooling
+            positive_embeddings = text_embedding_cache.embed_many([prompts[i].positive_prompt for i in scored_indices])
+            negative_embeddings = text_embedding_cache.embed_many([prompts[i].negative_prompt for i in scored_indices])
 
-                positive_prompt_length = clip_text_embedder.compute_token_length(positive_text_prompt)
-                negative_prompt_length = clip_text_embedder.compute_token_length(negative_text_prompt)
+            for j, i in enumerate(scored_indices):
+                positive_embedding = torch.from_numpy(positive_embeddings[j]).to(clip_text_embedder.device)
+                negative_embedding = torch.from_numpy(negative_embeddings[j]).to(clip_text_embedder.device)
+                prompt_scores[i] = scoring_model.predict_pooled_embeddings(positive_embedding, negative_embedding).item()
 
-                if positive_prompt_length <= clip_text_embedder.max_length and negative_prompt_length <= clip_text_embedder.max_length:
-                    # calculate new embeddings
-                    positive_embedding, _, positive_attention_mask = clip_text_embedder.forward_return_all(positive_text_prompt)
-                    negative_embedding, _, negative_attention_mask = clip_text_embedder.forward_return_all(negative_text_prompt)
-
-                    model_type = model_name
-                    prompt_score = scoring_model.predict_average_pooling(positive_embedding,
-                                                                   negative_embedding,
-                                                         positive_attention_mask,
-                                                         negative_attention_mask).item()
-
-            scored_prompt = ScoredPrompt(prompt_score,
-                                         positive_text_prompt,
-                                         negative_text_prompt,
+        scored_indices = set(scored_indices)
+        for i, prompt in enumerate(prompts):
+            model_type = model_name if i in scored_indices else 'N/A'
+
+            scored_prompt = ScoredPrompt(prompt_scores[i],
+                                         prompt.positive_prompt,
+                                         prompt.negative_prompt,
                                          model_type,
                                          generation_policy,
                                          top_k,
@@ -10,6 +10,7 @@ from configs.model_config import ModelPathConfig
 from stable_diffusion.model_paths import (SDconfigs, CLIPconfigs)
 from stable_diffusion import CLIPTextEmbedder
 from utility.minio import cmd
+from utility.clip.text_embedding_cache import TextEmbeddingCache
 from training_worker.ab_ranking.model.ab_ranking_efficient_net import ABRankingEfficientNetModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
@@ -57,6 +58,8 @@ class PromptJobGeneratorState:
         self.device = device
         self.config = ModelPathConfig()
         self.clip_text_embedder = CLIPTextEmbedder(device=self.device)
+        # attention pooled embeddings of the generated prompts, for scoring
+        self.text_embedding_cache = TextEmbeddingCache(self.clip_text_embedder, pooling_strategy='ATTENTION_POOLING')
 
     def configure_minio(self, minio_access_key, minio_secret_key):
         self.minio_client = cmd.get_minio_client(minio_access_key, minio_secret_key)
@@ -1,6 +1,8 @@
 """
-This script aggregates all individual selection datapoints json inside
-/datasets/<dataset-name>/data/ranking/aggregate/ into single per day per dataset json.
+This script packs all individual selection datapoints json inside
+/datasets/<dataset-name>/data/ranking/aggregate/ and /datasets/ranks/<rank id>/data/ranking/aggregate/
+into a single msgpack file per day, listed in a manifest.
+See data_loader/utils.py for the layout of the files.
 """
 
 import os
@@ -10,13 +12,19 @@ from pytz import timezone
 from datetime import datetime
 from dotenv import dotenv_values
 import json
+import msgpack
 from io import BytesIO
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from minio.deleteobjects import DeleteObject
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio import cmd
+from data_loader.utils import (get_dataset_ranking_prefix, get_daily_file_path, get_manifest_path,
+                               list_objects_with_etags, load_daily_manifest, load_daily_file, get_selection_datapoint,
+                               SELECTION_DATAPOINTS_AGGREGATE_PATH, SELECTION_DATAPOINTS_DOWNLOAD_WORKERS)
 
 config = dotenv_values("./scheduled_workers/.env")
 DATASETS_BUCKET = "datasets"
@@ -26,76 +34,98 @@ def get_datasets(minio_client):
     return datasets
 
 
-def get_selection_datapoints(minio_client, dataset_name):
-    prefix = os.path.join(dataset_name, "data/ranking/aggregate")
-    datasets = cmd.get_list_of_objects_with_prefix(minio_client, DATASETS_BUCKET, prefix=prefix)
-    return datasets
-
-
-def get_object(client, file_path):
-    response = client.get_object(DATASETS_BUCKET, file_path)
-    data = response.data
-
-    return data
+def get_rank_ranking_prefixes(minio_client):
+    # ranks/<rank id>/data/ranking
+    rank_folders = minio_client.list_objects(DATASETS_BUCKET, prefix="ranks/", recursive=False)
+    return [os.path.join(obj.object_name, "data/ranking") for obj in rank_folders if obj.is_dir]
 
 
-def remove_object(client, file_path):
-    client.remove_object(DATASETS_BUCKET, file_path)
+def get_date(path):
+    # the json files are named <date>-<time>-<user>.json
+    return os.path.basename(path)[:10]
 
 
-def remove_todays_data_from_list(selection_datapoints):
-    date = datetime.now(tz=timezone("Asia/Hong_Kong")).strftime('%Y-%m-%d')
-    new_list = []
-    for path in selection_datapoints:
-        if date not in path:
-            new_list.append(path)
+def upload_msgpack(minio_client, path, data):
+    cmd.upload_data(minio_client, DATASETS_BUCKET, path, BytesIO(msgpack.packb(data)))
 
-    return new_list
 
-def get_summary_dict(selection_datapoints):
-    summary_dict = {}
-    # get date
-    for path in selection_datapoints:
-        base = os.path.basename(path)
-        date = base[:10]
+def upload_manifest(minio_client, ranking_prefix, manifest):
+    data = BytesIO(json.dumps(manifest, indent=4).encode('utf-8'))
+    cmd.upload_data(minio_client, DATASETS_BUCKET, get_manifest_path(ranking_prefix), data)
 
-        if date not in summary_dict:
-            summary_dict[date] = []
 
-        summary_dict[date].append(path)
+def remove_objects(minio_client, paths):
+    # one request per 1000 objects
+    errors = minio_client.remove_objects(DATASETS_BUCKET, [DeleteObject(path) for path in paths])
+    for error in errors:
+        print("Error removing {}: {}".format(error.name, error.message))
 
-    return summary_dict
 
-def aggregate_dataset_selection_datapoints(minio_client, dataset_name):
-    selection_datapoints = get_selection_datapoints(minio_client, dataset_name=dataset_name)
+def aggregate_selection_datapoints_with_prefix(minio_client, ranking_prefix, remove_originals=False):
+    aggregate_prefix = os.path.join(ranking_prefix, SELECTION_DATAPOINTS_AGGREGATE_PATH)
+    listed_etags = list_objects_with_etags(minio_client, aggregate_prefix + "/")
 
     # we don't want to prematurely aggregate today's data since more data is still being added
-    selection_datapoints = remove_todays_data_from_list(selection_datapoints)
-
-    # get summary dict containing a date key and list of paths as values
-    summary_dict = get_summary_dict(selection_datapoints)
-    for key, val in summary_dict.items():
-        full_path = os.path.join(dataset_name, "data/ranking", "{}-{}.json".format(key, dataset_name))
-        json_values = []
-        for path in val:
-            data = get_object(minio_client, path)
-            decoded_data = data.decode().replace("'", '"')
-            json_data = json.loads(decoded_data)
-            json_values.append(json_data)
-            json_data = json.dumps(json_values, indent=4).encode('utf-8')
-            data = BytesIO(json_data)
-
-        # upload the aggregated data
-        cmd.upload_data(minio_client, DATASETS_BUCKET, full_path, data)
-
-    print("Finished aggregating datapoints...")
-    print("Now removing aggregated datapoints...")
-    for path in selection_datapoints:
-        remove_object(minio_client, path)
-    print("Finished removing aggregated datapoints...")
-
-
-def aggregate_selection_datapoints():
+    today = datetime.now(tz=timezone("Asia/Hong_Kong")).strftime('%Y-%m-%d')
+
+    # date => paths of the day
+    day_paths = {}
+    for path in listed_etags:
+        date = get_date(path)
+        if date != today:
+            day_paths.setdefault(date, []).append(path)
+
+    manifest = load_daily_manifest(minio_client, ranking_prefix)
+
+    with ThreadPoolExecutor(max_workers=SELECTION_DATAPOINTS_DOWNLOAD_WORKERS) as executor:
+        for date in sorted(day_paths.keys()):
+            paths = day_paths[date]
+            day = manifest["days"].get(date)
+
+            # file name => packed datapoint
+            entries = {}
+            if day is not None:
+                for entry in load_daily_file(minio_client, ranking_prefix, date)["datapoints"]:
+                    entries[entry["file_name"]] = entry
+
+            # only the new and changed jsons are downloaded
+            changed_paths = []
+            for path in paths:
+                entry = entries.get(os.path.basename(path))
+                if entry is None or entry["etag"] != listed_etags[path]:
+                    changed_paths.append(path)
+
+            if len(changed_paths) > 0:
+                futures = [executor.submit(get_selection_datapoint, minio_client, path) for path in changed_paths]
+                for future in as_completed(futures):
+                    path, item = future.result()
+                    file_name = os.path.basename(path)
+                    entries[file_name] = {"file_name": file_name, "etag": listed_etags[path], "data": item}
+
+                datapoints = [entries[file_name] for file_name in sorted(entries.keys())]
+                upload_msgpack(minio_client, get_daily_file_path(ranking_prefix, date), {"date": date, "datapoints": datapoints})
+
+                # the manifest is the commit point of the day file
+                manifest["days"][date] = {"file_name": os.path.basename(get_daily_file_path(ranking_prefix, date)),
+                                          "count": len(datapoints),
+                                          "originals_removed": False if day is None else day["originals_removed"]}
+                upload_manifest(minio_client, ranking_prefix, manifest)
+                print("Packed {} selection datapoints of {}, {} new or changed".format(len(datapoints), date, len(changed_paths)))
+
+            if remove_originals:
+                # once removed the packed datapoints are the only copy
+                manifest["days"][date]["originals_removed"] = True
+                upload_manifest(minio_client, ranking_prefix, manifest)
+                remove_objects(minio_client, paths)
+
+    print("Finished aggregating datapoints of {}...".format(ranking_prefix))
+
+
+def aggregate_dataset_selection_datapoints(minio_client, dataset_name, remove_originals=False):
+    aggregate_selection_datapoints_with_prefix(minio_client, get_dataset_ranking_prefix(dataset_name), remove_originals)
+
+
+def aggregate_selection_datapoints(remove_originals=False):
     start_time = datetime.now()
     print("Starting selection datapoints aggregation task...")
     # get minio client
@@ -105,20 +135,28 @@ def aggregate_selection_datapoints():
 
     # for every dataset get aggregated json files
     for dataset_name in dataset_list:
+        if dataset_name == "ranks":
+            continue
+
         print("Processing dataset: {}".format(dataset_name))
-        aggregate_dataset_selection_datapoints(minio_client, dataset_name)
+        aggregate_dataset_selection_datapoints(minio_client, dataset_name, remove_originals)
         print("Finished processing dataset: {}".format(dataset_name))
         print("==========================================================")
 
+    for ranking_prefix in get_rank_ranking_prefixes(minio_client):
+        print("Processing rank: {}".format(ranking_prefix))
+        aggregate_selection_datapoints_with_prefix(minio_client, ranking_prefix, remove_originals)
+        print("==========================================================")
+
     print("Finished selection datapoints aggregation task...")
     print("Time Elapsed: {}s".format(datetime.now() - start_time))
 
 
 
-def main(time_to_run):
+def main(time_to_run, remove_originals):
     print("Current datetime: {}".format(datetime.now(tz=timezone("Asia/Hong_Kong"))))
     print("The script will run everyday at {} UTC+8:00".format(time_to_run))
-    schedule.every().day.at(time_to_run, timezone("Asia/Hong_Kong")).do(aggregate_selection_datapoints)
+    schedule.every().day.at(time_to_run, timezone("Asia/Hong_Kong")).do(aggregate_selection_datapoints, remove_originals=remove_originals)
     while True:
         schedule.run_pending()
 
@@ -127,10 +165,13 @@ def parse_args():
 
     # Required parameters
     parser.add_argument("--time-to-run", type=str, default="00:10")
+    parser.add_argument("--remove-originals", action="store_true", default=False,
+                        help="Remove the json of the datapoints once they're packed. "
+                             "The orchestration api reads and flags those jsons, so they're kept by default")
 
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
 
-    main(args.time_to_run)
\ No newline at end of file
+    main(args.time_to_run, args.remove_originals)
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import sys
+import argparse
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+
+from utility.minio import cmd
+from training_worker.ab_ranking.model import constants
+from data_loader.utils import get_datasets
+from data_loader.feature_shards import build_feature_shards, DEFAULT_FEATURE_SHARD_SIZE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack the features of the selection datapoint images into shards")
+    parser.add_argument('--minio-addr', required=False, help='Minio server address', default="192.168.3.5:9000")
+    parser.add_argument('--minio-access-key', required=False, help='Minio access key')
+    parser.add_argument('--minio-secret-key', required=False, help='Minio secret key')
+    parser.add_argument('--dataset-name', required=True, help='Name of the dataset, or all')
+    parser.add_argument('--input-type', default=constants.KANDINSKY_CLIP, choices=[constants.EMBEDDING,
+                                                                                  constants.EMBEDDING_POSITIVE,
+                                                                                  constants.EMBEDDING_NEGATIVE,
+                                                                                  constants.CLIP,
+                                                                                  constants.KANDINSKY_CLIP],
+                        help='Features to pack')
+    parser.add_argument('--pooling-strategy', default=constants.AVERAGE_POOLING, type=int,
+                        help='Pooling strategy of the text embeddings, 0=average, 1=max, 2=max abs')
+    parser.add_argument('--shard-size', default=DEFAULT_FEATURE_SHARD_SIZE, type=int, help='Max number of images per shard')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    minio_client = cmd.get_minio_client(minio_access_key=args.minio_access_key,
+                                        minio_secret_key=args.minio_secret_key,
+                                        minio_ip_addr=args.minio_addr)
+
+    if args.dataset_name != "all":
+        dataset_names = [args.dataset_name]
+    else:
+        dataset_names = get_datasets(minio_client)
+
+    for dataset_name in dataset_names:
+        print("Building feature shards for {}...".format(dataset_name))
+        try:
+            build_feature_shards(minio_client,
+                                 dataset_name,
+                                 args.input_type,
+                                 args.pooling_strategy,
+                                 args.shard_size)
+        except Exception as e:
+            print("Error building feature shards for {}: {}".format(dataset_name, e))
+
+
+if __name__ == "__main__":
+    main()
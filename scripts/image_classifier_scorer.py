@@ -453,19 +453,18 @@ class ImageScorer:
 
     def upload_scores(self, hash_score_pairs, job_uuids_hash_dict):
         print("Uploading scores to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for pair in hash_score_pairs:
-                # upload score
-                score_data= {
-                    "job_uuid": job_uuids_hash_dict[pair[0]],
-                    "classifier_id": self.classifier_id,
-                    "score": pair[1],
-                }
-                futures.append(executor.submit(request.http_add_classifier_score, score_data=score_data))
-
-            for _ in tqdm(as_completed(futures), total=len(hash_score_pairs)):
-                continue
+        score_data_list = []
+        for image_hash, score in hash_score_pairs:
+            score_data_list.append({
+                "job_uuid": job_uuids_hash_dict[image_hash],
+                "classifier_id": self.classifier_id,
+                "tag_id": self.tag_id,
+                "score": score,
+                "image_hash": image_hash,
+                "image_source": "generated_image",
+            })
+
+        request.http_upload_in_chunks(request.http_add_classifier_scores_bulk, score_data_list)
 
     def get_classifier_id_and_name(self, classifier_file_path):
         for classifier in self.classifier_id_list:
@@ -475,35 +474,27 @@ class ImageScorer:
     
     def upload_sigma_scores(self, hash_sigma_score_dict):
         print("Uploading sigma scores to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for key, val in hash_sigma_score_dict.items():
-                # upload score
-                sigma_score_data = {
-                    "image_hash": key,
-                    "sigma_score": val,
-                }
+        sigma_score_data_list = []
+        for image_hash, sigma_score in hash_sigma_score_dict.items():
+            sigma_score_data_list.append({
+                "model_id": self.classifier_id,
+                "image_hash": image_hash,
+                "sigma_score": sigma_score,
+            })
 
-                futures.append(executor.submit(request.http_add_sigma_score, sigma_score_data=sigma_score_data))
-
-            for _ in tqdm(as_completed(futures), total=len(futures)):
-                continue
+        request.http_upload_in_chunks(request.http_add_sigma_scores_bulk, sigma_score_data_list)
 
     def upload_percentile(self, hash_percentile_dict):
         print("Uploading percentiles to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for image_hash, percentile in hash_percentile_dict.items():
-                # upload percentile
-                percentile_data = {
-                    "image_hash": image_hash,
-                    "percentile": percentile,
-                }
-
-                futures.append(executor.submit(request.http_add_percentile, percentile_data=percentile_data))
-
-            for _ in tqdm(as_completed(futures), total=len(hash_percentile_dict)):
-                continue
+        percentile_data_list = []
+        for image_hash, percentile in hash_percentile_dict.items():
+            percentile_data_list.append({
+                "model_id": self.classifier_id,
+                "image_hash": image_hash,
+                "percentile": percentile,
+            })
+
+        request.http_upload_in_chunks(request.http_add_percentiles_bulk, percentile_data_list)
 
     def generate_graphs(self, hash_score_pairs, hash_percentile_dict, hash_sigma_score_dict):
         # Initialize all graphs/subplots
@@ -4,7 +4,6 @@ import io
 import math
 import os
 import sys
-import threading
 import uuid
 import numpy as np
 import torch
@@ -17,6 +16,7 @@ sys.path.insert(0, os.getcwd())
 
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from utility.minio import cmd
+from utility.minio.upload_service import UploadService
 from utility.http import request
 from utility.http import external_images_request
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
@@ -24,6 +24,9 @@ from scripts.image_extraction.utils import extract_square_images, save_latents_a
 from training_worker.classifiers.models.elm_regression import ELMRegression
 from kandinsky.model_paths import DECODER_MODEL_PATH
 
+# number of extracts filtered at once
+DEFAULT_FILTER_BATCH_SIZE = 64
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -37,6 +40,7 @@ def parse_args():
     parser.add_argument('--target-size', type=int, default=512, help='Target size of image extraction')
     parser.add_argument('--batch-size', type=int, default=10000, help='batch size for extraction')
     parser.add_argument('--file-batch-size', type=int, default=10000, help='Batch size for numpy file storage')
+    parser.add_argument('--filter-batch-size', type=int, default=DEFAULT_FILTER_BATCH_SIZE, help='Number of extracts going through the clip encoder, the filter models and the vae encoder at once')
 
     return parser.parse_args()
 
@@ -63,6 +67,71 @@ def load_scoring_model(minio_client, rank_id, model_path, device):
 
     return scoring_model
 
+class FusedClassifierHeads:
+    # evaluates many elm classifiers with one matrix multiply
+    # the hidden layers are concatenated and the output layers are put on a block diagonal,
+    # so column i of the scores is the score of classifier_models[i]
+    # classifiers with different activation functions can't share a multiply, they are grouped
+    def __init__(self, classifier_models, device):
+        self.num_heads = len(classifier_models)
+        self.device = device
+
+        activation_columns = {}
+        for column, model in enumerate(classifier_models):
+            activation_columns.setdefault(model.activation_func_name, []).append(column)
+
+        self.groups = []
+        for columns in activation_columns.values():
+            models = [classifier_models[column] for column in columns]
+            weight = torch.cat([model._weight.to(device, torch.float32) for model in models], dim=1)
+            bias = torch.cat([model._bias.to(device, torch.float32) for model in models])
+            beta = torch.block_diag(*[model._beta.to(device, torch.float32) for model in models])
+            columns = torch.tensor(columns, dtype=torch.long, device=device)
+
+            self.groups.append((models[0]._activation, weight, bias, beta, columns))
+
+    def classify(self, clip_vectors):
+        # (batch size, clip dim) => (batch size, number of classifiers)
+        scores = torch.zeros((len(clip_vectors), self.num_heads), dtype=torch.float32, device=self.device)
+        with torch.no_grad():
+            for activation, weight, bias, beta, columns in self.groups:
+                scores[:, columns] = activation(clip_vectors.mm(weight) + bias).mm(beta)
+
+        return scores
+
+
+class FusedQualityHeads:
+    # evaluates many elm ranking models with one matrix multiply
+    # the random layers of the models are relus, so each model is
+    # score = (relu(x) . w + b) * scaling factor, stacked as columns of one matrix
+    def __init__(self, ranking_models, device, clip_dim=1280):
+        self.num_heads = len(ranking_models)
+
+        weights = [torch.zeros(clip_dim, 0)]
+        biases = [torch.zeros(0)]
+        for model in ranking_models:
+            last_layer = model.model.linear_last_layer
+            # deprecated models have no scaling factor
+            scaling_factor = getattr(model.model, "scaling_factor", None)
+            scaling_factor = 1.0 if scaling_factor is None else scaling_factor.detach().cpu().reshape(-1)
+
+            weights.append((last_layer.weight.detach().cpu().reshape(-1, 1) * scaling_factor).to(torch.float32))
+            biases.append((last_layer.bias.detach().cpu().reshape(-1) * scaling_factor).to(torch.float32))
+
+        self.weight = torch.cat(weights, dim=1).to(device)
+        self.bias = torch.cat(biases).to(device)
+        self.mean = torch.tensor([float(model.mean) for model in ranking_models], dtype=torch.float32, device=device)
+        self.standard_deviation = torch.tensor([float(model.standard_deviation) for model in ranking_models],
+                                               dtype=torch.float32, device=device)
+
+    def get_sigma_scores(self, clip_vectors):
+        # (batch size, clip dim) => (batch size, number of models)
+        with torch.no_grad():
+            scores = torch.relu(clip_vectors).mm(self.weight) + self.bias
+
+        return (scores - self.mean) / self.standard_deviation
+
+
 class ImageExtractionPipeline:
 
     def __init__(self,
@@ -74,7 +143,8 @@ class ImageExtractionPipeline:
                  defect_threshold: float = 0.7,
                  target_size: int = 512,
                  batch_size: int = 10000,
-                 file_batch_size= 10000):
+                 file_batch_size= 10000,
+                 filter_batch_size: int = DEFAULT_FILTER_BATCH_SIZE):
         
         # get minio client
         self.minio_client = cmd.get_minio_client(minio_access_key=minio_access_key,
@@ -88,6 +158,7 @@ class ImageExtractionPipeline:
         self.target_size= target_size
         self.batch_size= batch_size
         self.file_batch_size= file_batch_size
+        self.filter_batch_size= filter_batch_size
         self.clip_vectors=[]
         self.vae_latents=[]
         self.image_hashes= []
@@ -107,8 +178,16 @@ class ImageExtractionPipeline:
         self.clip = None
         self.vae = None
 
-        # threads
-        self.threads=[]
+        # all the filter models stacked, built after loading the models
+        self.classifier_heads = None
+        self.classifier_thresholds = None
+        self.num_defect_heads = 0
+        self.quality_heads = None
+
+        # uploads of the extracts
+        self.upload_service= UploadService(name="extract uploads")
+        # the latent batch files are read, appended and written back, so they're saved one at a time
+        self.batch_file_upload_service= UploadService(num_workers=1, name="latent batch file uploads")
 
     def load_models(self):
         try:
@@ -161,8 +240,24 @@ class ImageExtractionPipeline:
                 local_files_only=True,
             ).eval().to(device=self.device)
 
+            self.build_filter_heads()
+
         except Exception as e:
             raise Exception(f"An error occured while loading the models: {e}.")
+
+    def build_filter_heads(self):
+        # defect classifiers first, then topic classifiers
+        # the irrelevant image classifiers are not used for filtering
+        defect_models = list(self.defect_models.values())
+        topic_models = list(self.topic_models.values())
+
+        self.num_defect_heads = len(defect_models)
+        self.classifier_heads = FusedClassifierHeads(defect_models + topic_models, self.device)
+        self.classifier_thresholds = torch.tensor([self.defect_threshold] * len(defect_models) +
+                                                  [self.min_classifier_score] * len(topic_models),
+                                                  dtype=torch.float32, device=self.device)
+
+        self.quality_heads = FusedQualityHeads(self.quality_models, self.device)
         
 
     def get_classifier_model(self, tag_name):
@@ -193,76 +288,87 @@ class ImageExtractionPipeline:
         
         return clip_model
     
-    def is_filtered(self, clip_vector):
-        # check if the image is irrelevant
-        # for tag, model in self.irrelevant_image_models.items():
-        #     with torch.no_grad():
-        #         classifier_score = model.classify(clip_vector).item()
-        #     if classifier_score >= self.defect_threshold:
-        #         return True
-
-        # check if the image has any defects
-        for tag, model in self.defect_models.items():
-            with torch.no_grad():
-                classifier_score = model.classify(clip_vector).item()
-            if classifier_score >= self.defect_threshold:
-                return True
-
-        # check classifier scores
-        for tag, model in self.topic_models.items():
-            with torch.no_grad():
-                classifier_score = model.classify(clip_vector).item()
-            if classifier_score >= self.min_classifier_score:
-                return False
-        
-        # Check quality score
-        for model in self.quality_models:
-            with torch.no_grad():
-                clip_score = model.predict_clip(clip_vector).item()
-                score_mean= float(model.mean)
-                score_std= float(model.standard_deviation)
-                sigma_score = (clip_score - score_mean) / score_std
-            
-            if sigma_score >= self.min_quality_sigma:
-                return False
-        
-        return True
+    def get_filter_mask(self, clip_vectors):
+        # returns a (batch size,) bool tensor, true for the extracts that are kept
+        # an extract is dropped if it has any defect,
+        # otherwise it's kept if it passes any topic classifier or any quality model
+        classifier_scores = self.classifier_heads.classify(clip_vectors)
+        passed_classifiers = classifier_scores >= self.classifier_thresholds
+
+        has_defect = passed_classifiers[:, :self.num_defect_heads].any(dim=1)
+        has_topic = passed_classifiers[:, self.num_defect_heads:].any(dim=1)
+
+        sigma_scores = self.quality_heads.get_sigma_scores(clip_vectors)
+        has_quality = (sigma_scores >= self.min_quality_sigma).any(dim=1)
+
+        return ~has_defect & (has_topic | has_quality)
+
+    def get_clip_vectors(self, images):
+        pixel_values = self.clip.image_processor(images, return_tensors="pt")['pixel_values']
+        with torch.no_grad():
+            clip_vectors = self.clip.get_image_features(pixel_values)
+
+        return clip_vectors.to(dtype=torch.float32)
+
+    def get_vae_latents(self, images):
+        pixel_values = np.stack([np.array(image) for image in images]).astype(np.float32) / 127.5 - 1  # Normalize
+        pixel_values = np.transpose(pixel_values, [0, 3, 1, 2])  # Correct channel order: [B, C, H, W]
+        pixel_values = torch.from_numpy(pixel_values).to(device=self.device)
+
+        with torch.no_grad():
+            vae_latents = self.vae.encode(pixel_values).latents
+
+        del pixel_values
+
+        return vae_latents
+
+    def save_latents_and_vectors(self):
+        # save batch file
+        clip_vectors= self.clip_vectors
+        vae_latents= self.vae_latents
+        image_hashes= self.image_hashes
+
+        self.clip_vectors =[]
+        self.vae_latents =[]
+        self.image_hashes =[]
+
+        self.batch_file_upload_service.submit(save_latents_and_vectors, self.minio_client, self.dataset, clip_vectors, vae_latents, image_hashes)
 
     def filter_extracts(self, external_images: list, extracted_images: list):
         print("Filtering extracted images...........")
         extract_data=[]
         extraction_policy= "random_crop_resize"
 
-        # filter the images based on
-        index=0 
-        for extract in tqdm(extracted_images):
-            image = extract["image"]
-            image_data = extract["image_data"]
-
-            # get the clip vector from the image
-            with torch.no_grad():
-                clip_vector= self.clip.get_image_features(image).to(dtype=torch.float32)
-            # filter the image if it's not useful
-            if not self.is_filtered(clip_vector):
-                # calculate vae latent
-                pixel_values = np.array(image).astype(np.float32) / 127.5 - 1  # Normalize
-                pixel_values = np.transpose(pixel_values, [2, 0, 1])  # Correct channel order: [C, H, W]
-                pixel_values = torch.from_numpy(pixel_values).unsqueeze(0).to(device=self.device)  # Add batch dimension
-
-                with torch.no_grad():
-                    vae_latent = self.vae.encode(pixel_values).latents
-
-                pixel_values.cpu()
-                del pixel_values
-                torch.cuda.empty_cache()
+        # the extracts go through the clip encoder and the filter models in batches,
+        # and only the ones that are kept go through the vae encoder
+        for start_index in tqdm(range(0, len(extracted_images), self.filter_batch_size)):
+            extracts_batch = extracted_images[start_index:start_index + self.filter_batch_size]
+            images = [extract["image"] for extract in extracts_batch]
+
+            clip_vectors = self.get_clip_vectors(images)
+            keep_mask = self.get_filter_mask(clip_vectors)
+
+            # the only device sync of the filtering
+            kept_indexes = torch.nonzero(keep_mask).flatten().tolist()
+            if len(kept_indexes) == 0:
+                continue
+
+            vae_latents = self.get_vae_latents([images[index] for index in kept_indexes]).cpu()
+            clip_vectors = clip_vectors.cpu()
+
+            for latent_index, index in enumerate(kept_indexes):
+                extract = extracts_batch[index]
+                # keep the (1, ...) shape of single images
+                clip_vector = clip_vectors[index:index + 1]
+                vae_latent = vae_latents[latent_index:latent_index + 1]
 
                 # store data
-                source_image_data= external_images[index]
-                
+                source_image_data= external_images[start_index + index]
+
                 data={
-                    "image_hash" : hashlib.md5(image_data.getvalue()).hexdigest(),
+                    "image_hash" : hashlib.md5(extract["image_data"].getvalue()).hexdigest(),
                     "image_uuid": str(uuid.uuid4()),
-                    "image": image,
+                    "image": extract["image"],
                     "clip_vector": clip_vector,
                     "vae_latent" : vae_latent,
                     "source_image_hash": source_image_data["image_hash"],
@@ -273,42 +379,20 @@ class ImageExtractionPipeline:
 
                 extract_data.append(data)
 
-                # spawn upload data thread
-                thread = threading.Thread(target=upload_extract_data, args=(self.minio_client, data,))
-                thread.start()
-                self.threads.append(thread)
+                # queue the upload of the data, blocks when too much data is waiting
+                self.upload_service.submit(upload_extract_data, self.minio_client, data)
 
                 self.clip_vectors.append(clip_vector)
                 self.vae_latents.append(vae_latent)
                 self.image_hashes.append(data["image_hash"])
-                
+
                 # check if batch size was reached
                 if len(self.clip_vectors) >= self.file_batch_size:
-                    # save batch file
-                    clip_vectors= self.clip_vectors.copy()
-                    vae_latents= self.vae_latents.copy()
-
-                    self.clip_vectors =[]
-                    self.vae_latents =[]
+                    self.save_latents_and_vectors()
 
-                    thread = threading.Thread(target=save_latents_and_vectors, args=(self.minio_client, self.dataset, clip_vectors, vae_latents, self.image_hashes,))
-                    thread.start()
-                    self.threads.append(thread)
-            
-            index+=1
-        
         # save any extra vectors to numpy files
         if len(self.clip_vectors) > 0:
-            # save batch file
-            clip_vectors= self.clip_vectors.copy()
-            vae_latents= self.vae_latents.copy()
-
-            self.clip_vectors =[]
-            self.vae_latents =[]
-            
-            thread = threading.Thread(target=save_latents_and_vectors, args=(self.minio_client, self.dataset, clip_vectors, vae_latents, self.image_hashes,))
-            thread.start()
-            self.threads.append(thread)
+            self.save_latents_and_vectors()
 
         return extract_data
 
@@ -343,10 +427,13 @@ class ImageExtractionPipeline:
             processed_images+= len(extract_data)
             print(f"{len(extract_data)} images filtered from {self.batch_size} images")
             print(f"total extracted images: {processed_images}/{total_images}")
+            self.upload_service.print_stats()
 
-        # check if all upload threads are completed
-        for thread in self.threads:
-            thread.join()
+        # wait for all the uploads to complete
+        self.upload_service.join()
+        self.batch_file_upload_service.join()
+        self.upload_service.print_stats()
+        self.batch_file_upload_service.print_stats()
 
 def main():
     args= parse_args()
@@ -370,7 +457,8 @@ def main():
                                                 defect_threshold= args.defect_threshold,
                                                 target_size= args.target_size,
                                                 batch_size= args.batch_size,
-                                                file_batch_size= args.file_batch_size) 
+                                                file_batch_size= args.file_batch_size,
+                                                filter_batch_size= args.filter_batch_size) 
             # load all necessary models
             pipeline.load_models()
 
@@ -389,7 +477,8 @@ def main():
                                             defect_threshold= args.defect_threshold,
                                             target_size= args.target_size,
                                             batch_size= args.batch_size,
-                                            file_batch_size= args.file_batch_size) 
+                                            file_batch_size= args.file_batch_size,
+                                            filter_batch_size= args.filter_batch_size) 
         # load all necessary models
         pipeline.load_models()
 
@@ -22,6 +22,12 @@ from utility.http import model_training_request
 from utility.http import request
 from utility.minio import cmd
 
+# number of images scored per forward of the model
+DEFAULT_SCORING_BATCH_SIZE = 1024
+# rows of the first batch scored again one by one, to check the batched scores
+SCORING_CHECK_ROWS = 8
+SCORING_CHECK_TOLERANCE = 1e-4
+
 
 def determine_model_input_type_size(model_filename):
     if "embedding-positive" in model_filename:
@@ -43,8 +49,12 @@ class ImageScorer:
                  minio_client,
                  dataset_name="characters",
                  model_name="",
-                 generation_policy="all"):
+                 generation_policy="all",
+                 batch_size=DEFAULT_SCORING_BATCH_SIZE,
+                 rank_id=None):
         self.minio_client = minio_client
+        self.rank_id = rank_id
+        self.batch_size = batch_size
         self.model = None
         self.dataset = dataset_name
         self.generation_policy = generation_policy
@@ -151,7 +161,7 @@ class ImageScorer:
         msgpack_data = cmd.get_file_from_minio(self.minio_client, 'datasets', path)
         if not msgpack_data:
             print(f"No msgpack file found at path: {path}")
-            return None, None, None, None, index
+            return None, None, None, None, index, None
 
         data = msgpack.unpackb(msgpack_data.data)
 
@@ -187,7 +197,7 @@ class ImageScorer:
             data_msgpack = cmd.get_file_from_minio(self.minio_client, 'datasets',data_msgpack_path)
             if not data_msgpack:
                 print("No msgpack file found at path: {}".format(data_msgpack_path))
-                return None
+                return None, None, None, None, index, None
 
             data = msgpack.unpackb(data_msgpack.data)
 
@@ -223,91 +233,103 @@ class ImageScorer:
 
         return features_data, image_paths
 
+    def get_batch_scores(self, batch_features_data):
+        # stacks the features of the batch into (B, D) tensors
+        # and scores them with a single forward of the model
+        first_features = torch.stack([data[1] for data in batch_features_data]).to(self.device)
+        first_features = first_features.reshape(len(batch_features_data), -1)
+
+        if self.model_input_type == "embedding":
+            second_features = torch.stack([data[2] for data in batch_features_data]).to(self.device)
+            second_features = second_features.reshape(len(batch_features_data), -1)
+            # same input as predict_pooled_embeddings, positive then negative
+            inputs = torch.cat((first_features, second_features), dim=1)
+            scores = self.model.predict_positive_or_negative_only_pooled(inputs)
+
+        elif self.model_input_type in ["embedding-positive", "embedding-negative"]:
+            scores = self.model.predict_positive_or_negative_only_pooled(first_features)
+
+        elif self.model_input_type == "clip" or self.model_input_type == "clip-h":
+            scores = self.model.predict_clip(first_features)
+
+        # squeeze turns a batch of one into a scalar
+        return scores.reshape(-1).float().cpu().numpy()
+
+    def check_batch_scores(self, batch_features_data, batch_scores):
+        # a batched score must equal the score of the row on its own
+        for i in range(min(SCORING_CHECK_ROWS, len(batch_features_data))):
+            row_score = self.get_batch_scores(batch_features_data[i:i + 1])[0]
+            if not np.isclose(batch_scores[i], row_score, rtol=SCORING_CHECK_TOLERANCE, atol=SCORING_CHECK_TOLERANCE):
+                raise Exception("Batched score {} of row {} doesn't match its score on its own {}".format(batch_scores[i], i, row_score))
+
     def get_scores(self, msgpack_paths):
-        hash_score_pairs = []
-        job_uuids_hash_dict = {}
         features_data, image_paths = self.get_all_feature_pairs(msgpack_paths)
+
+        # skip the images whose features couldn't be loaded
+        valid_indices = [i for i, data in enumerate(features_data) if data[1] is not None]
+        features_data = [features_data[i] for i in valid_indices]
+        image_paths = [image_paths[i] for i in valid_indices]
+
         print('Predicting dataset scores...')
+        scores = np.zeros(len(features_data), dtype=np.float32)
         with torch.no_grad():
-            count=0
-            weird_count = 0
-            for data in tqdm(features_data):
-                if self.model_input_type == "embedding":
-                    positive_embedding_array = data[1].to(self.device)
-                    negative_embedding_array = data[2].to(self.device)
-                    image_hash = data[0]
-                    score = self.model.predict_pooled_embeddings(positive_embedding_array, negative_embedding_array)
-
-                elif self.model_input_type == "embedding-positive":
-                    positive_embedding_array = data[1].to(self.device)
-                    image_hash = data[0]
-                    score = self.model.predict_positive_or_negative_only_pooled(positive_embedding_array)
-
-                elif self.model_input_type == "embedding-negative":
-                    negative_embedding_array = data[1].to(self.device)
-                    image_hash = data[0]
-                    score = self.model.predict_positive_or_negative_only_pooled(negative_embedding_array)
-
-                elif self.model_input_type == "clip"  or self.model_input_type == "clip-h":
-                    clip_feature_vector = data[1].to(self.device)
-                    image_hash = data[0]
-                    score = self.model.predict_clip(clip_feature_vector)
-
-                if score > 100000.0 or score < -100000.0:
-                    print("score more than or less than 100k and -100k")
-                    print("Score=", score)
-                    print("image path=", image_paths[count])
-                    weird_count += 1
-                    continue
-
-                hash_score_pairs.append((image_hash, score.item()))
-                # add job uuids to dict
-                job_uuids_hash_dict[image_hash] = data[3]
+            for start in tqdm(range(0, len(features_data), self.batch_size)):
+                end = min(start + self.batch_size, len(features_data))
+                scores[start:end] = self.get_batch_scores(features_data[start:end])
+                if start == 0:
+                    self.check_batch_scores(features_data[start:end], scores[start:end])
+
+        weird_scores = (scores > 100000.0) | (scores < -100000.0)
+        for i in np.nonzero(weird_scores)[0]:
+            print("score more than or less than 100k and -100k")
+            print("Score=", scores[i])
+            print("image path=", image_paths[i])
+        print("Weird scores count = ", int(weird_scores.sum()))
 
-                count += 1
-
-        print("Weird scores count = ", weird_count)
+        hash_score_pairs = []
+        job_uuids_hash_dict = {}
+        valid_image_paths = []
+        for i in np.nonzero(~weird_scores)[0]:
+            image_hash = features_data[i][0]
+            hash_score_pairs.append((image_hash, float(scores[i])))
+            # add job uuids to dict
+            job_uuids_hash_dict[image_hash] = features_data[i][3]
+            valid_image_paths.append(image_paths[i])
 
-        return hash_score_pairs, image_paths, job_uuids_hash_dict
+        return hash_score_pairs, valid_image_paths, job_uuids_hash_dict
 
     def get_percentiles(self, hash_score_pairs):
-        hash_percentile_dict = {}
-        sorted_hash_score_pairs = hash_score_pairs.copy()
-        sorted_hash_score_pairs.sort(key=lambda a: a[1])
+        scores = np.array([pair[1] for pair in hash_score_pairs], dtype=np.float64)
 
-        len_hash_scores = len(sorted_hash_score_pairs)
-        for i in range(len(sorted_hash_score_pairs)):
-            percentile = i / len_hash_scores
-            hash_percentile_dict[sorted_hash_score_pairs[i][0]] = percentile
+        # rank of every score, ties keep their order
+        percentiles = np.empty(len(scores), dtype=np.float64)
+        percentiles[np.argsort(scores, kind='stable')] = np.arange(len(scores)) / len(scores)
+
+        hash_percentile_dict = {}
+        for pair, percentile in zip(hash_score_pairs, percentiles.tolist()):
+            hash_percentile_dict[pair[0]] = percentile
 
         return hash_percentile_dict
 
     def get_sigma_scores(self, hash_score_pairs):
-        scores_arr = []
-        for i in range(len(hash_score_pairs)):
-            score = hash_score_pairs[i][1]
-            if math.isnan(score):
-                # skip nan
-                continue
+        scores_np_arr = np.array([pair[1] for pair in hash_score_pairs], dtype=np.float64)
 
-            scores_arr.append(score)
+        # skip nan
+        print("max=", np.nanmax(scores_np_arr))
+        print("min=", np.nanmin(scores_np_arr))
 
-        scores_np_arr = np.array(scores_arr)
-        print("max=", scores_np_arr.max())
-        print("min=", scores_np_arr.min())
-
-        mean = scores_np_arr.mean(dtype=np.float64)
-        standard_deviation = scores_np_arr.std(dtype=np.float64)
+        mean = np.nanmean(scores_np_arr)
+        standard_deviation = np.nanstd(scores_np_arr)
 
         print("numpy arr=", scores_np_arr)
         print("mean=", mean)
         print("standard_dev=", standard_deviation)
 
+        sigma_scores = (scores_np_arr - mean) / standard_deviation
+
         hash_sigma_score_dict = {}
-        for i in range(len(hash_score_pairs)):
-            score = hash_score_pairs[i][1]
-            sigma_score = (score - mean) / standard_deviation
-            hash_sigma_score_dict[hash_score_pairs[i][0]] = float(sigma_score)
+        for pair, sigma_score in zip(hash_score_pairs, sigma_scores.tolist()):
+            hash_sigma_score_dict[pair[0]] = sigma_score
 
         return hash_sigma_score_dict
 
@@ -350,56 +372,56 @@ class ImageScorer:
 
         return csv_data
 
-    def upload_scores(self, hash_score_pairs):
+    def upload_scores(self, hash_score_pairs, hash_sigma_score_dict, job_uuids_hash_dict):
+        # every rank score is stored with its rank id
+        if self.rank_id is None:
+            raise Exception("A rank id (--rank-id) is needed to upload the rank scores")
+
         print("Uploading scores to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for pair in hash_score_pairs:
-                # upload score
-                score_data = {
-                    "model_id": self.model_id,
-                    "image_hash": pair[0],
-                    "score": pair[1],
-                }
+        score_data_list = []
+        for image_hash, score in hash_score_pairs:
+            # scores are keyed on (uuid, image_hash, rank_model_id)
+            if image_hash not in job_uuids_hash_dict:
+                continue
 
-                futures.append(executor.submit(request.http_add_score, score_data=score_data))
+            score_data_list.append({
+                "uuid": job_uuids_hash_dict[image_hash],
+                "rank_model_id": self.model_id,
+                "rank_id": self.rank_id,
+                "score": score,
+                "sigma_score": hash_sigma_score_dict[image_hash],
+                "image_hash": image_hash,
+                "image_source": "generated_image",
+            })
 
-            for _ in tqdm(as_completed(futures), total=len(hash_score_pairs)):
-                continue
+        if len(score_data_list) < len(hash_score_pairs):
+            print("{} scores without a job uuid are not uploaded".format(len(hash_score_pairs) - len(score_data_list)))
+
+        request.http_upload_in_chunks(request.http_add_rank_scores_bulk, score_data_list)
 
     def upload_sigma_scores(self, hash_sigma_score_dict):
         print("Uploading sigma scores to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for key, val in hash_sigma_score_dict.items():
-                # upload score
-                sigma_score_data = {
-                    "model_id": self.model_id,
-                    "image_hash": key,
-                    "sigma_score": val,
-                }
-
-                futures.append(executor.submit(request.http_add_sigma_score, sigma_score_data=sigma_score_data))
+        sigma_score_data_list = []
+        for image_hash, sigma_score in hash_sigma_score_dict.items():
+            sigma_score_data_list.append({
+                "model_id": self.model_id,
+                "image_hash": image_hash,
+                "sigma_score": sigma_score,
+            })
 
-            for _ in tqdm(as_completed(futures), total=len(futures)):
-                continue
+        request.http_upload_in_chunks(request.http_add_sigma_scores_bulk, sigma_score_data_list)
 
     def upload_percentile(self, hash_percentile_dict):
         print("Uploading percentiles to mongodb...")
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-            for image_hash, percentile in hash_percentile_dict.items():
-                # upload percentile
-                percentile_data = {
-                    "model_id": self.model_id,
-                    "image_hash": image_hash,
-                    "percentile": percentile,
-                }
+        percentile_data_list = []
+        for image_hash, percentile in hash_percentile_dict.items():
+            percentile_data_list.append({
+                "model_id": self.model_id,
+                "image_hash": image_hash,
+                "percentile": percentile,
+            })
 
-                futures.append(executor.submit(request.http_add_percentile, percentile_data=percentile_data))
-
-            for _ in tqdm(as_completed(futures), total=len(hash_percentile_dict)):
-                continue
+        request.http_upload_in_chunks(request.http_add_percentiles_bulk, percentile_data_list)
 
     def generate_graphs(self, hash_score_pairs, hash_percentile_dict, hash_sigma_score_dict):
         # Initialize all graphs/subplots
@@ -564,6 +586,8 @@ def parse_args():
     parser.add_argument('--dataset-name', required=True, help='Name of the dataset for embeddings')
     parser.add_argument('--generation-policy', required=False, default="all", help='Name of generation policy to get, default is all')
     parser.add_argument('--model-filename', required=True, help='Filename of the main model (e.g., "XXX..safetensors")')
+    parser.add_argument('--batch-size', required=False, default=DEFAULT_SCORING_BATCH_SIZE, type=int, help='Number of images scored per batch')
+    parser.add_argument('--rank-id', required=False, default=None, type=int, help='Rank id stored with the uploaded rank scores, needed to upload them')
     args = parser.parse_args()
     return args
 
@@ -571,13 +595,17 @@ def parse_args():
 def run_image_scorer(minio_client,
                      dataset_name,
                      model_filename,
-                     generation_policy):
+                     generation_policy,
+                     batch_size=DEFAULT_SCORING_BATCH_SIZE,
+                     rank_id=None):
     start_time = time.time()
 
     scorer = ImageScorer(minio_client=minio_client,
                          dataset_name=dataset_name,
                          model_name=model_filename,
-                         generation_policy=generation_policy)
+                         generation_policy=generation_policy,
+                         batch_size=batch_size,
+                         rank_id=rank_id)
 
     scorer.load_model()
     paths = scorer.get_paths()
@@ -592,7 +620,7 @@ def run_image_scorer(minio_client,
                                   image_paths=image_paths,
                                   features_data_job_uuid_dict=features_data_job_uuid_dict)
     scorer.generate_graphs(hash_score_pairs, hash_percentile_dict, hash_sigma_score_dict)
-    # scorer.upload_scores(hash_score_pairs)
+    # scorer.upload_scores(hash_score_pairs, hash_sigma_score_dict, job_uuids_hash_dict)
     # scorer.upload_percentile(hash_percentile_dict)
     # scorer.upload_sigma_scores(hash_sigma_score_dict)
 
@@ -611,7 +639,9 @@ def main():
         run_image_scorer(minio_client,
                          args.dataset_name,
                          args.model_filename,
-                         args.generation_policy)
+                         args.generation_policy,
+                         args.batch_size,
+                         args.rank_id)
     else:
         # if all, train models for all existing datasets
         # get dataset name list
@@ -622,7 +652,9 @@ def main():
                 run_image_scorer(minio_client,
                                  dataset,
                                  args.model_filename,
-                                 args.generation_policy)
+                                 args.generation_policy,
+                                 args.batch_size,
+                                 args.rank_id)
             except Exception as e:
                 print("Error running image scorer for {}: {}".format(dataset, e))
 
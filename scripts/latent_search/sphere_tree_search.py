@@ -28,6 +28,13 @@ from training_worker.scoring.models.classifier_fc import ClassifierFCNetwork
 from utility.minio import cmd
 from utility.http import request
 
+# sampled nodes scored in one batch when expanding the tree
+EXPANSION_BATCH_SIZE= 32768
+# hnsw graph of the approximate faiss index
+FAISS_HNSW_M= 32
+FAISS_HNSW_EF_SEARCH= 64
+INITIAL_NODE_CAPACITY= 1024
+
 def parse_args():
         parser = argparse.ArgumentParser()
 
@@ -52,9 +59,37 @@ def parse_args():
         parser.add_argument('--classifier-weight', type=float, default=0.5)
         parser.add_argument('--ranking-weight', type=float, default=0.5)
         parser.add_argument('--graph-tree', type=str, default=None)
+        parser.add_argument('--expansion-batch-size', type=int, help='Number of sampled nodes scored in one batch when expanding the tree', default=EXPANSION_BATCH_SIZE)
+        parser.add_argument('--faiss-index-type', type=str, help="flat or hnsw, defaults to flat on gpu and hnsw on cpu", default=None)
 
         return parser.parse_args()
 
+class TreeNodeBuffer:
+    # (capacity, dimension) tensor of the tree nodes, the capacity doubles when it's full
+    # so nodes are added without stacking the whole tree again
+    def __init__(self, dimension, device, initial_capacity=INITIAL_NODE_CAPACITY):
+        self.nodes= torch.zeros((initial_capacity, dimension), dtype=torch.float32, device=device)
+        self.num_nodes= 0
+
+    def __len__(self):
+        return self.num_nodes
+
+    def append(self, nodes):
+        num_nodes= self.num_nodes + nodes.size(0)
+        if num_nodes > self.nodes.size(0):
+            capacity= self.nodes.size(0)
+            while capacity < num_nodes:
+                capacity*= 2
+            new_nodes= torch.zeros((capacity, self.nodes.size(1)), dtype=self.nodes.dtype, device=self.nodes.device)
+            new_nodes[:self.num_nodes]= self.nodes[:self.num_nodes]
+            self.nodes= new_nodes
+
+        self.nodes[self.num_nodes:num_nodes]= nodes
+        self.num_nodes= num_nodes
+
+    def get_nodes(self):
+        return self.nodes[:self.num_nodes]
+
 class RapidlyExploringTreeSearch:
     def __init__(self,
                  minio_access_key,
@@ -71,7 +106,9 @@ class RapidlyExploringTreeSearch:
                  ranking_weight,
                  classifier_weight,
                  graph_tree,
-                 defect_tag=None):
+                 defect_tag=None,
+                 expansion_batch_size=EXPANSION_BATCH_SIZE,
+                 faiss_index_type=None):
         
         # parameters
         self.dataset= dataset  
@@ -86,6 +123,7 @@ class RapidlyExploringTreeSearch:
         self.ranking_weight= ranking_weight
         self.classifier_weight= classifier_weight
         self.graph_tree= graph_tree
+        self.expansion_batch_size= expansion_batch_size
         # get minio client
         self.minio_client = cmd.get_minio_client(minio_access_key=minio_access_key,
                                                 minio_secret_key=minio_secret_key)
@@ -97,6 +135,11 @@ class RapidlyExploringTreeSearch:
             device = 'cpu'
         self.device = torch.device(device)
 
+        # the exact index is only fast enough on gpu for large trees
+        if faiss_index_type is None:
+            faiss_index_type= "flat" if torch.cuda.is_available() else "hnsw"
+        self.faiss_index_type= faiss_index_type
+
         self.scoring_model= ScoringFCNetwork(minio_client=self.minio_client, dataset=dataset)
         self.scoring_model.load_model()
 
@@ -179,18 +222,25 @@ class RapidlyExploringTreeSearch:
         normalized_tensor = (scores - min_val) / (max_val - min_val)
         return normalized_tensor
 
-    def setup_faiss(self, all_nodes):
-        # Assuming all_nodes is a list of torch tensors (nodes)
-        dimension = all_nodes[0].size(0)
-        faiss_index = faiss.IndexFlatL2(dimension)
-        
-        if torch.cuda.is_available():
-            res = faiss.StandardGpuResources()
-            faiss_index = faiss.index_cpu_to_gpu(res, 0, faiss_index)
+    def min_max_normalize_rows(self, scores, mask):
+        # normalize the scores of each parent's children separately, only over the children in the mask
+        min_val = torch.where(mask, scores, torch.full_like(scores, float('inf'))).min(dim=1, keepdim=True).values
+        max_val = torch.where(mask, scores, torch.full_like(scores, -float('inf'))).max(dim=1, keepdim=True).values
+        normalized_tensor = (scores - min_val) / (max_val - min_val)
+        return normalized_tensor
 
-        # Convert all_nodes to a contiguous array of float32, required by FAISS
-        node_matrix = torch.stack(all_nodes).cpu().numpy().astype('float32')
-        faiss_index.add(node_matrix)
+    def setup_faiss(self, dimension):
+        # empty index, nodes are added to it as they're accepted
+        if self.faiss_index_type=="hnsw":
+            # approximate nearest node, searches stay fast on cpu with 100k+ nodes
+            faiss_index = faiss.IndexHNSWFlat(dimension, FAISS_HNSW_M)
+            faiss_index.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+        else:
+            faiss_index = faiss.IndexFlatL2(dimension)
+        
+            if torch.cuda.is_available():
+                res = faiss.StandardGpuResources()
+                faiss_index = faiss.index_cpu_to_gpu(res, 0, faiss_index)
 
         return faiss_index
 
@@ -201,24 +251,22 @@ class RapidlyExploringTreeSearch:
         distances, indices = faiss_index.search(nodes, 1)  # Find the nearest node
         return distances
 
-    def find_nearest_points(self, point, num_samples, covariance_matrix):
-        # Sampling from a multivariate Gaussian distribution
-        distribution = torch.distributions.MultivariateNormal(point, covariance_matrix)
-        clip_vectors = distribution.sample((num_samples,))
-        clip_vectors = torch.clamp(clip_vectors, self.clip_min, self.clip_max).to(self.device)
+    def sample_children(self, parents, num_samples, std):
+        # num_samples children per parent in one draw: parent + std * eps,
+        # the same gaussian as a multivariate normal with a diagonal covariance of std^2
+        eps = torch.randn((parents.size(0), num_samples, parents.size(1)), dtype=torch.float32, device=self.device)
+        clip_vectors = parents.unsqueeze(1) + std * eps
+        clip_vectors = torch.clamp(clip_vectors, self.clip_min, self.clip_max)
 
         return clip_vectors
 
-    def filter_defects(self, points, defect_threshold=0.6):
+    def get_defect_mask(self, points, defect_threshold=0.6):
+        # true for the points that aren't defective
         points= points.to(device=self.device)
         # get defect scores
-        scores= self.defect_model.predict(points, batch_size=points.size(0)).squeeze(1)
-        # filter for indices of elements that aren't defective
-        filtered_indices= torch.where(scores<defect_threshold)[0]
-        # filter datapoints
-        filtered_points= points[filtered_indices]
+        scores= self.defect_model.predict(points, batch_size=self.expansion_batch_size).squeeze(1)
 
-        return filtered_points
+        return scores<defect_threshold
 
     def score_points(self, points):
         points= points.to(device=self.device)
@@ -229,125 +277,179 @@ class RapidlyExploringTreeSearch:
         points= points.to(device=self.device)
         scores= self.classifier_model.predict(points, batch_size=points.size(0))
         return scores
+
+    def predict_masked(self, predict, points, mask):
+        # scores of the points in the mask, nan for the others
+        scores = torch.full((points.size(0),), float('nan'), dtype=torch.float32, device=self.device)
+        if mask.any():
+            scores[mask] = predict(points[mask]).squeeze(1).float()
+
+        return scores
     
-    def rank_points_by_distance(self, nodes, faiss_index):
+    def rank_points_by_distance(self, nodes, mask, faiss_index):
+        # nodes are (parents, children, dimension), mask is false for the filtered children
+        num_parents, num_children, dimension = nodes.size()
+        flat_nodes = nodes.reshape(-1, dimension)
+        flat_mask = mask.reshape(-1)
+
         # calculate ranking and classifier scores
-        classifier_scores = self.classifiy_points(nodes).squeeze(1)
-        ranking_scores = self.score_points(nodes).squeeze(1)
+        classifier_scores = self.predict_masked(self.classifiy_points, flat_nodes, flat_mask).reshape(num_parents, num_children)
+        ranking_scores = self.predict_masked(self.score_points, flat_nodes, flat_mask).reshape(num_parents, num_children)
 
         # increase classifier scores with a threshold
         classifier_scores= torch.where(classifier_scores>0.6, torch.tensor(1), classifier_scores)
 
         # rank by distance and quality
-        quality_ranks= self.min_max_normalize_scores(ranking_scores)
-        distances = self.compute_distances(faiss_index, nodes)
-        distances = torch.tensor(distances.squeeze()).to(device= self.device)
-        distance_ranks= self.min_max_normalize_scores(distances)
+        quality_ranks= self.min_max_normalize_rows(ranking_scores, mask)
+        distances = self.compute_distances(faiss_index, flat_nodes)
+        distances = torch.tensor(distances).to(device= self.device).reshape(num_parents, num_children)
+        distance_ranks= self.min_max_normalize_rows(distances, mask)
 
         ranks= quality_ranks + distance_ranks
 
         return ranks, classifier_scores, ranking_scores
 
-    def rank_points_by_quality(self, nodes):
+    def rank_points_by_quality(self, nodes, mask):
+        # nodes are (parents, children, dimension), mask is false for the filtered children
+        num_parents, num_children, dimension = nodes.size()
+        flat_nodes = nodes.reshape(-1, dimension)
+        flat_mask = mask.reshape(-1)
+
         # calculate ranking and classifier scores
         classifier_scores= None
         ranking_scores= None
         
         if self.classifier_weight!=0:
-            classifier_scores = self.classifiy_points(nodes).squeeze(1)
+            classifier_scores = self.predict_masked(self.classifiy_points, flat_nodes, flat_mask).reshape(num_parents, num_children)
             # increase classifier scores with a threshold
             classifier_scores= torch.where(classifier_scores>0.6, torch.tensor(1), classifier_scores)
         if self.ranking_weight!=0:
-            ranking_scores = self.score_points(nodes).squeeze(1)
+            ranking_scores = self.predict_masked(self.score_points, flat_nodes, flat_mask).reshape(num_parents, num_children)
 
         # combine scores
         if self.ranking_weight!=0 and self.classifier_weight!=0:
-            classifier_ranks= self.classifier_weight * self.min_max_normalize_scores(classifier_scores) 
-            quality_ranks= self.ranking_weight * self.min_max_normalize_scores(ranking_scores)
+            classifier_ranks= self.classifier_weight * self.min_max_normalize_rows(classifier_scores, mask) 
+            quality_ranks= self.ranking_weight * self.min_max_normalize_rows(ranking_scores, mask)
             ranks= classifier_ranks + quality_ranks
         elif self.ranking_weight!=0:
-            quality_ranks= self.min_max_normalize_scores(ranking_scores)
+            quality_ranks= self.min_max_normalize_rows(ranking_scores, mask)
             ranks= quality_ranks
         elif self.classifier_weight!=0:
-            classifier_ranks= self.min_max_normalize_scores(classifier_scores)
-            ranks= quality_ranks
+            classifier_ranks= self.min_max_normalize_rows(classifier_scores, mask)
+            ranks= classifier_ranks
 
         return ranks, classifier_scores, ranking_scores 
 
+    def expand_nodes(self, parents, nodes_per_iteration, branches_per_iteration, std, faiss_index):
+        # samples and scores the children of a batch of parents at once,
+        # returns the top branches_per_iteration children of each parent, in parent order
+        children = self.sample_children(parents, nodes_per_iteration, std)
+
+        # filter defective points
+        if self.defect_model:
+            mask = self.get_defect_mask(children.reshape(-1, children.size(2))).reshape(children.size(0), children.size(1))
+        else:
+            mask = torch.ones(children.size()[:2], dtype=torch.bool, device=self.device)
+
+        # score these points
+        if self.sampling_policy == "rapidly_exploring_tree_search":
+            ranks, classifier_scores, ranking_scores = self.rank_points_by_distance(children, mask, faiss_index)
+        elif self.sampling_policy == "jump_point_tree_search":
+            ranks, classifier_scores, ranking_scores = self.rank_points_by_quality(children, mask)
+
+        # select the top n children of each parent, filtered children are never selected
+        ranks = torch.where(mask, ranks, torch.full_like(ranks, -float('inf')))
+        num_branches = min(branches_per_iteration, nodes_per_iteration)
+        _, top_indices = torch.topk(ranks, num_branches, dim=1)
+        parent_indices = torch.arange(children.size(0), device=self.device).unsqueeze(1)
+        selected = mask[parent_indices, top_indices].reshape(-1)
+
+        top_points = children[parent_indices, top_indices].reshape(-1, children.size(2))[selected]
+        top_classifier_scores= None
+        top_ranking_scores= None
+        if self.classifier_weight!=0:
+            top_classifier_scores = classifier_scores[parent_indices, top_indices].reshape(-1)[selected]
+            top_classifier_scores= torch.where(top_classifier_scores>0.6, torch.tensor(1), top_classifier_scores)
+        if self.ranking_weight!=0:
+            top_ranking_scores = ranking_scores[parent_indices, top_indices].reshape(-1)[selected]
+
+        return top_points, top_classifier_scores, top_ranking_scores
+
     def expand_tree(self, nodes_per_iteration, branches_per_iteration, max_nodes, top_k, jump_distance, num_images):
-        current_generation = [self.clip_mean.squeeze()]
-        all_nodes = [self.clip_mean.squeeze()]
+        root = self.clip_mean.squeeze(0)
+        current_generation = root.unsqueeze(0)
+        all_nodes = TreeNodeBuffer(root.size(0), self.device)
+        all_nodes.append(current_generation)
         if self.sampling_policy=="rapidly_exploring_tree_search":
-            faiss_index = self.setup_faiss(all_nodes)
+            faiss_index = self.setup_faiss(root.size(0))
+            faiss_index.add(current_generation.cpu().numpy().astype('float32'))
+        else:
+            faiss_index = None
 
         all_classifier_scores = torch.tensor([], dtype=torch.float32, device=self.device)
         all_ranking_scores = torch.tensor([], dtype=torch.float32, device=self.device)
 
-        # generate covariance matrix
-        covariance_matrix = torch.diag((self.clip_std.pow(2) * jump_distance).squeeze(0))
+        # standard deviation of the jumps, the covariance matrix is diag(std^2 * jump distance)
+        std = self.clip_std * math.sqrt(jump_distance)
+        # parents expanded in one batch
+        parents_per_batch = max(1, self.expansion_batch_size // nodes_per_iteration)
         
         # Initialize tqdm
         pbar = tqdm(total=max_nodes)
         nodes=0
-        while(nodes < max_nodes):
+        while(nodes < max_nodes and len(current_generation) > 0):
             next_generation = []
             
-            for point in current_generation:
-                # Find nearest k points to the current point
-                nearest_points = self.find_nearest_points(point, nodes_per_iteration, covariance_matrix)
-                # Filter defective points
-                if self.defect_model:
-                    nearest_points= self.filter_defects(nearest_points)
-                    # skip if all nearest points are defective
-                    if len(nearest_points)==0:
-                        continue
-
-                # Score these points
-                if self.sampling_policy == "rapidly_exploring_tree_search":
-                    ranks, classifier_scores, ranking_scores = self.rank_points_by_distance(nearest_points, faiss_index)
-                elif self.sampling_policy == "jump_point_tree_search":
-                    ranks, classifier_scores, ranking_scores = self.rank_points_by_quality(nearest_points)
-
-                # Select top n points based on scores
-                _, sorted_indices = torch.sort(ranks, descending=True)
-                top_points = nearest_points[sorted_indices[:branches_per_iteration]]
+            for start in range(0, len(current_generation), parents_per_batch):
+                # don't expand more parents than needed to reach max nodes
+                num_parents = min(parents_per_batch, math.ceil((max_nodes - nodes) / nodes_per_iteration))
+                parents = current_generation[start:start + num_parents]
+
+                top_points, top_classifier_scores, top_ranking_scores = self.expand_nodes(parents,
+                                                                                          nodes_per_iteration,
+                                                                                          branches_per_iteration,
+                                                                                          std,
+                                                                                          faiss_index)
                 if self.classifier_weight!=0:
-                    top_classifier_scores = classifier_scores[sorted_indices[:branches_per_iteration]]
-                    top_classifier_scores= torch.where(top_classifier_scores>0.6, torch.tensor(1), top_classifier_scores)
                     all_classifier_scores = torch.cat((all_classifier_scores, top_classifier_scores), dim=0)
                 if self.ranking_weight!=0:   
-                    top_ranking_scores = ranking_scores[sorted_indices[:branches_per_iteration]]
                     all_ranking_scores = torch.cat((all_ranking_scores, top_ranking_scores), dim=0)
 
                 # Keep track of all nodes and their scores for selection later
-                all_nodes.extend(top_points)
+                all_nodes.append(top_points)
 
-                next_generation.extend(top_points)
-                nodes+= nodes_per_iteration
-                pbar.update(nodes_per_iteration)
-                if nodes > max_nodes:
-                    break
+                next_generation.append(top_points)
+                nodes+= len(parents) * nodes_per_iteration
+                pbar.update(len(parents) * nodes_per_iteration)
 
                 # add selected points to the index
-                current_nodes=top_points.cpu().numpy().astype('float32')
                 if self.sampling_policy=="rapidly_exploring_tree_search":
-                    faiss_index.add(current_nodes) 
+                    faiss_index.add(top_points.cpu().numpy().astype('float32')) 
+
+                if nodes >= max_nodes:
+                    break
             
             # Prepare for the next iteration
-            current_generation = next_generation
+            if len(next_generation) == 0:
+                break
+            current_generation = torch.cat(next_generation, dim=0)
         
         # Close the progress bar when done
         pbar.close()
 
+        # the root has no scores, the scores are of the nodes after it
+        tree_nodes= all_nodes.get_nodes()
+        scored_nodes= tree_nodes[1:]
+
         # graph tree
         if self.graph_tree=="topic":
-            labels= self.label_nodes_by_topic(all_nodes)
-            self.graph_datapoints(all_nodes, labels)
+            labels= self.label_nodes_by_topic(tree_nodes)
+            self.graph_datapoints(tree_nodes, labels)
         
         # graph tree
         elif self.graph_tree=="quality":
-            labels= self.label_nodes_by_quality(all_nodes, all_ranking_scores)
-            self.graph_datapoints(all_nodes, labels)
+            labels= self.label_nodes_by_quality(scored_nodes, all_ranking_scores)
+            self.graph_datapoints(scored_nodes, labels)
         
         # After the final iteration, choose the top n highest scoring points overall
         if self.classifier_weight!=0:
@@ -363,7 +465,7 @@ class RapidlyExploringTreeSearch:
             all_ranks= quality_ranks
     
         values, sorted_indices = torch.sort(all_ranks, descending=True)
-        final_top_points = torch.stack(all_nodes, dim=0)[sorted_indices[:int(num_images/top_k)]]
+        final_top_points = scored_nodes[sorted_indices[:int(num_images/top_k)]]
 
         # select n random spheres from the top k spheres
         indices = torch.randperm(final_top_points.size(0))[:num_images]
@@ -406,7 +508,7 @@ class RapidlyExploringTreeSearch:
 
         for start_index in range(0, num_nodes, self.batch_size):
             end_index = min(start_index + self.batch_size, num_nodes)
-            nodes = torch.stack(tree[start_index:end_index]).to(device=self.device)
+            nodes = tree[start_index:end_index].to(device=self.device)
 
             max_scores = torch.full((nodes.size(0),), fill_value=-float('inf'), dtype=torch.float32)
             max_labels = ["undefined"] * nodes.size(0)  # Initialize with 'undefined'
@@ -430,10 +532,7 @@ class RapidlyExploringTreeSearch:
         minio_path = f"{self.dataset}/output/tree_search/{self.sampling_policy}_by_{self.graph_tree}_graph.gif"
         reducer = umap.UMAP(random_state=42)
 
-        tree.append(self.clip_min.squeeze(0))
-        tree.append(self.clip_max.squeeze(0))
-
-        tree = torch.stack(tree).cpu().numpy()
+        tree = torch.cat([tree, self.clip_min, self.clip_max], dim=0).cpu().numpy()
         umap_embeddings = reducer.fit_transform(tree)
 
         min_x, min_y= np.min(umap_embeddings[:,0], axis=0) , np.min(umap_embeddings[:,1], axis=0)
@@ -597,7 +696,9 @@ def main():
                                         ranking_weight= args.ranking_weight,
                                         classifier_weight= args.classifier_weight,
                                         graph_tree= args.graph_tree,
-                                        defect_tag= args.defect_tag)
+                                        defect_tag= args.defect_tag,
+                                        expansion_batch_size= args.expansion_batch_size,
+                                        faiss_index_type= args.faiss_index_type)
 
     generator.generate_images(nodes_per_iteration=args.nodes_per_iteration,
                           branches_per_iteration=args.branches_per_iteration,
@@ -7,7 +7,7 @@ sys.path.insert(0, base_directory)
 from utility.http import request
 from utility.minio import cmd
 from utility.boltzman.boltzman_phrase_scores_loader import BoltzmanPhraseScoresLoader
-from utility.gibs_sampling.gibs_sampling import generate_prompts
+from utility.gibs_sampling.gibs_sampling import generate_prompts, DEFAULT_GIBS_NUM_SWEEPS
 
 
 def run_prompt_generator(minio_client,
@@ -17,6 +17,7 @@ def run_prompt_generator(minio_client,
                          prompt_count,
                          gibs_temperature,
                          gibs_k,
+                         gibs_num_sweeps=DEFAULT_GIBS_NUM_SWEEPS,
                          ):
     positive_phrase_scores_loader = BoltzmanPhraseScoresLoader(dataset_name=dataset_name,
                                                        phrase_scores_csv=positive_phrase_scores_csv,
@@ -39,7 +40,8 @@ def run_prompt_generator(minio_client,
                      negative_phrase_scores_loader,
                      prompt_count,
                      gibs_temperature,
-                     gibs_k)
+                     gibs_k,
+                     gibs_num_sweeps)
 
 
 def parse_args():
@@ -53,6 +55,7 @@ def parse_args():
     parser.add_argument('--prompt-count', required=True, type=int, help='Number of prompt jobs to generate')
     parser.add_argument('--gibs-k', default=1.0, type=float, help='K for gibs probability')
     parser.add_argument('--gibs-temperature', default=8, type=float, help='Temperature for gibs probability')
+    parser.add_argument('--gibs-num-sweeps', default=DEFAULT_GIBS_NUM_SWEEPS, type=int, help='Number of gibs sampling sweeps over the prompts')
     args = parser.parse_args()
     return args
 
@@ -71,7 +74,8 @@ def main():
                              args.negative_phrase_scores_csv,
                              args.prompt_count,
                              args.gibs_temperature,
-                             args.gibs_k)
+                             args.gibs_k,
+                             args.gibs_num_sweeps)
     else:
         # if all, do for all existing datasets
         # get dataset name list
@@ -85,7 +89,8 @@ def main():
                                      args.negative_phrase_scores_csv,
                                      args.prompt_count,
                                      args.gibs_temperature,
-                                     args.gibs_k)
+                                     args.gibs_k,
+                                     args.gibs_num_sweeps)
             except Exception as e:
                 print("Error running prompt generator for {}: {}".format(dataset, e))
 
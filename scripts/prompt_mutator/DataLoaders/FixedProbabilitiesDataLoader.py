@@ -4,6 +4,7 @@ import numpy as np
 
 import pandas as pd
 from data_loader.phrase_embedding_loader import PhraseEmbeddingLoader
+from data_loader.phrase_token_length_table import load_phrase_token_length_table
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
@@ -26,6 +27,7 @@ class FixedProbabilitiesDataLoader:
         self.text_encoder= text_encoder
         self.phrase_list=[]
         self.token_length_dict={}
+        self.token_length_table=None
         self.embedding_dict={}
 
         self.minio_access_key = minio_access_key
@@ -50,6 +52,14 @@ class FixedProbabilitiesDataLoader:
         for index, phrase in enumerate(self.phrase_list):
             self.token_length_dict[phrase]= phrase_token_lengths[index]
             self.embedding_dict[phrase]= phrase_embeddings[index]
+
+        # token lengths table of the phrases, for sampling phrases within a token budget
+        tokenizer= self.text_encoder.tokenizer if self.text_encoder is not None else None
+        self.token_length_table= load_phrase_token_length_table(self.minio_client,
+                                                                self.dataset_name,
+                                                                self.phrase_list,
+                                                                tokenizer=tokenizer,
+                                                                known_token_lengths=self.token_length_dict)
     
     # get civitai phrase embeddings from minIO
     def load_phrase_embeddings(self):
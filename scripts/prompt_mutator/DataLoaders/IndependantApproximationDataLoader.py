@@ -1,5 +1,6 @@
 import sys
 from data_loader.phrase_embedding_loader import PhraseEmbeddingLoader
+from data_loader.phrase_token_length_table import load_phrase_token_length_table
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
@@ -21,6 +22,7 @@ class IndependantApproximationDataLoader:
         self.text_encoder= text_encoder
         self.phrase_list=[]
         self.token_length_dict={}
+        self.token_length_table=None
         self.phrase_embedding_loader=None
 
         self.minio_access_key = minio_access_key
@@ -43,6 +45,14 @@ class IndependantApproximationDataLoader:
         # create dictionarries for phrase token lengths and embeddings
         for index, phrase in enumerate(self.phrase_list):
             self.token_length_dict[phrase]= phrase_loader.get_token_size(index)
+
+        # token lengths table of the phrases, for sampling phrases within a token budget
+        tokenizer= self.text_encoder.tokenizer if self.text_encoder is not None else None
+        self.token_length_table= load_phrase_token_length_table(self.minio_client,
+                                                                self.dataset_name,
+                                                                self.phrase_list,
+                                                                tokenizer=tokenizer,
+                                                                known_token_lengths=self.token_length_dict)
         
         # get embeddings of the phrases
         self.phrase_embedding_loader= PhraseEmbeddingLoader(dataset_name=self.dataset_name,
@@ -57,7 +67,10 @@ class IndependantApproximationDataLoader:
         if self.token_length_dict.get(phrase) is not None:
             return self.token_length_dict[phrase]
         else:
-            return self.compute_token_length(phrase)
+            # kept so the phrase isn't tokenized again
+            token_length= self.compute_token_length(phrase)
+            self.token_length_dict[phrase]= token_length
+            return token_length
     
     def compute_token_length(self, phrase:str):
         # Tokenize the phrase
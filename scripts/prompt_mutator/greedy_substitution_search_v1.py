@@ -22,9 +22,11 @@ from utility.ensemble.ensemble_helpers import Binning, SigmaScoresWithEntropy
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel
 from stable_diffusion.model.clip_text_embedder.clip_text_embedder import CLIPTextEmbedder
+from utility.clip.text_embedding_cache import TextEmbeddingCache, DEFAULT_MAX_DISK_ROWS
 from prompt_job_generator.independent_approx_v1.independent_approx_v1 import IndependentApproxV1
 from utility.boltzman.boltzman_phrase_scores_loader import BoltzmanPhraseScoresLoader
 from data_loader.phrase_embedding_loader import PhraseEmbeddingLoader
+from data_loader.phrase_token_length_table import compute_token_lengths
 from utility.boltzman.boltzman import find_first_element_binary_search, get_cumulative_probability_arr_without_upload
 from utility.minio import cmd
 from utility.http import request
@@ -62,6 +64,9 @@ def parse_args():
     parser.add_argument('--num_choices', type=int, help="Number of substituion choices tested every iteration", default=128)
     parser.add_argument('--clip-batch-size', type=int, help="Batch size for clip embeddings", default=256)
     parser.add_argument('--substitution-batch-size', type=int, help="Batch size for the substitution model", default=10000)
+    parser.add_argument('--candidates-per-round', type=int, help="Number of substitution choices of each prompt evaluated in a batch when mutating, 0 for all of them", default=16)
+    parser.add_argument('--text-embedding-cache-directory', help="Directory where the prompt embeddings are kept between runs, by default they are only cached in memory", default=None)
+    parser.add_argument('--text-embedding-cache-max-rows', type=int, help="Maximum number of prompt embeddings kept in the cache directory, it is cleared when full", default=DEFAULT_MAX_DISK_ROWS)
 
     return parser.parse_args()
 
@@ -108,7 +113,10 @@ class PromptSubstitutionGenerator:
         top_k,
         num_choices_per_iteration,
         clip_batch_size,
-        substitution_batch_size
+        substitution_batch_size,
+        text_embedding_cache_directory=None,
+        text_embedding_cache_max_rows=DEFAULT_MAX_DISK_ROWS,
+        candidates_per_round=16
     ):
         start=time.time()
 
@@ -150,6 +158,8 @@ class PromptSubstitutionGenerator:
         self.clip_batch_size= clip_batch_size
         # batch size for xgboost inference
         self.substitution_batch_size=substitution_batch_size
+        # number of substitution choices of each prompt evaluated in a batch, 0 for all of them at once
+        self.candidates_per_round= candidates_per_round
 
         # get minio client
         self.minio_client = cmd.get_minio_client(minio_access_key,
@@ -166,6 +176,12 @@ class PromptSubstitutionGenerator:
         # Load the clip embedder model
         self.embedder=CLIPTextEmbedder(device=device)
         self.embedder.load_submodels()
+        # mean pooled prompt embeddings, prompts seen in previous iterations or runs aren't encoded again
+        self.text_embedding_cache= TextEmbeddingCache(self.embedder,
+                                                      pooling_strategy='AVERAGE_POOLING',
+                                                      batch_size=self.clip_batch_size,
+                                                      directory=text_embedding_cache_directory,
+                                                      max_disk_rows=text_embedding_cache_max_rows)
 
         # load the scoring models (for positive prompts and for both)
         self.positive_scorer= self.load_model(embedding_type='positive', scoring_model=self.scoring_model)
@@ -227,8 +243,10 @@ class PromptSubstitutionGenerator:
         # get base prompt list
         base_prompts = load_base_prompts(self.csv_base_prompts)
         # create a dictionarry for base prompts
-        self.base_prompt_embeddings={phrase: self.get_mean_pooled_embedding(self.get_prompt_embedding(phrase)) for phrase in base_prompts}
-        self.base_prompt_token_lengths={phrase: self.get_token_length(phrase) for phrase in base_prompts}
+        base_prompt_embeddings= self.text_embedding_cache.embed_many(base_prompts)
+        self.base_prompt_embeddings={phrase: embedding for phrase, embedding in zip(base_prompts, base_prompt_embeddings)}
+        base_prompt_token_lengths= compute_token_lengths(self.embedder.tokenizer, base_prompts)
+        self.base_prompt_token_lengths={phrase: int(token_length) for phrase, token_length in zip(base_prompts, base_prompt_token_lengths)}
 
         end=time.time()
         # log time taken for each step
@@ -335,6 +353,33 @@ class PromptSubstitutionGenerator:
 
         return variance_score
 
+    # get sigma scores of the ensemble models for a batch of embeddings, (number of models, batch size)
+    def get_ensemble_sigma_scores_batch(self, positive_embeddings, negative_embeddings):
+        # same input as predict_pooled_embeddings: positive and negative embeddings concatenated
+        inputs= torch.cat([torch.from_numpy(positive_embeddings), torch.from_numpy(negative_embeddings)], dim=1).to(self.device)
+
+        sigma_scores=[]
+        for model in self.ensemble_models:
+            mean=float(model.mean)
+            std=float(model.standard_deviation)
+            with torch.no_grad():
+                scores=model.model.forward(inputs).reshape(-1).cpu().numpy()
+
+            sigma_scores.append((scores - mean) / std)
+
+        return np.stack(sigma_scores)
+
+    # get combined quality scores and variances of a batch of embeddings
+    def get_variance_scores(self, positive_embeddings, negative_embeddings, scores):
+
+        if(self.variance_weight==0 or len(self.ensemble_models)==0):
+            return scores
+
+        sigma_scores=self.get_ensemble_sigma_scores_batch(positive_embeddings, negative_embeddings)
+        variances= np.var(sigma_scores, axis=0)
+
+        return scores + (self.variance_weight * variances)
+
     # load elm or linear scoring models
     def load_model(self, embedding_type, scoring_model="linear", input_size=768):
         input_path=f"{self.model_dataset}/models/ranking/"
@@ -418,6 +463,15 @@ class PromptSubstitutionGenerator:
         
         return prompt_score.item()
     
+    # get linear or elm positive scores of a batch of embeddings
+    def get_positive_scores(self, embeddings):
+        embeddings= torch.from_numpy(embeddings).to(self.device)
+
+        with torch.no_grad():
+            prompt_scores=self.positive_scorer.predict_positive_or_negative_only_pooled(embeddings)
+
+        return prompt_scores.reshape(-1).cpu().numpy()
+    
     # get linear or elm score of an embedding
     def get_combined_score(self, positive_embedding, negative_embedding):
         # convert embeddings to tensors
@@ -449,14 +503,19 @@ class PromptSubstitutionGenerator:
     
     # function to get a random phrase from civitai with a max token size for substitutions
     def choose_random_phrase(self, max_token_length):
-        phrase_token_length=max_token_length + 1
+        phrase_indices= self.choose_random_phrase_indices([max_token_length])
+        random_index= int(phrase_indices[0])
 
-        while(phrase_token_length > max_token_length):
-            random_index=random.randrange(0, len(self.phrase_list))
-            phrase= self.phrase_list[random_index]
-            phrase_token_length=self.data_loader.get_token_length(phrase)
+        return random_index, self.phrase_list[random_index]
 
-        return random_index, phrase
+    # get random phrase indices from the token lengths table, one per max token size
+    def choose_random_phrase_indices(self, max_token_lengths):
+        token_length_table= self.data_loader.token_length_table
+        # phrases shorter than every phrase of the corpus are substituted with one of the shortest ones
+        min_token_length= int(token_length_table.token_lengths.min())
+        max_token_lengths= np.maximum(np.asarray(max_token_lengths), min_token_length)
+
+        return token_length_table.sample_indices(max_token_lengths)
 
     # rejection sampling function
     def rejection_sampling(self, prompts):
@@ -474,19 +533,21 @@ class PromptSubstitutionGenerator:
             prompt_list = prompt.positive_prompt.split(', ')
             num_phrases= len(prompt_list)
 
+            # choose the substituted positions and get a random phrase from civitai for each of them,
+            # no longer than the substituted phrase
+            phrase_positions= np.random.randint(0, num_phrases, size=num_choices)
+            substituted_phrase_lengths= np.asarray(prompt.positive_phrase_token_lengths)[phrase_positions]
+            phrase_indices= self.choose_random_phrase_indices(substituted_phrase_lengths)
+
             # create a substitution for each position in the prompt
             for i in range(num_choices):
-                phrase_position= random.randint(0, num_phrases - 1)
-                # get the substituted phrase token length
-                substituted_phrase_length=prompt.positive_phrase_token_lengths[phrase_position]
+                phrase_position= int(phrase_positions[i])
                 # get the substituted phrase embedding
                 substituted_embedding = prompt.positive_phrase_embeddings[phrase_position]
-                # get a random phrase from civitai to substitute with
-                phrase_index, random_phrase= self.choose_random_phrase(max_token_length=substituted_phrase_length)   
                 # get phrase string
-                substitute_phrase = random_phrase
+                substitute_phrase = self.phrase_list[phrase_indices[i]]
                 # get phrase embedding by its index
-                substitute_embedding = self.data_loader.get_phrase_embedding(random_phrase)
+                substitute_embedding = self.data_loader.get_phrase_embedding(substitute_phrase)
                 # concatenate input in one array to use for inference
                 substitution_input = np.concatenate([prompt.positive_embedding, substituted_embedding, 
                                                      substitute_embedding, [phrase_position], [prompt.positive_score]])
@@ -539,6 +600,25 @@ class PromptSubstitutionGenerator:
         
         return prompts_substitution_choices
 
+    # builds the modified prompts of a list of substitutions and scores them in batches
+    def score_substitutions(self, prompts, candidates):
+        # candidates are (prompt index, substitution data) pairs
+        modified_prompt_strs=[]
+        for prompt_index, substitution in candidates:
+            prompt_list = prompts[prompt_index].positive_prompt.split(', ')
+            prompt_list[substitution['position']] = substitution['substitute_phrase']
+            modified_prompt_strs.append(", ".join(prompt_list))
+
+        # embeddings of every modified prompt in one call, only the new ones are encoded
+        positive_embeddings= self.text_embedding_cache.embed_many(modified_prompt_strs)
+        negative_embeddings= np.stack([prompts[prompt_index].negative_embedding for prompt_index, _ in candidates]).astype(np.float32)
+
+        positive_scores= self.get_positive_scores(positive_embeddings)
+        positive_scores= (positive_scores - self.positive_mean) / self.positive_std
+        variance_scores= self.get_variance_scores(positive_embeddings, negative_embeddings, positive_scores)
+
+        return modified_prompt_strs, positive_embeddings, positive_scores, variance_scores
+
     # function to mutate prompts
     def mutate_prompts(self, prompts):
         start= time.time()
@@ -554,65 +634,80 @@ class PromptSubstitutionGenerator:
             prompt_substitutions=self.rejection_sampling(prompts)
 
             print("Mutating prompts")
-            index=0
-            for substitution_choices in tqdm(prompt_substitutions):
-                for substitution in substitution_choices:
-                    # get substitution data
-                    position=substitution['position']
-                    substitute_phrase=substitution['substitute_phrase']
-                    substitute_embedding=substitution['substitute_embedding']
-                    substituted_embedding=substitution['substituted_embedding']
-                    predicted_score=substitution['score']
-
-                    #Create a modified prompt with the substitution
-                    prompt_list = prompts[index].positive_prompt.split(', ')
-                    prompt_list[position] = substitute_phrase
-                    modified_prompt_str = ", ".join(prompt_list)
-
-                    #calculate modified prompt embedding and sigma score
-                    modified_prompt_embedding=self.get_prompt_embedding(modified_prompt_str)
-                    modified_prompt_embedding=self.get_mean_pooled_embedding(modified_prompt_embedding)
-                    modified_prompt_score= self.get_positive_score(modified_prompt_embedding)
-                    modified_prompt_score= (modified_prompt_score - self.positive_mean) / self.positive_std
-
-                    # get variance score
-                    variance_score= self.get_variance_score(modified_prompt_embedding,
-                                                            prompts[index].negative_embedding,
-                                                            modified_prompt_score)
+            # the substitution choices of every prompt are evaluated from the highest predicted score,
+            # the first one that improves the prompt is kept.
+            # each round evaluates the next choices of all the prompts that didn't improve yet in one batch
+            next_choice=[0] * num_prompts
+            undecided_prompts=[index for index in range(num_prompts) if len(prompt_substitutions[index]) > 0]
+            while len(undecided_prompts) > 0:
+                candidates=[]
+                candidate_counts=[]
+                for index in undecided_prompts:
+                    if self.candidates_per_round > 0:
+                        choices= prompt_substitutions[index][next_choice[index]:next_choice[index] + self.candidates_per_round]
+                    else:
+                        choices= prompt_substitutions[index][next_choice[index]:]
+                    candidates.extend((index, substitution) for substitution in choices)
+                    candidate_counts.append(len(choices))
+
+                modified_prompt_strs, modified_prompt_embeddings, modified_prompt_scores, variance_scores= self.score_substitutions(prompts, candidates)
+
+                # (prompt, choice) matrix of the choices that improve the prompt
+                candidate_counts= np.array(candidate_counts)
+                candidate_offsets= np.concatenate([[0], np.cumsum(candidate_counts)[:-1]])
+                rows= np.repeat(np.arange(len(undecided_prompts)), candidate_counts)
+                columns= np.arange(len(candidates)) - np.repeat(candidate_offsets, candidate_counts)
+                current_variance_scores= np.array([prompts[index].variance_score for index in undecided_prompts])
+                improves= np.zeros((len(undecided_prompts), candidate_counts.max()), dtype=bool)
+                improves[rows, columns]= variance_scores > current_variance_scores[rows]
+
+                # argmax gives the first improving choice, the one the sequential search would stop at
+                has_improvement= improves.any(axis=1)
+                first_improvement= improves.argmax(axis=1)
+
+                next_undecided_prompts=[]
+                for row, index in enumerate(undecided_prompts):
+                    num_evaluated= first_improvement[row] + 1 if has_improvement[row] else candidate_counts[row]
 
                     if(self.self_training):
-                        # collect self training data
-                        data=np.concatenate((prompts[index].positive_embedding, 
-                                            substituted_embedding, 
-                                            substitute_embedding)).tolist(),
-                    
-                        prompt_data={
-                        'input': data[0],
-                        'position_encoding': position,
-                        'score_encoding': prompts[index].positive_prompt,
-                        'output': modified_prompt_score,
-                        'delta': abs(modified_prompt_score - predicted_score)
-                        }
-                        self_training_data.append(prompt_data)
+                        # collect self training data of the choices the sequential search would have evaluated
+                        for candidate_index in range(candidate_offsets[row], candidate_offsets[row] + num_evaluated):
+                            substitution= candidates[candidate_index][1]
+                            data=np.concatenate((prompts[index].positive_embedding, 
+                                                substitution['substituted_embedding'], 
+                                                substitution['substitute_embedding'])).tolist()
+
+                            prompt_data={
+                            'input': data,
+                            'position_encoding': substitution['position'],
+                            'score_encoding': prompts[index].positive_prompt,
+                            'output': float(modified_prompt_scores[candidate_index]),
+                            'delta': float(abs(modified_prompt_scores[candidate_index] - substitution['score']))
+                            }
+                            self_training_data.append(prompt_data)
+
+                    if has_improvement[row]:
+                        # the new prompt is saved and it jumps to the next iteration
+                        candidate_index= candidate_offsets[row] + first_improvement[row]
+                        substitution= candidates[candidate_index][1]
+                        prompts[index].positive_prompt= modified_prompt_strs[candidate_index]
+                        prompts[index].positive_embedding= modified_prompt_embeddings[candidate_index]
+                        prompts[index].positive_phrase_embeddings[substitution['position']]= substitution['substitute_embedding']
+                        # python floats, numpy floats can't be packed with msgpack
+                        prompts[index].positive_score= float(modified_prompt_scores[candidate_index])
+                        prompts[index].variance_score= float(variance_scores[candidate_index])
+                    else:
+                        next_choice[index]+= candidate_counts[row]
+                        if next_choice[index] < len(prompt_substitutions[index]):
+                            next_undecided_prompts.append(index)
+
+                undecided_prompts= next_undecided_prompts
 
-                    # check if score improves
-                    if(prompts[index].variance_score < variance_score):
-                        # if it does improve, the new prompt is saved and it jumps to the next iteration
-                        prompts[index].positive_prompt= modified_prompt_str
-                        prompts[index].positive_embedding= modified_prompt_embedding
-                        prompts[index].positive_phrase_embeddings[position]= substitute_embedding
-                        prompts[index].positive_score= modified_prompt_score
-                        prompts[index].variance_score= variance_score
-                        break
-                
-                # After handling each prompt, clear substitution_choices if it's not needed further
-                del substitution_choices
-
-                self.average_score_by_iteration[i]+=prompts[index].positive_score
-                index+=1
-            
             # Clear prompt_substitutions after processing all prompts
             del prompt_substitutions
+
+            for index in range(num_prompts):
+                self.average_score_by_iteration[i]+=prompts[index].positive_score
             
             # save average score for current iteration
             self.average_score_by_iteration[i]=self.average_score_by_iteration[i] / num_prompts
@@ -624,6 +719,7 @@ class PromptSubstitutionGenerator:
         end=time.time()
         self.mutation_time= end-start
         self.inference_speed= self.inference_speed / self.max_iterations
+        self.text_embedding_cache.print_stats()
 
         return prompts, self_training_data
 
@@ -788,8 +884,7 @@ class PromptSubstitutionGenerator:
                     modified_prompt_str = ", ".join(prompt_list)
 
                     #calculate modified prompt embedding and sigma score
-                    modified_prompt_embedding=self.get_prompt_embedding(modified_prompt_str)
-                    modified_prompt_embedding=self.get_mean_pooled_embedding(modified_prompt_embedding)
+                    modified_prompt_embedding=self.text_embedding_cache.embed(modified_prompt_str)
                     modified_prompt_score= self.get_positive_score(modified_prompt_embedding)
                     modified_prompt_score= (modified_prompt_score - self.positive_mean) / self.positive_std
 
@@ -966,8 +1061,8 @@ class PromptSubstitutionGenerator:
             negative_prompts = [p['negative_prompt'] for p in prompt_batch]
 
             # Compute token lengths for the batch
-            positive_token_lengths = [self.embedder.compute_token_length(prompt) for prompt in positive_prompts]
-            negative_token_lengths = [self.embedder.compute_token_length(prompt) for prompt in negative_prompts]
+            positive_token_lengths = compute_token_lengths(self.embedder.tokenizer, positive_prompts)
+            negative_token_lengths = compute_token_lengths(self.embedder.tokenizer, negative_prompts)
 
             # Filter out prompts with too many tokens
             valid_positive_indices = [i for i in range(len(positive_token_lengths)) if positive_token_lengths[i] <= 77 and negative_token_lengths[i] <= 77]
@@ -984,8 +1079,8 @@ class PromptSubstitutionGenerator:
 
             # Get embeddings for the batch
             start=time.time()
-            positive_embeddings = self.get_prompt_embedding(valid_positive_prompts)
-            negative_embeddings = self.get_prompt_embedding(valid_negative_prompts)
+            positive_embeddings = self.text_embedding_cache.embed_many(valid_positive_prompts)
+            negative_embeddings = self.text_embedding_cache.embed_many(valid_negative_prompts)
             end= time.time()
 
             clip_time+= end-start
@@ -996,8 +1091,8 @@ class PromptSubstitutionGenerator:
             # Normalize scores and calculate mean pooled embeddings for the batch
             for i, index in enumerate(valid_positive_indices):
                 # Mean pooling and other processing
-                positive_embedding = self.get_mean_pooled_embedding(positive_embeddings[i].unsqueeze(0))
-                negative_embedding = self.get_mean_pooled_embedding(negative_embeddings[i].unsqueeze(0))
+                positive_embedding = positive_embeddings[i]
+                negative_embedding = negative_embeddings[i]
                 
                 # calculate positive score and variance score
                 positive_score=self.get_positive_score(positive_embedding)
@@ -1069,8 +1164,8 @@ class PromptSubstitutionGenerator:
             negative_prompts = [p.negative_prompt_str for p in prompt_batch]
 
             # Compute token lengths for the batch
-            positive_token_lengths = [self.embedder.compute_token_length(prompt) for prompt in positive_prompts]
-            negative_token_lengths = [self.embedder.compute_token_length(prompt) for prompt in negative_prompts]
+            positive_token_lengths = compute_token_lengths(self.embedder.tokenizer, positive_prompts)
+            negative_token_lengths = compute_token_lengths(self.embedder.tokenizer, negative_prompts)
 
             # Filter out prompts with too many tokens
             valid_positive_indices = [i for i in range(len(positive_token_lengths)) if positive_token_lengths[i] <= 77 and negative_token_lengths[i] <= 77]
@@ -1087,8 +1182,8 @@ class PromptSubstitutionGenerator:
 
             # Get embeddings for the batch
             start=time.time()
-            positive_embeddings = self.get_prompt_embedding(valid_positive_prompts)
-            negative_embeddings = self.get_prompt_embedding(valid_negative_prompts)
+            positive_embeddings = self.text_embedding_cache.embed_many(valid_positive_prompts)
+            negative_embeddings = self.text_embedding_cache.embed_many(valid_negative_prompts)
             end= time.time()
 
             clip_time+= end-start
@@ -1099,8 +1194,8 @@ class PromptSubstitutionGenerator:
             # Normalize scores and calculate mean pooled embeddings for the batch
             for i, index in enumerate(valid_positive_indices):
                 # Mean pooling and other processing
-                positive_embedding = self.get_mean_pooled_embedding(positive_embeddings[i].unsqueeze(0))
-                negative_embedding = self.get_mean_pooled_embedding(negative_embeddings[i].unsqueeze(0))
+                positive_embedding = positive_embeddings[i]
+                negative_embedding = negative_embeddings[i]
                 
                 # calculate positive score and variance score
                 positive_score=self.get_positive_score(positive_embedding)
@@ -1372,7 +1467,10 @@ def main():
                                     top_k=args.top_k,
                                     num_choices_per_iteration=args.num_choices,
                                     clip_batch_size=args.clip_batch_size,
-                                    substitution_batch_size=args.substitution_batch_size)
+                                    substitution_batch_size=args.substitution_batch_size,
+                                    text_embedding_cache_directory=args.text_embedding_cache_directory,
+                                    text_embedding_cache_max_rows=args.text_embedding_cache_max_rows,
+                                    candidates_per_round=args.candidates_per_round)
         
         # generate n number of images
         prompt_mutator.generate_images(num_images=args.n_data)
@@ -1408,7 +1506,10 @@ def main():
                                                              top_k=args.top_k,
                                                              num_choices_per_iteration=args.num_choices,
                                                              clip_batch_size=args.clip_batch_size,
-                                                             substitution_batch_size=args.substitution_batch_size)
+                                                             substitution_batch_size=args.substitution_batch_size,
+                                                             text_embedding_cache_directory=args.text_embedding_cache_directory,
+                                                             text_embedding_cache_max_rows=args.text_embedding_cache_max_rows,
+                                                             candidates_per_round=args.candidates_per_round)
 
                 # generate n number of images
                 prompt_mutator.generate_images(num_images=args.n_data)
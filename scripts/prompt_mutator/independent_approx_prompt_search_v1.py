@@ -17,6 +17,7 @@ sys.path.insert(0, base_directory)
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel
 from stable_diffusion.model.clip_text_embedder.clip_text_embedder import CLIPTextEmbedder
+from utility.clip.text_embedding_cache import TextEmbeddingCache, DEFAULT_MAX_DISK_ROWS
 from utility.boltzman.boltzman_phrase_scores_loader import BoltzmanPhraseScoresLoader
 from utility.minio import cmd
 
@@ -41,6 +42,8 @@ def parse_args():
     parser.add_argument('--top-k', type=float, help="top percentage of prompts taken from generation to be mutated", default=0.1)
     parser.add_argument('--boltzman-temperature', type=int, default=64)
     parser.add_argument('--boltzman-k', type=float, default=1.0)
+    parser.add_argument('--text-embedding-cache-directory', help="Directory where the prompt embeddings are kept between runs, by default they are only cached in memory", default=None)
+    parser.add_argument('--text-embedding-cache-max-rows', type=int, help="Maximum number of prompt embeddings kept in the cache directory, it is cleared when full", default=DEFAULT_MAX_DISK_ROWS)
     parser.add_argument(
         '--csv_base_prompts', help='CSV containing base prompts', 
         default='input/dataset-config/environmental/base-prompts-environmental.csv'
@@ -63,7 +66,9 @@ class BoltzmanPromptSubstitutionGenerator:
         save_csv,
         top_k,
         boltzman_temperature,
-        boltzman_k
+        boltzman_k,
+        text_embedding_cache_directory=None,
+        text_embedding_cache_max_rows=DEFAULT_MAX_DISK_ROWS
     ):
         start=time.time()
 
@@ -107,6 +112,11 @@ class BoltzmanPromptSubstitutionGenerator:
         # Load the clip embedder model
         self.embedder=CLIPTextEmbedder(device=device)
         self.embedder.load_submodels()
+        # mean pooled prompt embeddings, prompts seen before aren't encoded again
+        self.text_embedding_cache= TextEmbeddingCache(self.embedder,
+                                                      pooling_strategy='AVERAGE_POOLING',
+                                                      directory=text_embedding_cache_directory,
+                                                      max_disk_rows=text_embedding_cache_max_rows)
 
         # load the scoring models (for positive prompts and for both)
         self.positive_scorer= self.load_model(embedding_type='positive', scoring_model=self.scoring_model)
@@ -194,30 +204,19 @@ class BoltzmanPromptSubstitutionGenerator:
         
         return positive_score_csv, negative_score_csv
 
-    # get the clip text embedding of a prompt or a phrase
+    # get the mean pooled clip text embedding of a prompt or a phrase
     def get_prompt_embedding(self, prompt):
-        with torch.no_grad():
-            embedding= self.embedder(prompt)
-
-        embedding= embedding.unsqueeze(0)
-        embedding=embedding.to(self.device)
+        embedding= self.text_embedding_cache.embed(prompt)
 
-        return embedding
+        return torch.from_numpy(embedding).to(self.device)
 
-    # get linear or elm score of an embedding
+    # get linear or elm score of a pooled embedding
     def get_prompt_score(self, embedding):
         with torch.no_grad():
-            prompt_score=self.positive_scorer.predict_positive_or_negative_only(embedding)
+            prompt_score=self.positive_scorer.predict_positive_or_negative_only_pooled(embedding.unsqueeze(0))
         
         return prompt_score.item()
 
-    # get the mean pool of an embedding
-    def get_mean_pooled_embedding(self, embedding):
-        embedding=torch.mean(embedding, dim=2)
-        embedding = embedding.reshape(len(embedding), -1).squeeze(0)
-
-        return embedding.detach().cpu().numpy()
-    
     # function to choose a random phrase under the max token length
     def choose_random_phrase(self, max_token_length):
         random_index=random.randrange(0, len(self.phrase_score_data))
@@ -380,7 +379,7 @@ class BoltzmanPromptSubstitutionGenerator:
                             prompt_score=positive_score)
 
             # calculating new score with the mutated positive prompt
-            score=self.scorer.predict(mutated_positive_embedding, negative_embedding).item()
+            score=self.scorer.predict_pooled_embeddings(mutated_positive_embedding, negative_embedding).item()
             sigma_score=(score - self.mean) / self.std
             # append to list of scores after mutation
             mutated_scores.append(sigma_score)
@@ -430,6 +429,7 @@ class BoltzmanPromptSubstitutionGenerator:
         end=time.time()
 
         print(f"time taken for {num_images} prompts is {end - start:.2f} seconds")
+        self.text_embedding_cache.print_stats()
 
         # logging speed of generation
         generation_speed= num_images/(end - start)
@@ -485,8 +485,8 @@ class BoltzmanPromptSubstitutionGenerator:
            
             # calculating combined score and positive score of prompt
             with torch.no_grad():
-                prompt_score=self.scorer.predict(positive_embedding, negative_embedding).item()
-                positive_score=self.positive_scorer.predict_positive_or_negative_only(positive_embedding).item()
+                prompt_score=self.scorer.predict_pooled_embeddings(positive_embedding, negative_embedding).item()
+                positive_score=self.get_prompt_score(positive_embedding)
 
             # storing prompt data
             prompt_data.append({
@@ -644,7 +644,9 @@ def main():
                                   save_csv=args.save_csv,
                                   top_k=args.top_k,
                                   boltzman_temperature=args.boltzman_temperature,
-                                  boltzman_k=args.boltzman_k)
+                                  boltzman_k=args.boltzman_k,
+                                  text_embedding_cache_directory=args.text_embedding_cache_directory,
+                                  text_embedding_cache_max_rows=args.text_embedding_cache_max_rows)
     
     # generate n number of images
     prompt_mutator.generate_images(num_images=args.n_data)
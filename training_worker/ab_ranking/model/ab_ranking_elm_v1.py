@@ -39,7 +39,8 @@ class ABRankingELMBaseModel(nn.Module):
 
     # for score
     def forward(self, x):
-        assert x.shape == (1, self.inputs_shape)
+        # (batch size, inputs shape), rows are scored independently
+        assert x.dim() == 2 and x.shape[1] == self.inputs_shape
 
         # go through random layers first
         for i in range(self.num_random_layers):
@@ -49,7 +50,7 @@ class ABRankingELMBaseModel(nn.Module):
         scaled_output = torch.multiply(output, self.scaling_factor)
 
 
-        assert scaled_output.shape == (1,1)
+        assert scaled_output.shape == (x.shape[0], 1)
         return scaled_output
 
     # TODO: add bias for the layers too
@@ -89,7 +90,8 @@ class ABRankingELMBaseModelDeprecate(nn.Module):
 
     # for score
     def forward(self, x):
-        assert x.shape == (1, self.inputs_shape)
+        # (batch size, inputs shape), rows are scored independently
+        assert x.dim() == 2 and x.shape[1] == self.inputs_shape
 
         # go through random layers first
         for i in range(self.num_random_layers):
@@ -97,7 +99,7 @@ class ABRankingELMBaseModelDeprecate(nn.Module):
 
         output = self.linear_last_layer(x)
 
-        assert output.shape == (1,1)
+        assert output.shape == (x.shape[0], 1)
         return output
 
     # TODO: add bias for the layers too
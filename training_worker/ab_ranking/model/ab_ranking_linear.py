@@ -36,15 +36,14 @@ class ABRankingLinearModel(nn.Module):
 
     # for score
     def forward(self, input):
-        # make sure input shape is (1, self.inputs_shape)
-        # we currently don't support batching
-        assert input.shape == (1, self.inputs_shape)
+        # make sure input shape is (batch size, self.inputs_shape)
+        assert input.dim() == 2 and input.shape[1] == self.inputs_shape
 
         output = self.linear(input)
         scaled_output = torch.multiply(output, self.scaling_factor)
 
-        # make sure input shape is (1, score)
-        assert scaled_output.shape == (1,1)
+        # make sure output shape is (batch size, score)
+        assert scaled_output.shape == (input.shape[0], 1)
         return scaled_output
 
 class ABRankingLinearModelDeprecate(nn.Module):
@@ -58,14 +57,13 @@ class ABRankingLinearModelDeprecate(nn.Module):
 
     # for score
     def forward(self, input):
-        # make sure input shape is (1, self.inputs_shape)
-        # we currently don't support batching
-        assert input.shape == (1, self.inputs_shape)
+        # make sure input shape is (batch size, self.inputs_shape)
+        assert input.dim() == 2 and input.shape[1] == self.inputs_shape
 
         output = self.linear(input)
 
-        # make sure input shape is (1, score)
-        assert output.shape == (1,1)
+        # make sure output shape is (batch size, score)
+        assert output.shape == (input.shape[0], 1)
         return output
 
 class ABRankingModel:
@@ -3,7 +3,6 @@ import sys
 import io
 import csv
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import numpy as np
 import random
@@ -54,6 +53,198 @@ def find_first_element_binary_search(cumulative_prob_arr, random_float):
     return -1
 
 
+# number of prompts sampled at once by the phrase sampler
+# bounds the size of the candidate matrices
+PROMPT_SAMPLING_BATCH_SIZE = 4096
+# rounds of candidates drawn for the prompts that aren't complete,
+# the prompts still not complete after that are finished without replacement
+MAX_SAMPLING_ROUNDS = 8
+# size of the (prompts, phrases) key matrices used to sample without replacement
+WITHOUT_REPLACEMENT_MAX_KEYS = 1 << 24
+
+
+class BoltzmanPhraseSampler:
+    """
+    Samples prompts from a boltzman distribution over the phrases,
+    many prompts at once.
+
+    The cumulative probability array is sorted by probability (see get_cumulative_probability_arr)
+    and phrase_origin_indexes maps its positions to the phrase indexes of the loader.
+
+    For every prompt a row of candidate phrases is drawn with np.searchsorted.
+    Repeated phrases are dropped (sampling without replacement) and phrases are
+    added in draw order while the prompt is under max_token_size,
+    stopping at the first phrase that doesn't fit.
+
+    Each prompt keeps its phrases and token total, so only the prompts that aren't
+    complete draw more candidates. After MAX_SAMPLING_ROUNDS rounds (a few phrases
+    with most of the probability) the rest is drawn without replacement with exponential keys,
+    which gives the same distribution as drawing with replacement and dropping the repeats.
+    """
+    def __init__(self,
+                 phrase_scores_loader,
+                 phrase_origin_indexes,
+                 cumulative_probability_arr,
+                 max_token_size=75,
+                 comma_token_size=1,
+                 seed=None):
+        self.max_token_size = max_token_size
+        self.comma_token_size = comma_token_size
+        self.rng = np.random.default_rng(seed)
+
+        self.cumulative_probability_arr = np.asarray(cumulative_probability_arr, dtype=np.float64)
+        self.num_phrases = len(self.cumulative_probability_arr)
+        assert self.num_phrases > 0, "Error: there are no phrases to sample from"
+        self.total_probability = self.cumulative_probability_arr[-1]
+        self.probabilities = np.diff(self.cumulative_probability_arr, prepend=0.0)
+
+        # phrase & token size of every position of the cumulative array
+        # looked up once instead of once per sampled phrase
+        self.phrases = []
+        token_sizes = []
+        for prompt_index in phrase_origin_indexes:
+            self.phrases.append(phrase_scores_loader.get_phrase(prompt_index))
+            token_sizes.append(phrase_scores_loader.get_token_size(prompt_index))
+        self.phrases = np.array(self.phrases, dtype=object)
+
+        # tokens used by each phrase including its comma
+        self.phrase_costs = np.array(token_sizes, dtype=np.int64) + comma_token_size
+
+        # enough candidates to fill a prompt if there are no repeated phrases
+        min_phrase_cost = max(int(self.phrase_costs.min()), 1)
+        self.num_candidates = self.max_token_size // min_phrase_cost + 1
+        # a prompt never has more phrases than that
+        self.max_prompt_phrases = min(self.num_candidates, self.num_phrases)
+
+    def draw_candidates(self, prompt_count, num_candidates):
+        random_floats = self.rng.random((prompt_count, num_candidates)) * self.total_probability
+        candidates = np.searchsorted(self.cumulative_probability_arr, random_floats, side='right')
+
+        # float rounding can land past the last element
+        return np.minimum(candidates, self.num_phrases - 1)
+
+    def add_candidates(self, prompt_phrases, num_prompt_phrases, total_token_sizes, rows, candidates, valid=None):
+        # adds the candidates of each row to its prompt, in order, updating the prompt state
+        # returns which rows are complete
+        rows_phrases = prompt_phrases[rows]
+
+        # a candidate is repeated if its phrase is in the prompt or was drawn before in its row
+        # the prompt phrases come first and the stable sort keeps the first occurrence in front
+        # (the -1 padding of the prompts never matches a candidate)
+        block = np.concatenate([rows_phrases, candidates], axis=1)
+        order = np.argsort(block, axis=1, kind='stable')
+        sorted_block = np.take_along_axis(block, order, axis=1)
+        sorted_repeated = np.zeros(block.shape, dtype=bool)
+        sorted_repeated[:, 1:] = sorted_block[:, 1:] == sorted_block[:, :-1]
+
+        repeated = np.empty(block.shape, dtype=bool)
+        np.put_along_axis(repeated, order, sorted_repeated, axis=1)
+        repeated = repeated[:, rows_phrases.shape[1]:]
+        if valid is not None:
+            repeated |= ~valid
+
+        # token budget, repeated phrases use no tokens
+        costs = np.where(repeated, 0, self.phrase_costs[candidates])
+        candidate_token_sizes = total_token_sizes[rows, None] + np.cumsum(costs, axis=1)
+        used = ~repeated & (candidate_token_sizes < self.max_token_size)
+
+        # the used candidates go after the phrases already in the prompt
+        used_rows, used_columns = np.nonzero(used)
+        positions = num_prompt_phrases[rows][used_rows] + np.cumsum(used, axis=1)[used_rows, used_columns] - 1
+        prompt_phrases[rows[used_rows], positions] = candidates[used_rows, used_columns]
+        num_prompt_phrases[rows] += used.sum(axis=1)
+        total_token_sizes[rows] += np.where(used, costs, 0).sum(axis=1)
+
+        # a prompt is complete once a phrase didn't fit
+        # or when every phrase is already in it
+        overflowed = (~repeated & (candidate_token_sizes >= self.max_token_size)).any(axis=1)
+        exhausted = num_prompt_phrases[rows] >= self.num_phrases
+
+        return overflowed | exhausted
+
+    def add_candidates_without_replacement(self, prompt_phrases, num_prompt_phrases, total_token_sizes, rows):
+        # the phrases ordered by -log(u) / p are a draw without replacement (successive sampling)
+        # phrases already in the prompt or without probability get an infinite key and are skipped
+        num_keys = self.max_prompt_phrases
+        chunk_size = max(1, WITHOUT_REPLACEMENT_MAX_KEYS // self.num_phrases)
+        for start in range(0, len(rows), chunk_size):
+            chunk_rows = rows[start:start + chunk_size]
+            with np.errstate(divide='ignore', over='ignore'):
+                keys = -np.log(self.rng.random((len(chunk_rows), self.num_phrases))) / self.probabilities
+
+            chunk_phrases = prompt_phrases[chunk_rows]
+            phrase_rows, phrase_columns = np.nonzero(chunk_phrases >= 0)
+            keys[phrase_rows, chunk_phrases[phrase_rows, phrase_columns]] = np.inf
+
+            if num_keys < self.num_phrases:
+                candidates = np.argpartition(keys, num_keys - 1, axis=1)[:, :num_keys]
+            else:
+                candidates = np.tile(np.arange(self.num_phrases), (len(chunk_rows), 1))
+            candidate_keys = np.take_along_axis(keys, candidates, axis=1)
+            order = np.argsort(candidate_keys, axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            candidate_keys = np.take_along_axis(candidate_keys, order, axis=1)
+
+            self.add_candidates(prompt_phrases,
+                                num_prompt_phrases,
+                                total_token_sizes,
+                                chunk_rows,
+                                candidates,
+                                valid=np.isfinite(candidate_keys))
+
+    def sample_phrase_indexes(self, prompt_count):
+        # returns the positions (in the cumulative array) of the phrases of each prompt
+        prompt_phrases = np.full((prompt_count, self.max_prompt_phrases), -1, dtype=np.int64)
+        num_prompt_phrases = np.zeros(prompt_count, dtype=np.int64)
+        total_token_sizes = np.zeros(prompt_count, dtype=np.int64)
+
+        # only the prompts that aren't complete draw more candidates
+        rows = np.arange(prompt_count)
+        for _ in range(MAX_SAMPLING_ROUNDS):
+            if len(rows) == 0:
+                break
+
+            candidates = self.draw_candidates(len(rows), self.num_candidates)
+            complete = self.add_candidates(prompt_phrases, num_prompt_phrases, total_token_sizes, rows, candidates)
+            rows = rows[~complete]
+
+        if len(rows) > 0:
+            self.add_candidates_without_replacement(prompt_phrases, num_prompt_phrases, total_token_sizes, rows)
+
+        split_indexes = np.cumsum(num_prompt_phrases)[:-1]
+
+        return np.split(prompt_phrases[prompt_phrases >= 0], split_indexes)
+
+    def sample_prompts(self, prompt_count):
+        prompt_list = []
+        for start in range(0, prompt_count, PROMPT_SAMPLING_BATCH_SIZE):
+            batch_size = min(PROMPT_SAMPLING_BATCH_SIZE, prompt_count - start)
+            for phrase_indexes in self.sample_phrase_indexes(batch_size):
+                prompt_list.append(', '.join(self.phrases[phrase_indexes]))
+
+        return prompt_list
+
+
+def sample_prompt_pairs(positive_phrase_scores_loader,
+                        positive_phrase_origin_indexes,
+                        positive_cumulative_probability_arr,
+                        negative_phrase_scores_loader,
+                        negative_phrase_origin_indexes,
+                        negative_cumulative_probability_arr,
+                        prompt_count):
+    positive_sampler = BoltzmanPhraseSampler(phrase_scores_loader=positive_phrase_scores_loader,
+                                             phrase_origin_indexes=positive_phrase_origin_indexes,
+                                             cumulative_probability_arr=positive_cumulative_probability_arr)
+    negative_sampler = BoltzmanPhraseSampler(phrase_scores_loader=negative_phrase_scores_loader,
+                                             phrase_origin_indexes=negative_phrase_origin_indexes,
+                                             cumulative_probability_arr=negative_cumulative_probability_arr)
+
+    positive_prompt_list = positive_sampler.sample_prompts(prompt_count)
+    negative_prompt_list = negative_sampler.sample_prompts(prompt_count)
+
+    return list(zip(positive_prompt_list, negative_prompt_list))
+
+
 def generate_prompt(positive_phrase_scores_loader,
                     positive_phrase_origin_indexes,
                     positive_cumulative_probability_arr,
@@ -61,72 +252,15 @@ def generate_prompt(positive_phrase_scores_loader,
                     negative_phrase_origin_indexes,
                     negative_cumulative_probability_arr,
                     ):
-    max_token_size = 75
-    comma_token_size = 1
-
-    positive_prompt_total_token_size = 0
-    negative_prompt_total_token_size = 0
-    positive_prompt = []
-    negative_prompt = []
-    positive_used_phrase_dict = {}
-    negative_used_phrase_dict = {}
-
-    positive_cumulative_probability_arr_min = positive_cumulative_probability_arr.min()
-    positive_cumulative_probability_arr_max = positive_cumulative_probability_arr.max()
-    # positive prompt
-    while positive_prompt_total_token_size < max_token_size:
-        random_float = random.uniform(positive_cumulative_probability_arr_min,
-                                      positive_cumulative_probability_arr_max)
-        x_rand = random_float
-        random_index = find_first_element_binary_search(positive_cumulative_probability_arr, random_float)
-        while random_index in positive_used_phrase_dict:
-            y_rand = random.uniform(0.0, (1.0 - x_rand))
-            x_rand = x_rand + y_rand
-            random_index = find_first_element_binary_search(positive_cumulative_probability_arr, x_rand)
-
-        prompt_index = positive_phrase_origin_indexes[random_index]
-        random_phrase = positive_phrase_scores_loader.get_phrase(prompt_index)
-
-        chosen_phrase_size = positive_phrase_scores_loader.get_token_size(prompt_index)
-        sum_token_size = positive_prompt_total_token_size + chosen_phrase_size + comma_token_size
-        if sum_token_size < max_token_size:
-            # update used array
-            positive_used_phrase_dict[random_index] = 1
-            positive_prompt.append(random_phrase)
-            positive_prompt_total_token_size = sum_token_size
-        else:
-            break
-
-    negative_cumulative_probability_arr_min = negative_cumulative_probability_arr.min()
-    negative_cumulative_probability_arr_max = negative_cumulative_probability_arr.max()
-    # negative prompt
-    while negative_prompt_total_token_size < max_token_size:
-        random_float = random.uniform(negative_cumulative_probability_arr_min,
-                                      negative_cumulative_probability_arr_max)
-        x_rand = random_float
-        random_index = find_first_element_binary_search(negative_cumulative_probability_arr, random_float)
-        while random_index in negative_used_phrase_dict:
-            y_rand = random.uniform(0.0, (1.0 - x_rand))
-            x_rand = x_rand + y_rand
-            random_index = find_first_element_binary_search(negative_cumulative_probability_arr, x_rand)
-
-        prompt_index = negative_phrase_origin_indexes[random_index]
-        random_phrase = negative_phrase_scores_loader.get_phrase(prompt_index)
-
-        chosen_phrase_size = negative_phrase_scores_loader.get_token_size(prompt_index)
-        sum_token_size = negative_prompt_total_token_size + chosen_phrase_size + comma_token_size
-        if sum_token_size < max_token_size:
-            # update used array
-            negative_used_phrase_dict[random_index] = 1
-            negative_prompt.append(random_phrase)
-            negative_prompt_total_token_size = sum_token_size
-        else:
-            break
-
-    positive_prompt_str = ', '.join([prompt for prompt in positive_prompt])
-    negative_prompt_str = ', '.join([prompt for prompt in negative_prompt])
-
-    prompt = (positive_prompt_str, negative_prompt_str)
+    # to generate many prompts use sample_prompt_pairs or BoltzmanPhraseSampler
+    # so the samplers are only built once
+    prompt = sample_prompt_pairs(positive_phrase_scores_loader=positive_phrase_scores_loader,
+                                 positive_phrase_origin_indexes=positive_phrase_origin_indexes,
+                                 positive_cumulative_probability_arr=positive_cumulative_probability_arr,
+                                 negative_phrase_scores_loader=negative_phrase_scores_loader,
+                                 negative_phrase_origin_indexes=negative_phrase_origin_indexes,
+                                 negative_cumulative_probability_arr=negative_cumulative_probability_arr,
+                                 prompt_count=1)[0]
 
     return prompt
 
@@ -145,69 +279,63 @@ def generate_prompts(minio_client,
     generated_prompts = []
 
     print("Generating {} prompts...".format(prompt_count))
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for i in range(prompt_count):
-            futures.append(executor.submit(generate_prompt,
-                                           positive_phrase_scores_loader=positive_phrase_scores_loader,
-                                           positive_phrase_origin_indexes=positive_phrase_origin_indexes,
-                                           positive_cumulative_probability_arr=positive_cumulative_probability_arr,
-                                           negative_phrase_scores_loader=negative_phrase_scores_loader,
-                                           negative_phrase_origin_indexes=negative_phrase_origin_indexes,
-                                           negative_cumulative_probability_arr=negative_cumulative_probability_arr))
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            prompt = future.result()
-            positive_prompt = prompt[0]
-            negative_prompt = prompt[1]
-            print("positive prompt=", positive_prompt)
-            print("negative prompt=", negative_prompt)
-            print("---------------------------------------------------------------")
-            if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
-                response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
-                                                                           negative_prompt=negative_prompt,
-                                                                           prompt_scoring_model="n/a",
-                                                                           prompt_score=0.0,
-                                                                           prompt_generation_policy="independent_approx_v1",
-                                                                           top_k=0.0,
-                                                                           dataset_name=dataset_name,
-                                                                           boltzman_temperature=boltzman_temperature,
-                                                                           boltzman_k=boltzman_k)
-            elif dataset_name in ["character", "mech", "icons"]:
-                mask_path = "./test/test_inpainting/icon_mask.png"
-                if dataset_name == "character":
-                    mask_path = "./test/test_inpainting/character_mask.png"
-                elif dataset_name == "mech":
-                    sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
-                    chosen_size = random.randint(0, len(sizes)-1)
-                    size_str = sizes[chosen_size]
-                    mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
-
-                response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
-                                                                    negative_prompt=negative_prompt,
-                                                                    prompt_scoring_model="n/a",
-                                                                    prompt_score=0.0,
-                                                                    prompt_generation_policy="independent_approx_v1",
-                                                                    top_k=0.0,
-                                                                    dataset_name=dataset_name,
-                                                                    boltzman_temperature=boltzman_temperature,
-                                                                    boltzman_k=boltzman_k,
-                                                                    init_img_path="./test/test_inpainting/white_512x512.jpg",
-                                                                    mask_path=mask_path)
-            else:
-                raise Exception("dataset unsupported")
+    prompt_list = sample_prompt_pairs(positive_phrase_scores_loader=positive_phrase_scores_loader,
+                                      positive_phrase_origin_indexes=positive_phrase_origin_indexes,
+                                      positive_cumulative_probability_arr=positive_cumulative_probability_arr,
+                                      negative_phrase_scores_loader=negative_phrase_scores_loader,
+                                      negative_phrase_origin_indexes=negative_phrase_origin_indexes,
+                                      negative_cumulative_probability_arr=negative_cumulative_probability_arr,
+                                      prompt_count=prompt_count)
+
+    for positive_prompt, negative_prompt in tqdm(prompt_list):
+        print("positive prompt=", positive_prompt)
+        print("negative prompt=", negative_prompt)
+        print("---------------------------------------------------------------")
+        if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
+            response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
+                                                                       negative_prompt=negative_prompt,
+                                                                       prompt_scoring_model="n/a",
+                                                                       prompt_score=0.0,
+                                                                       prompt_generation_policy="independent_approx_v1",
+                                                                       top_k=0.0,
+                                                                       dataset_name=dataset_name,
+                                                                       boltzman_temperature=boltzman_temperature,
+                                                                       boltzman_k=boltzman_k)
+        elif dataset_name in ["character", "mech", "icons"]:
+            mask_path = "./test/test_inpainting/icon_mask.png"
+            if dataset_name == "character":
+                mask_path = "./test/test_inpainting/character_mask.png"
+            elif dataset_name == "mech":
+                sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
+                chosen_size = random.randint(0, len(sizes)-1)
+                size_str = sizes[chosen_size]
+                mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
+
+            response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
+                                                                negative_prompt=negative_prompt,
+                                                                prompt_scoring_model="n/a",
+                                                                prompt_score=0.0,
+                                                                prompt_generation_policy="independent_approx_v1",
+                                                                top_k=0.0,
+                                                                dataset_name=dataset_name,
+                                                                boltzman_temperature=boltzman_temperature,
+                                                                boltzman_k=boltzman_k,
+                                                                init_img_path="./test/test_inpainting/white_512x512.jpg",
+                                                                mask_path=mask_path)
+        else:
+            raise Exception("dataset unsupported")
 
-            job_uuid = response['uuid']
-            data = {"job_uuid": job_uuid,
-                    "positive_prompt": positive_prompt,
-                    "negative_prompt": negative_prompt}
-            generated_prompts.append(data)
+        job_uuid = response['uuid']
+        data = {"job_uuid": job_uuid,
+                "positive_prompt": positive_prompt,
+                "negative_prompt": negative_prompt}
+        generated_prompts.append(data)
 
-        upload_prompt_generation_data_to_csv(minio_client=minio_client,
-                                             dataset_name=dataset_name,
-                                             prompt_generation_data=generated_prompts,
-                                             boltzman_temperature=boltzman_temperature,
-                                             boltzman_k=boltzman_k)
+    upload_prompt_generation_data_to_csv(minio_client=minio_client,
+                                         dataset_name=dataset_name,
+                                         prompt_generation_data=generated_prompts,
+                                         boltzman_temperature=boltzman_temperature,
+                                         boltzman_k=boltzman_k)
 
 
 def generate_prompts_array(positive_phrase_scores_loader,
@@ -220,30 +348,23 @@ def generate_prompts_array(positive_phrase_scores_loader,
     generated_prompts = []
 
     print("Generating {} prompts...".format(prompt_count))
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for i in range(prompt_count):
-            futures.append(executor.submit(generate_prompt,
-                                           positive_phrase_scores_loader=positive_phrase_scores_loader,
-                                           positive_phrase_origin_indexes=positive_phrase_origin_indexes,
-                                           positive_cumulative_probability_arr=positive_cumulative_probability_arr,
-                                           negative_phrase_scores_loader=negative_phrase_scores_loader,
-                                           negative_phrase_origin_indexes=negative_phrase_origin_indexes,
-                                           negative_cumulative_probability_arr=negative_cumulative_probability_arr))
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            prompt = future.result()
-            positive_prompt = prompt[0]
-            negative_prompt = prompt[1]
-
-            data = {
-                "positive_prompt": positive_prompt,
-                "negative_prompt": negative_prompt
-            }
-
-            generated_prompts.append(data)
-
-        return generated_prompts
+    prompt_list = sample_prompt_pairs(positive_phrase_scores_loader=positive_phrase_scores_loader,
+                                      positive_phrase_origin_indexes=positive_phrase_origin_indexes,
+                                      positive_cumulative_probability_arr=positive_cumulative_probability_arr,
+                                      negative_phrase_scores_loader=negative_phrase_scores_loader,
+                                      negative_phrase_origin_indexes=negative_phrase_origin_indexes,
+                                      negative_cumulative_probability_arr=negative_cumulative_probability_arr,
+                                      prompt_count=prompt_count)
+
+    for positive_prompt, negative_prompt in prompt_list:
+        data = {
+            "positive_prompt": positive_prompt,
+            "negative_prompt": negative_prompt
+        }
+
+        generated_prompts.append(data)
+
+    return generated_prompts
 
 
 def get_cumulative_probability_arr(minio_client,
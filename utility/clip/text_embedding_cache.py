@@ -0,0 +1,153 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from utility.clip.clip_text_embedder import CLIPTextPooler
+from data_loader.phrase_embedding_store import PhraseEmbeddingStore
+
+# pooled clip text embeddings of prompts and phrases, keyed by (model, pooling, hash of the text)
+#
+# two tiers:
+# - an in memory lru of float32 embeddings
+# - optionally an on disk, memory mapped float16 store (see phrase_embedding_store.py)
+#   in <directory>/<model name>/<pooling strategy>, so embeddings are kept between runs
+#   the store and its hash index are bounded by max_disk_rows, when it is full it is cleared
+#   and refilled, a cache of prompts that keep changing has no better eviction order than that
+#
+# embed_many looks the texts up in both tiers and only encodes the misses, in batches
+
+DEFAULT_TEXT_EMBEDDING_MODEL_NAME = "clip-vit-large-patch14"
+DEFAULT_EMBED_BATCH_SIZE = 256
+DEFAULT_MEMORY_CACHE_SIZE = 100000
+# 1.5gb of float16 rows
+DEFAULT_MAX_DISK_ROWS = 1000000
+
+
+def get_text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TextEmbeddingCache:
+    def __init__(self,
+                 text_embedder,
+                 pooling_strategy='AVERAGE_POOLING',
+                 model_name=DEFAULT_TEXT_EMBEDDING_MODEL_NAME,
+                 embedding_dim=768,
+                 batch_size=DEFAULT_EMBED_BATCH_SIZE,
+                 memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE,
+                 directory=None,
+                 max_disk_rows=DEFAULT_MAX_DISK_ROWS):
+        # text_embedder is a loaded CLIPTextEmbedder
+        self.text_embedder = text_embedder
+        self.pooling_strategy = pooling_strategy
+        self.model_name = model_name
+        self.embedding_dim = embedding_dim
+        self.batch_size = batch_size
+        self.memory_cache_size = memory_cache_size
+        self.max_disk_rows = max_disk_rows
+
+        # text hash => float32 embedding
+        self.memory_cache = OrderedDict()
+
+        self.disk_store = None
+        if directory is not None:
+            self.disk_store = PhraseEmbeddingStore(embedding_dim=embedding_dim,
+                                                   directory=os.path.join(directory, model_name, pooling_strategy.lower()))
+
+        # counters
+        self.num_memory_hits = 0
+        self.num_disk_hits = 0
+        self.num_encoded = 0
+        self.num_disk_evictions = 0
+
+    def add_to_memory_cache(self, text_hash, embedding):
+        if self.memory_cache_size <= 0:
+            return
+
+        self.memory_cache[text_hash] = embedding
+        self.memory_cache.move_to_end(text_hash)
+        if len(self.memory_cache) > self.memory_cache_size:
+            self.memory_cache.popitem(last=False)
+
+    def add_to_disk_store(self, text_hashes, embeddings):
+        if len(self.disk_store) + len(text_hashes) > self.max_disk_rows:
+            self.disk_store.clear()
+            self.num_disk_evictions += 1
+
+        self.disk_store.append(text_hashes, embeddings)
+
+    def lookup(self, text_hash):
+        embedding = self.memory_cache.get(text_hash)
+        if embedding is not None:
+            self.memory_cache.move_to_end(text_hash)
+            self.num_memory_hits += 1
+            return embedding
+
+        if self.disk_store is not None:
+            index = self.disk_store.get_index(text_hash)
+            if index is not None:
+                embedding = self.disk_store.matrix[index].astype(np.float32)
+                self.add_to_memory_cache(text_hash, embedding)
+                self.num_disk_hits += 1
+                return embedding
+
+        return None
+
+    def encode(self, texts):
+        # texts are padded to the max length by the tokenizer
+        with torch.no_grad():
+            embeddings, _, attention_masks = self.text_embedder.forward_return_all(texts)
+            pooled_embeddings = CLIPTextPooler.tensor_pooling(embeddings, attention_masks, self.pooling_strategy)
+
+        return pooled_embeddings.float().cpu().numpy().reshape(len(texts), self.embedding_dim)
+
+    def embed_many(self, texts):
+        # returns the (len(texts), embedding dim) float32 pooled embeddings of the texts
+        results = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+
+        # text hash => rows of the results, for the texts that aren't cached
+        missing_rows = OrderedDict()
+        missing_texts = []
+        for row, text in enumerate(texts):
+            text_hash = get_text_hash(text)
+            if text_hash in missing_rows:
+                missing_rows[text_hash].append(row)
+                continue
+
+            embedding = self.lookup(text_hash)
+            if embedding is not None:
+                results[row] = embedding
+            else:
+                missing_rows[text_hash] = [row]
+                missing_texts.append(text)
+
+        missing_hashes = list(missing_rows.keys())
+        for start in range(0, len(missing_texts), self.batch_size):
+            batch_texts = missing_texts[start:start + self.batch_size]
+            batch_hashes = missing_hashes[start:start + self.batch_size]
+            batch_embeddings = self.encode(batch_texts)
+
+            for text_hash, embedding in zip(batch_hashes, batch_embeddings):
+                results[missing_rows[text_hash]] = embedding
+                self.add_to_memory_cache(text_hash, embedding)
+
+            if self.disk_store is not None:
+                self.add_to_disk_store(batch_hashes, batch_embeddings)
+
+            self.num_encoded += len(batch_texts)
+
+        return results
+
+    def embed(self, text):
+        return self.embed_many([text])[0]
+
+    def print_stats(self):
+        num_lookups = self.num_memory_hits + self.num_disk_hits + self.num_encoded
+        print("text embedding cache: memory hits={}, disk hits={}, encoded={}, disk evictions={}, hit rate={:.2f}%".format(
+            self.num_memory_hits,
+            self.num_disk_hits,
+            self.num_encoded,
+            self.num_disk_evictions,
+            100 * (self.num_memory_hits + self.num_disk_hits) / max(num_lookups, 1)))
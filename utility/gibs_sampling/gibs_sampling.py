@@ -3,7 +3,6 @@ import sys
 import io
 import csv
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import numpy as np
 import random
@@ -15,6 +14,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio import cmd
+from utility.boltzman.boltzman import BoltzmanPhraseSampler
 from worker.prompt_generation.prompt_generator import generate_image_generation_jobs_with_temperature, generate_inpainting_job_with_temperature
 
 
@@ -27,97 +27,190 @@ def get_gibs_probability(energy_one,
     return prob
 
 
-def swap_phrases_based_on_gibs_sampling(initial_prompt_indices,
-                                        phrase_scores_loader,
-                                        gibs_temperature,
-                                        gibs_k):
-    phrase_data_total_size = phrase_scores_loader.get_phrase_data_total_size()
-    prompt_len = len(initial_prompt_indices)
-    number_of_phrases_to_swap = random.randint(round(prompt_len/2), prompt_len)
-    num_swapped = 0
-
-    swapped_index_dict = {}
-    used_phrase_dict = {}
-    while num_swapped < number_of_phrases_to_swap:
-        rand_prompt_index = random.randint(0, prompt_len-1)
-        if rand_prompt_index in swapped_index_dict:
-            continue
-
-        rand_phrase_index = random.randint(0, phrase_data_total_size-1)
-        if rand_phrase_index in used_phrase_dict:
-            continue
-
-        energy_one = phrase_scores_loader.get_phrase_energy(initial_prompt_indices[rand_prompt_index])
-        energy_two = phrase_scores_loader.get_phrase_energy(rand_phrase_index)
-        swap_probability = get_gibs_probability(energy_one,
-                                    energy_two,
-                                    gibs_temperature,
-                                    gibs_k)
-        print("swap prob=", swap_probability)
-        rand_float = random.uniform(0, 5)
-        if rand_float <= swap_probability:
-            # then swap
-            initial_prompt_indices[rand_prompt_index] = rand_phrase_index
-            swapped_index_dict[rand_prompt_index] = 1
-            used_phrase_dict[rand_phrase_index] = 1
-            num_swapped += 1
-
-    return initial_prompt_indices
-
-
-def generate_prompt_using_uniform_random(phrase_scores_loader):
-    max_token_size = 75
-    comma_token_size = 1
-
-    prompt_total_token_size = 0
-    prompt = []
-    prompt_index = []
-    used_phrase_dict = {}
-
-    phrase_scores_len = phrase_scores_loader.get_phrase_data_total_size()
-    # prompt
-    while prompt_total_token_size < max_token_size:
-        random_index = random.randint(0, phrase_scores_len-1)
-        if random_index in used_phrase_dict:
-            continue
-
-        random_phrase = phrase_scores_loader.get_phrase(random_index)
-
-        chosen_phrase_size = phrase_scores_loader.get_token_size(random_index)
-        sum_token_size = prompt_total_token_size + chosen_phrase_size + comma_token_size
-        if sum_token_size < max_token_size:
-            # update used array
-            used_phrase_dict[random_index] = 1
-            prompt.append(random_phrase)
-            prompt_index.append(random_index)
-            prompt_total_token_size = sum_token_size
-        else:
-            break
+# number of gibs sweeps over the prompts
+# in each sweep a swap is proposed for every phrase of every prompt
+DEFAULT_GIBS_NUM_SWEEPS = 4
+
+# a swap is accepted when uniform(0, scale) <= swap probability
+GIBS_SWAP_PROBABILITY_SCALE = 5.0
+
+
+class GibsSampler:
+    """
+    Gibbs sampling over a batch of prompts.
+
+    The prompts start as uniform random phrases under the token limit.
+    Then, for a number of sweeps, every position of every prompt gets a proposed
+    random phrase, and the swap is accepted with get_gibs_probability.
+    All the prompts of the batch are processed at once, one position at a time.
+    Swaps that would repeat a phrase of the prompt or go over max_token_size are rejected.
+    """
+    def __init__(self,
+                 phrase_scores_loader,
+                 gibs_temperature,
+                 gibs_k,
+                 max_token_size=75,
+                 comma_token_size=1,
+                 swap_probability_scale=GIBS_SWAP_PROBABILITY_SCALE,
+                 seed=None):
+        self.gibs_temperature = gibs_temperature
+        self.gibs_k = gibs_k
+        self.max_token_size = max_token_size
+        self.swap_probability_scale = swap_probability_scale
+        self.rng = np.random.default_rng(seed)
+
+        self.phrase_data_total_size = phrase_scores_loader.get_phrase_data_total_size()
+        assert self.phrase_data_total_size > 0, "Error: there are no phrases to sample from"
+
+        # energy, token size and phrase of every phrase index
+        # looked up once instead of once per proposed swap
+        energies = []
+        token_sizes = []
+        phrases = []
+        for index in range(self.phrase_data_total_size):
+            energies.append(phrase_scores_loader.get_phrase_energy(index))
+            token_sizes.append(phrase_scores_loader.get_token_size(index))
+            phrases.append(phrase_scores_loader.get_phrase(index))
+        self.energies = np.array(energies, dtype=np.float64)
+        self.phrase_costs = np.array(token_sizes, dtype=np.int64) + comma_token_size
+        self.phrases = np.array(phrases, dtype=object)
+
+        # the initial prompts are drawn with a uniform distribution
+        self.uniform_sampler = BoltzmanPhraseSampler(phrase_scores_loader=phrase_scores_loader,
+                                                     phrase_origin_indexes=range(self.phrase_data_total_size),
+                                                     cumulative_probability_arr=np.arange(1, self.phrase_data_total_size + 1),
+                                                     max_token_size=max_token_size,
+                                                     comma_token_size=comma_token_size,
+                                                     seed=self.rng.integers(2 ** 32))
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_proposed = 0
+        self.num_accepted = 0
+        self.num_rejected_repeated = 0
+        self.num_rejected_token_size = 0
+
+    def get_stats(self):
+        acceptance_rate = self.num_accepted / self.num_proposed if self.num_proposed > 0 else 0.0
+
+        return {
+            "proposed": self.num_proposed,
+            "accepted": self.num_accepted,
+            "rejected_repeated_phrase": self.num_rejected_repeated,
+            "rejected_token_size": self.num_rejected_token_size,
+            "acceptance_rate": acceptance_rate,
+        }
+
+    def generate_initial_prompts(self, prompt_count):
+        # returns a (prompt_count, max_prompt_len) matrix of phrase indexes
+        # padded with -1, and the length of each prompt
+        phrase_index_list = self.uniform_sampler.sample_phrase_indexes(prompt_count)
+        prompt_lengths = np.array([len(phrase_indexes) for phrase_indexes in phrase_index_list], dtype=np.int64)
+
+        prompts = np.full((prompt_count, max(int(prompt_lengths.max()), 1)), -1, dtype=np.int64)
+        prompts[np.arange(prompts.shape[1])[None, :] < prompt_lengths[:, None]] = np.concatenate(phrase_index_list)
+
+        return prompts, prompt_lengths
+
+    def sweep(self, prompts, prompt_lengths, total_token_sizes):
+        prompt_count = prompts.shape[0]
+
+        for position in range(prompts.shape[1]):
+            rows = np.nonzero(position < prompt_lengths)[0]
+            if len(rows) == 0:
+                break
+
+            current_phrases = prompts[rows, position]
+            proposed_phrases = self.rng.integers(0, self.phrase_data_total_size, size=len(rows))
+
+            swap_probability = get_gibs_probability(self.energies[current_phrases],
+                                                    self.energies[proposed_phrases],
+                                                    self.gibs_temperature,
+                                                    self.gibs_k)
+            accepted = self.rng.uniform(0, self.swap_probability_scale, size=len(rows)) <= swap_probability
+
+            repeated = (prompts[rows] == proposed_phrases[:, None]).any(axis=1)
+            new_total_token_sizes = (total_token_sizes[rows]
+                                     - self.phrase_costs[current_phrases]
+                                     + self.phrase_costs[proposed_phrases])
+            too_long = new_total_token_sizes >= self.max_token_size
+
+            self.num_proposed += len(rows)
+            self.num_rejected_repeated += int((accepted & repeated).sum())
+            self.num_rejected_token_size += int((accepted & ~repeated & too_long).sum())
+
+            accepted &= ~repeated & ~too_long
+            self.num_accepted += int(accepted.sum())
+
+            accepted_rows = rows[accepted]
+            prompts[accepted_rows, position] = proposed_phrases[accepted]
+            total_token_sizes[accepted_rows] = new_total_token_sizes[accepted]
+
+        return prompts
+
+    def sample_prompt_indexes(self, prompt_count, num_sweeps=DEFAULT_GIBS_NUM_SWEEPS):
+        prompts, prompt_lengths = self.generate_initial_prompts(prompt_count)
+        total_token_sizes = np.where(prompts >= 0, self.phrase_costs[prompts], 0).sum(axis=1)
+
+        for _ in range(num_sweeps):
+            self.sweep(prompts, prompt_lengths, total_token_sizes)
+
+        return [prompts[i, :prompt_lengths[i]] for i in range(prompt_count)]
+
+    def sample_prompts(self, prompt_count, num_sweeps=DEFAULT_GIBS_NUM_SWEEPS):
+        prompt_list = []
+        for prompt_indexes in self.sample_prompt_indexes(prompt_count, num_sweeps):
+            prompt_list.append(', '.join(self.phrases[prompt_indexes]))
+
+        return prompt_list
+
+
+def print_gibs_stats(name, stats):
+    print("{} gibs sampling: proposed={}, accepted={}, rejected repeated phrase={}, rejected token size={}, acceptance rate={:.4f}".format(
+        name,
+        stats["proposed"],
+        stats["accepted"],
+        stats["rejected_repeated_phrase"],
+        stats["rejected_token_size"],
+        stats["acceptance_rate"]))
+
+
+def generate_prompt_pairs(positive_phrase_scores_loader,
+                          negative_phrase_scores_loader,
+                          prompt_count,
+                          gibs_temperature,
+                          gibs_k,
+                          num_sweeps=DEFAULT_GIBS_NUM_SWEEPS):
+    positive_sampler = GibsSampler(phrase_scores_loader=positive_phrase_scores_loader,
+                                   gibs_temperature=gibs_temperature,
+                                   gibs_k=gibs_k)
+    negative_sampler = GibsSampler(phrase_scores_loader=negative_phrase_scores_loader,
+                                   gibs_temperature=gibs_temperature,
+                                   gibs_k=gibs_k)
+
+    positive_prompt_list = positive_sampler.sample_prompts(prompt_count, num_sweeps)
+    negative_prompt_list = negative_sampler.sample_prompts(prompt_count, num_sweeps)
 
-    return prompt_index
+    print_gibs_stats("positive", positive_sampler.get_stats())
+    print_gibs_stats("negative", negative_sampler.get_stats())
+
+    return list(zip(positive_prompt_list, negative_prompt_list))
 
 
 def generate_prompt(positive_phrase_scores_loader,
                     negative_phrase_scores_loader,
                     gibs_temperature,
                     gibs_k,
-                    ):
-    initial_positive_prompt_indices = generate_prompt_using_uniform_random(positive_phrase_scores_loader)
-    final_positive_prompt_indices = swap_phrases_based_on_gibs_sampling(initial_positive_prompt_indices,
-                                                              positive_phrase_scores_loader,
-                                                              gibs_temperature,
-                                                              gibs_k)
-
-    initial_negative_prompt_indices = generate_prompt_using_uniform_random(negative_phrase_scores_loader)
-    final_negative_prompt_indices = swap_phrases_based_on_gibs_sampling(initial_negative_prompt_indices,
-                                                              negative_phrase_scores_loader,
-                                                              gibs_temperature,
-                                                              gibs_k)
-
-    positive_prompt_str = ', '.join([positive_phrase_scores_loader.get_phrase(prompt_index) for prompt_index in final_positive_prompt_indices])
-    negative_prompt_str = ', '.join([negative_phrase_scores_loader.get_phrase(prompt_index) for prompt_index in final_negative_prompt_indices])
-
-    prompt = (positive_prompt_str, negative_prompt_str)
+                    num_sweeps=DEFAULT_GIBS_NUM_SWEEPS):
+    # to generate many prompts use generate_prompt_pairs
+    # so the samplers are only built once
+    prompt = generate_prompt_pairs(positive_phrase_scores_loader=positive_phrase_scores_loader,
+                                   negative_phrase_scores_loader=negative_phrase_scores_loader,
+                                   prompt_count=1,
+                                   gibs_temperature=gibs_temperature,
+                                   gibs_k=gibs_k,
+                                   num_sweeps=num_sweeps)[0]
 
     return prompt
 
@@ -128,71 +221,67 @@ def generate_prompts(minio_client,
                      negative_phrase_scores_loader,
                      prompt_count,
                      gibs_temperature,
-                     gibs_k):
+                     gibs_k,
+                     num_sweeps=DEFAULT_GIBS_NUM_SWEEPS):
     generated_prompts = []
 
     print("Generating {} prompts...".format(prompt_count))
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for i in range(prompt_count):
-            futures.append(executor.submit(generate_prompt,
-                                           positive_phrase_scores_loader=positive_phrase_scores_loader,
-                                           negative_phrase_scores_loader=negative_phrase_scores_loader,
-                                           gibs_temperature=gibs_temperature,
-                                           gibs_k=gibs_k))
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            prompt = future.result()
-            positive_prompt = prompt[0]
-            negative_prompt = prompt[1]
-            print("positive prompt=", positive_prompt)
-            print("negative prompt=", negative_prompt)
-            print("---------------------------------------------------------------")
-            if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
-                response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
-                                                                           negative_prompt=negative_prompt,
-                                                                           prompt_scoring_model="n/a",
-                                                                           prompt_score=0.0,
-                                                                           prompt_generation_policy="independent_approx_v1_gibs",
-                                                                           top_k=0.0,
-                                                                           dataset_name=dataset_name,
-                                                                           boltzman_temperature=gibs_temperature,
-                                                                           boltzman_k=gibs_k)
-            elif dataset_name in ["character", "mech", "icons"]:
-                mask_path = "./test/test_inpainting/icon_mask.png"
-                if dataset_name == "character":
-                    mask_path = "./test/test_inpainting/character_mask.png"
-                elif dataset_name == "mech":
-                    sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
-                    chosen_size = random.randint(0, len(sizes)-1)
-                    size_str = sizes[chosen_size]
-                    mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
-
-                response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
-                                                                    negative_prompt=negative_prompt,
-                                                                    prompt_scoring_model="n/a",
-                                                                    prompt_score=0.0,
-                                                                    prompt_generation_policy="independent_approx_v1_gibs",
-                                                                    top_k=0.0,
-                                                                    dataset_name=dataset_name,
-                                                                    boltzman_temperature=gibs_temperature,
-                                                                    boltzman_k=gibs_k,
-                                                                    init_img_path="./test/test_inpainting/white_512x512.jpg",
-                                                                    mask_path=mask_path)
-            else:
-                raise Exception("dataset unsupported")
-
-            job_uuid = response['uuid']
-            data = {"job_uuid": job_uuid,
-                    "positive_prompt": positive_prompt,
-                    "negative_prompt": negative_prompt}
-            generated_prompts.append(data)
-
-        upload_prompt_generation_data_to_csv(minio_client=minio_client,
-                                             dataset_name=dataset_name,
-                                             prompt_generation_data=generated_prompts,
-                                             gibs_temperature=gibs_temperature,
-                                             gibs_k=gibs_k)
+    prompt_list = generate_prompt_pairs(positive_phrase_scores_loader=positive_phrase_scores_loader,
+                                        negative_phrase_scores_loader=negative_phrase_scores_loader,
+                                        prompt_count=prompt_count,
+                                        gibs_temperature=gibs_temperature,
+                                        gibs_k=gibs_k,
+                                        num_sweeps=num_sweeps)
+
+    for positive_prompt, negative_prompt in tqdm(prompt_list):
+        print("positive prompt=", positive_prompt)
+        print("negative prompt=", negative_prompt)
+        print("---------------------------------------------------------------")
+        if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
+            response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
+                                                                       negative_prompt=negative_prompt,
+                                                                       prompt_scoring_model="n/a",
+                                                                       prompt_score=0.0,
+                                                                       prompt_generation_policy="independent_approx_v1_gibs",
+                                                                       top_k=0.0,
+                                                                       dataset_name=dataset_name,
+                                                                       boltzman_temperature=gibs_temperature,
+                                                                       boltzman_k=gibs_k)
+        elif dataset_name in ["character", "mech", "icons"]:
+            mask_path = "./test/test_inpainting/icon_mask.png"
+            if dataset_name == "character":
+                mask_path = "./test/test_inpainting/character_mask.png"
+            elif dataset_name == "mech":
+                sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
+                chosen_size = random.randint(0, len(sizes)-1)
+                size_str = sizes[chosen_size]
+                mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
+
+            response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
+                                                                negative_prompt=negative_prompt,
+                                                                prompt_scoring_model="n/a",
+                                                                prompt_score=0.0,
+                                                                prompt_generation_policy="independent_approx_v1_gibs",
+                                                                top_k=0.0,
+                                                                dataset_name=dataset_name,
+                                                                boltzman_temperature=gibs_temperature,
+                                                                boltzman_k=gibs_k,
+                                                                init_img_path="./test/test_inpainting/white_512x512.jpg",
+                                                                mask_path=mask_path)
+        else:
+            raise Exception("dataset unsupported")
+
+        job_uuid = response['uuid']
+        data = {"job_uuid": job_uuid,
+                "positive_prompt": positive_prompt,
+                "negative_prompt": negative_prompt}
+        generated_prompts.append(data)
+
+    upload_prompt_generation_data_to_csv(minio_client=minio_client,
+                                         dataset_name=dataset_name,
+                                         prompt_generation_data=generated_prompts,
+                                         gibs_temperature=gibs_temperature,
+                                         gibs_k=gibs_k)
 
 
 def upload_prompt_generation_data_to_csv(minio_client,
@@ -1,4 +1,4 @@
-import requests
+from utility.http import http_session
 
 SERVER_ADDRESS = 'http://192.168.3.1:8111'
 
@@ -8,7 +8,7 @@ def http_add_external_image(image_data):
     response = None
 
     try:
-        response = requests.post(url, json=image_data, headers=headers)
+        response = http_session.post(url, json=image_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -29,7 +29,7 @@ def http_get_external_image_list(dataset= None, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -38,6 +38,34 @@ def http_get_external_image_list(dataset= None, size=None):
     except Exception as e:
         print('request exception ', e)
 
+# Get the external images added after the cursor
+# returns the list of images and the cursor to use in the next call
+def http_get_external_images_since_cursor(cursor=None, limit=10000):
+    return http_get_images_since_cursor("/external-images/list-images-since-cursor", cursor, limit)
+
+def http_get_images_since_cursor(endpoint_url, cursor, limit):
+    url = SERVER_ADDRESS + endpoint_url
+    params = {"limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    response = None
+
+    try:
+        response = http_session.get(url, params=params)
+
+        if response.status_code == 200:
+            data_json = response.json()
+            return data_json['response']['data'], data_json['response']['next_cursor']
+
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return None, cursor
+
 def http_get_external_dataset_in_batches(dataset: str, batch_size: int):
     external_images=[]
     
@@ -49,7 +77,7 @@ def http_get_external_dataset_in_batches(dataset: str, batch_size: int):
 
         url = SERVER_ADDRESS + endpoint_url
         try:
-            response = requests.get(url)
+            response = http_session.get(url)
             
             if response.status_code == 200:
                 data_json = response.json()
@@ -83,7 +111,7 @@ def http_get_external_image_list_without_extracts(dataset, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -99,7 +127,7 @@ def http_add_extract(image_data):
     response = None
 
     try:
-        response = requests.post(url, json=image_data, headers=headers)
+        response = http_session.post(url, json=image_data, headers=headers)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -123,7 +151,7 @@ def http_get_extract_image_list(dataset= None, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -133,12 +161,18 @@ def http_get_extract_image_list(dataset= None, size=None):
         print('request exception ', e)
 
 
+# Get the extracts added after the cursor
+# returns the list of images and the cursor to use in the next call
+def http_get_extracts_since_cursor(cursor=None, limit=10000):
+    return http_get_images_since_cursor("/extracts/list-extracts-since-cursor", cursor, limit)
+
+
 def http_get_current_extract_batch_sequential_id(dataset: str):
     endpoint_url= "/extracts/get-current-data-batch-sequential-id?dataset={}".format(dataset)
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -152,7 +186,7 @@ def http_get_next_extract_batch_sequential_id(dataset: str, is_complete: bool =
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -167,7 +201,7 @@ def http_get_external_dataset_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -188,7 +222,7 @@ def http_get_extract_dataset_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -212,7 +246,7 @@ def http_get_video_game_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -237,7 +271,7 @@ def http_add_dataset(dataset_name: str, bucket_id: int):
     response = None
 
     try:
-        response = requests.post(url, headers=headers, params=params)
+        response = http_session.post(url, headers=headers, params=params)
 
         if response.status_code != 200:
             print(f"Request failed with status code: {response.status_code}: {response.content.decode('utf-8')}")
@@ -258,7 +292,7 @@ def http_delete_extract(image_hash: str):
     response = None
 
     try:
-        response = requests.delete(url)
+        response = http_session.delete(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -1,6 +1,6 @@
 # NOTE: don't add more imports here
 # this is also used by training workers
-import requests
+from utility.http import http_session
 import json
 from utility.http.http_request_utils import get_url_with_query_params, http_request
 
@@ -23,7 +23,7 @@ def http_get_job(worker_type: str = None, model_type: str = None):
         url += "?" + "&".join(query_params)
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             job_json = response.json()
@@ -38,6 +38,26 @@ def http_get_job(worker_type: str = None, model_type: str = None):
 
     return None
 
+# Get request to lease up to count jobs in one call
+# the jobs go back to pending if they are not completed before the lease expires
+def http_lease_jobs(worker_type: str = None, model_type: str = None, count: int = 1, lease_seconds: int = None):
+    url = SERVER_ADDRESS + "/queue/image-generation/lease-jobs"
+
+    query_params = {
+        "task_type": worker_type,
+        "model_type": model_type,
+        "count": count,
+        "lease_seconds": lease_seconds
+    }
+
+    url = get_url_with_query_params(url, query_params)
+
+    response = http_request(url, "GET")
+    if response is None:
+        return []
+
+    return response['response']['jobs']
+
 # get the list by dataset
 def http_get_list_by_dataset(dataset:str, model_type:str, min_clip_sigma_socre:float, size:int):
     """
@@ -71,7 +91,7 @@ def http_add_job(job):
     response = None
     
     try:
-        response = requests.post(url, json=job, headers=headers)
+        response = http_session.post(url, json=job, headers=headers)
         if response.status_code != 201 and response.status_code != 200:
             print(f"POST request failed with status code: {response.status_code}")
 
@@ -96,7 +116,7 @@ def http_add_kandinsky_job(job, positive_embedding, negative_embedding):
         "negative_embedding": negative_embedding
     }
     try:
-        response = requests.post(url, json=data, headers=headers)
+        response = http_session.post(url, json=data, headers=headers)
         if response.status_code != 201 and response.status_code != 200:
             print(f"POST request failed with status code: {response.status_code}")
 
@@ -111,13 +131,29 @@ def http_add_kandinsky_job(job, positive_embedding, negative_embedding):
     return decoded_response
 
 
+# add a list of jobs in one request
+def http_add_jobs(jobs):
+    url = SERVER_ADDRESS + "/queue/image-generation/add-jobs"
+    headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
+
+    return http_request(url, "POST", json_data=jobs, headers=headers)
+
+# add a list of kandinsky jobs in one request
+# each element is a dict with the job, positive_embedding and negative_embedding
+def http_add_kandinsky_jobs(kandinsky_jobs):
+    url = SERVER_ADDRESS + "/queue/image-generation/add-kandinsky-jobs"
+    headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
+
+    return http_request(url, "POST", json_data=kandinsky_jobs, headers=headers)
+
+
 def http_update_job_completed(job):
     url = SERVER_ADDRESS + "/queue/image-generation/update-completed"
     headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_session.put(url, json=job, headers=headers)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")    
     except Exception as e:
@@ -134,7 +170,7 @@ def http_update_job_failed(job):
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_session.put(url, json=job, headers=headers)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
     except Exception as e:
@@ -1,5 +1,5 @@
 from typing import Union
-import requests
+from utility.http import http_session
 import json
 from urllib.parse import urlencode
 from typing import Union
@@ -52,16 +52,16 @@ def http_request(url: str, method: str = "GET",
 
     try:
         # Make an HTTP request depends on the method
-        # if the method is GET then use requests.get()
-        # if the method is POST then use requests.post()
-        # if the method is PUT then use requests.put()
+        # if the method is GET then use http_session.get()
+        # if the method is POST then use http_session.post()
+        # if the method is PUT then use http_session.put()
         # otherwise, return None
         if method == "GET":
-            response = requests.get(url, params=params)
+            response = http_session.get(url, params=params)
         elif method == "POST":
-            response = requests.post(url, json=json_data, headers=headers)
+            response = http_session.post(url, json=json_data, headers=headers)
         elif method == "PUT":
-            response = requests.put(url, json=json_data, headers=headers)
+            response = http_session.put(url, json=json_data, headers=headers)
         else :
             print(f"Method: {method} not supported")
             return decoded_response
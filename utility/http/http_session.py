@@ -0,0 +1,195 @@
+# NOTE: don't add more imports here
+# this is also used by training workers
+import os
+import time
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# one pooled session per process for all the utility/http request functions
+# so the connections to the orchestration api are kept alive between calls
+#
+# failed connections are retried for every method,
+# failed responses only for the idempotent methods:
+# the post and put endpoints of the api add or move jobs, retrying them could apply them twice
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+DEFAULT_READ_TIMEOUT_SECONDS = 300
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_SECONDS = 0.5
+RETRY_STATUS_CODES = (502, 503, 504)
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+session_config = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "timeout": (DEFAULT_CONNECT_TIMEOUT_SECONDS, DEFAULT_READ_TIMEOUT_SECONDS),
+    "max_retries": DEFAULT_MAX_RETRIES,
+    "retry_backoff_seconds": DEFAULT_RETRY_BACKOFF_SECONDS,
+}
+
+session_lock = threading.Lock()
+session = None
+# sessions aren't shared with forked processes
+session_pid = None
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS_MS)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, latency_ms, failed):
+        for i, bucket_ms in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bucket_ms:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        if failed:
+            self.errors += 1
+
+    def get_percentile_ms(self, percentile):
+        # upper bound of the bucket the percentile falls in
+        target = self.count * percentile / 100
+        cumulative_count = 0
+        for bucket_ms, bucket_count in zip(LATENCY_BUCKETS_MS, self.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= target:
+                return min(bucket_ms, self.max_ms)
+
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": self.total_ms / self.count if self.count > 0 else 0.0,
+            "p50_ms": self.get_percentile_ms(50),
+            "p95_ms": self.get_percentile_ms(95),
+            "p99_ms": self.get_percentile_ms(99),
+            "max_ms": self.max_ms,
+            "buckets": {str(bucket_ms): bucket_count for bucket_ms, bucket_count in zip(LATENCY_BUCKETS_MS, self.bucket_counts)},
+        }
+
+
+latency_lock = threading.Lock()
+# (method, url path) => histogram
+latency_histograms = {}
+
+
+def configure_http_session(pool_size=None, timeout=None, max_retries=None, retry_backoff_seconds=None):
+    # the session is created again with the new config on the next request
+    global session
+
+    with session_lock:
+        if pool_size is not None:
+            session_config["pool_size"] = pool_size
+        if timeout is not None:
+            session_config["timeout"] = timeout
+        if max_retries is not None:
+            session_config["max_retries"] = max_retries
+        if retry_backoff_seconds is not None:
+            session_config["retry_backoff_seconds"] = retry_backoff_seconds
+
+        if session is not None:
+            session.close()
+        session = None
+
+
+def create_session():
+    retries = Retry(total=session_config["max_retries"],
+                    backoff_factor=session_config["retry_backoff_seconds"],
+                    status_forcelist=RETRY_STATUS_CODES,
+                    allowed_methods=RETRY_METHODS,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=session_config["pool_size"],
+                          pool_maxsize=session_config["pool_size"],
+                          max_retries=retries)
+
+    new_session = requests.Session()
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    return new_session
+
+
+def get_session():
+    global session, session_pid
+
+    with session_lock:
+        if session is None or session_pid != os.getpid():
+            session = create_session()
+            session_pid = os.getpid()
+
+        return session
+
+
+def record_latency(method, url, latency_ms, failed):
+    # query params are left out so every call of an endpoint goes in the same histogram
+    endpoint = (method, urlparse(url).path)
+    with latency_lock:
+        histogram = latency_histograms.get(endpoint)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            latency_histograms[endpoint] = histogram
+        histogram.add(latency_ms, failed)
+
+
+def http_session_request(method, url, **kwargs):
+    # same arguments as requests.request, with the session timeout by default
+    kwargs.setdefault("timeout", session_config["timeout"])
+
+    start_time = time.time()
+    failed = True
+    try:
+        response = get_session().request(method, url, **kwargs)
+        failed = response.status_code >= 400
+        return response
+    finally:
+        record_latency(method, url, (time.time() - start_time) * 1000, failed)
+
+
+def get(url, **kwargs):
+    return http_session_request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return http_session_request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return http_session_request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return http_session_request("DELETE", url, **kwargs)
+
+
+def get_latency_stats():
+    with latency_lock:
+        return {"{} {}".format(method, path): histogram.to_dict()
+                for (method, path), histogram in latency_histograms.items()}
+
+
+def print_latency_stats():
+    stats = get_latency_stats()
+    for endpoint, endpoint_stats in sorted(stats.items(), key=lambda item: -item[1]["count"]):
+        print("{}: count={}, errors={}, mean={:.1f}ms, p50<={:.0f}ms, p95<={:.0f}ms, p99<={:.0f}ms, max={:.1f}ms".format(
+            endpoint,
+            endpoint_stats["count"],
+            endpoint_stats["errors"],
+            endpoint_stats["mean_ms"],
+            endpoint_stats["p50_ms"],
+            endpoint_stats["p95_ms"],
+            endpoint_stats["p99_ms"],
+            endpoint_stats["max_ms"]))
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-import requests
+from utility.http import http_session
 import json
 from fastapi import Request
 from pymongo import MongoClient
@@ -20,7 +20,7 @@ def http_get_list_completed_jobs():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             job_json = response.json()
@@ -35,13 +35,38 @@ def http_get_list_completed_jobs():
             
     return None
 
+# Get the completed jobs added after the cursor
+# returns the list of jobs and the cursor to use in the next call
+def http_get_completed_jobs_since_cursor(cursor=None, limit=10000):
+    url = SERVER_ADDRESS + "/queue/image-generation/list-completed-jobs-since-cursor"
+    params = {"limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    response = None
+
+    try:
+        response = http_session.get(url, params=params)
+
+        if response.status_code == 200:
+            data_json = response.json()
+            return data_json['response']['jobs'], data_json['response']['next_cursor']
+
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return None, cursor
+
 # Get request to get sequential id of a dataset
 def http_get_sequential_id(dataset_name: str, limit: int):
     url = SERVER_ADDRESS + "/dataset/sequential-id/{0}?limit={1}".format(dataset_name, limit)
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         if response.status_code == 200:
             job_json = response.json()
             return job_json
@@ -61,7 +86,7 @@ def http_get_self_training_sequential_id(dataset_name: str):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
         if response.status_code == 200:
             job_json = response.json()
             return job_json["sequential_id"]
@@ -82,7 +107,7 @@ def http_add_model(model_card):
     response = None
 
     try:
-        response = requests.post(url, data=model_card, headers=headers)
+        response = http_session.post(url, data=model_card, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -103,7 +128,7 @@ def http_add_classifier_model(model_card):
     response = None
 
     try:
-        response = requests.post(url, data=model_card, headers=headers)
+        response = http_session.post(url, data=model_card, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -123,7 +148,7 @@ def http_get_model_id(model_hash):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -142,7 +167,7 @@ def http_get_classifier_model_list():
     url = SERVER_ADDRESS + "/pseudotag-classifiers/list-classifiers"
     response = None
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -161,7 +186,7 @@ def http_get_rank_list():
     url = SERVER_ADDRESS + "/ab-rank/list-rank-models"
     response = None
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -180,7 +205,7 @@ def http_get_ranking_model_list():
     url = SERVER_ADDRESS + "/ranking-models/list-ranking-models"
     response = None
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -201,7 +226,7 @@ def http_add_ranking_model(model_data):
     response = None
 
     try:
-        response = requests.post(url, data=model_data, headers=headers)
+        response = http_session.post(url, data=model_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -222,7 +247,7 @@ def http_add_score(score_data):
     response = None
 
     try:
-        response = requests.post(url, json=score_data, headers=headers)
+        response = http_session.post(url, json=score_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -242,7 +267,7 @@ def http_add_classifier_score(score_data, image_source= "generated_image"):
     response = None
     
     try:
-        response = requests.post(url, json=score_data, headers=headers, params=params)
+        response = http_session.post(url, json=score_data, headers=headers, params=params)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -262,7 +287,7 @@ def http_add_classifier_score_batch(scores_batch):
     response = None
     
     try:
-        response = requests.post(url, json=scores_batch, headers=headers)
+        response = http_session.post(url, json=scores_batch, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -281,7 +306,7 @@ def http_add_rank_score_batch(scores_batch):
     response = None
     
     try:
-        response = requests.post(url, json=scores_batch, headers=headers)
+        response = http_session.post(url, json=scores_batch, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -294,13 +319,95 @@ def http_add_rank_score_batch(scores_batch):
 
     return None
 
+# the bulk endpoints read newline delimited json, one object per line
+NDJSON_LINES_PER_CHUNK = 1000
+# number of objects sent in one request to the bulk endpoints
+BULK_UPLOAD_CHUNK_SIZE = 10000
+
+def iterate_ndjson_chunks(data_list):
+    # the body is streamed in chunks of lines
+    # so it's never serialized in memory all at once
+    for i in range(0, len(data_list), NDJSON_LINES_PER_CHUNK):
+        lines = [json.dumps(data) for data in data_list[i:i + NDJSON_LINES_PER_CHUNK]]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+def http_post_ndjson(url, data_list):
+    headers = {"Content-type": "application/x-ndjson"}
+    response = None
+
+    try:
+        response = http_session.post(url, data=iterate_ndjson_chunks(data_list), headers=headers)
+
+        if response.status_code != 200:
+            print(f"request failed with status code: {response.status_code}: {str(response.content)}")
+            return None
+
+        return response.json()["response"]
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return None
+
+def http_add_rank_scores_bulk(scores):
+    url = SERVER_ADDRESS + "/image-scores/scores/set-rank-scores-bulk"
+    return http_post_ndjson(url, scores)
+
+def http_add_classifier_scores_bulk(scores):
+    url = SERVER_ADDRESS + "/pseudotag-classifier-scores/set-image-classifier-scores-bulk"
+    return http_post_ndjson(url, scores)
+
+def http_add_sigma_scores_bulk(sigma_scores):
+    url = SERVER_ADDRESS + "/image-scores/sigma-scores/set-image-rank-sigma-scores-bulk"
+    return http_post_ndjson(url, sigma_scores)
+
+def http_add_percentiles_bulk(percentiles):
+    url = SERVER_ADDRESS + "/image-scores/percentiles/set-image-rank-percentiles-bulk"
+    return http_post_ndjson(url, percentiles)
+
+def http_upload_in_chunks(http_add_bulk, data_list, chunk_size=BULK_UPLOAD_CHUNK_SIZE):
+    # http_add_bulk is one of the http_add_*_bulk functions
+    # returns the upserted, modified, invalid and failed (not sent) counts
+    num_upserted = 0
+    num_modified = 0
+    num_invalid = 0
+    num_failed = 0
+    for i in range(0, len(data_list), chunk_size):
+        counts = http_add_bulk(data_list[i:i + chunk_size])
+        if counts is None:
+            print("Failed to upload {} to {}".format(i, min(i + chunk_size, len(data_list))))
+            num_failed += len(data_list[i:i + chunk_size])
+            continue
+
+        num_upserted += counts["upserted"]
+        num_modified += counts["modified"]
+        num_invalid += counts["invalid"]
+
+    print("Upserted={}, modified={}, invalid={}, failed={}".format(num_upserted, num_modified, num_invalid, num_failed))
+    if num_invalid > 0 or num_failed > 0:
+        # invalid objects are skipped by the server, the upload doesn't fail
+        print("WARNING: {} of {} objects were not written ({} invalid, {} failed)".format(num_invalid + num_failed,
+                                                                                         len(data_list),
+                                                                                         num_invalid,
+                                                                                         num_failed))
+
+    return {
+        "upserted": num_upserted,
+        "modified": num_modified,
+        "invalid": num_invalid,
+        "failed": num_failed
+    }
+
 def http_add_sigma_score(sigma_score_data):
     url = SERVER_ADDRESS + "/sigma-score/set-image-rank-sigma-score"
     headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
     response = None
 
     try:
-        response = requests.post(url, json=sigma_score_data, headers=headers)
+        response = http_session.post(url, json=sigma_score_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -320,7 +427,7 @@ def http_add_residual(residual_data):
     response = None
 
     try:
-        response = requests.put(url, json=residual_data, headers=headers)
+        response = http_session.put(url, json=residual_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -340,7 +447,7 @@ def http_add_percentile(percentile_data):
     response = None
 
     try:
-        response = requests.post(url, json=percentile_data, headers=headers)
+        response = http_session.post(url, json=percentile_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -360,7 +467,7 @@ def http_add_residual_percentile(residual_percentile_data):
     response = None
 
     try:
-        response = requests.post(url, json=residual_percentile_data, headers=headers)
+        response = http_session.post(url, json=residual_percentile_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -380,7 +487,7 @@ def http_get_dataset_names():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -402,7 +509,7 @@ def http_get_completed_job_by_image_hash(image_hash):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -450,7 +557,7 @@ def http_add_score_attributes(model_type,
     response = None
 
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_session.put(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -516,7 +623,7 @@ def http_add_score_attributes_v1(model_type, img_hash, image_clip_score, image_c
     response = None
 
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_session.put(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print(f"Request failed with status code: {response.status_code}: {str(response.content)}")
@@ -538,7 +645,7 @@ def http_update_ranking_delta_scores():
     response = None
 
     try:
-        response = requests.post(url, headers=headers)
+        response = http_session.post(url, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -557,7 +664,7 @@ def http_get_completed_job_by_uuid(job_uuid):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -578,7 +685,7 @@ def http_get_completed_job_by_dataset(dataset, limit=9999999):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -608,7 +715,7 @@ def http_get_completed_jobs_by_uuids(job_uuids):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -625,7 +732,7 @@ def http_get_completed_jobs_by_uuids(job_uuids):
 def http_get_tag_list():
     url = SERVER_ADDRESS + "/tags/list-tag-definitions"
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -638,7 +745,7 @@ def http_get_tag_list():
 def http_get_tagged_images(tag_id):
     url = SERVER_ADDRESS + "/tags/get-images-by-tag-id/?tag_id={}".format(tag_id)
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -651,7 +758,7 @@ def http_get_tagged_images(tag_id):
 def http_get_tagged_images_by_image_type(tag_id, image_type = "all_resolutions"):
     url = SERVER_ADDRESS + "/tags/get-images-by-image-type/?tag_id={}&image_type={}".format(tag_id, image_type)
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -667,7 +774,7 @@ def http_get_tagged_images_by_resolution(tag_id, source = None):
     else:
         url = SERVER_ADDRESS + "/tags/get-images-by-resolution/?tag_id={}&source={}".format(tag_id, source)
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -679,7 +786,7 @@ def http_get_tagged_images_by_resolution(tag_id, source = None):
 def http_get_tagged_extracts(tag_id):
     url = SERVER_ADDRESS + "/tags/get-images-by-tag-id-v1/?tag_id={}".format(tag_id)
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -692,7 +799,7 @@ def http_get_tagged_extracts(tag_id):
 def http_get_random_image_list(dataset, size):
     url = SERVER_ADDRESS + "/image/get_random_image_list?dataset={}&size={}".format(dataset, size)
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -712,7 +819,7 @@ def http_get_random_image_by_date(dataset, size, start_date=None, end_date=None)
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_session.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -720,3 +827,39 @@ def http_get_random_image_by_date(dataset, size, start_date=None, end_date=None)
 
     except Exception as e:
         print('request exception ', e)
+
+def http_add_image_hashes_bulk(image_hash_list):
+    url = SERVER_ADDRESS + "/image-hashes/add-image-hashes-bulk"
+    headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
+    response = None
+
+    try:
+        response = http_session.post(url, json={"image_hash_list": image_hash_list}, headers=headers)
+
+        if response.status_code != 200:
+            print(f"request failed with status code: {response.status_code}: {str(response.content)}")
+            return None
+
+        return response.json()["response"]["data"]
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return None
+
+def http_register_image_hashes(image_hash_list, chunk_size=BULK_UPLOAD_CHUNK_SIZE):
+    # returns image hash => image global id
+    image_hash_to_global_id = {}
+    for i in range(0, len(image_hash_list), chunk_size):
+        image_hashes = http_add_image_hashes_bulk(image_hash_list[i:i + chunk_size])
+        if image_hashes is None:
+            print("Failed to register image hashes {} to {}".format(i, min(i + chunk_size, len(image_hash_list))))
+            continue
+
+        for image_hash in image_hashes:
+            image_hash_to_global_id[image_hash["image_hash"]] = image_hash["image_global_id"]
+
+    return image_hash_to_global_id
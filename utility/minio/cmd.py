@@ -1,7 +1,9 @@
 from minio import Minio
 import os
 import requests
+import urllib3
 from .progress import Progress
+from .listing import iterate_objects_with_prefix, get_list_of_objects_with_prefix_cached
 from utility.utils_logger import logger
 
 # TODO: remove hardcode in the future
@@ -24,14 +26,25 @@ def get_minio_client(minio_access_key, minio_secret_key, minio_ip_addr=None):
             return minio_client
 
 
-def connect_to_minio_client(minio_ip_addr=None, access_key=None, secret_key=None,):
+def connect_to_minio_client(minio_ip_addr=None, access_key=None, secret_key=None, max_pool_size=None):
     global MINIO_ADDRESS
 
     if minio_ip_addr is not None:
         MINIO_ADDRESS = minio_ip_addr
 
+    # by default the minio client keeps 10 connections alive
+    # clients used from many threads need a bigger pool
+    # otherwise the extra connections are opened and closed on every request
+    http_client = None
+    if max_pool_size is not None:
+        http_client = urllib3.PoolManager(
+            maxsize=max_pool_size,
+            timeout=urllib3.Timeout(connect=10, read=60),
+            retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+        )
+
     print("Connecting to minio client...")
-    client = Minio(MINIO_ADDRESS, access_key, secret_key, secure=False)
+    client = Minio(MINIO_ADDRESS, access_key, secret_key, secure=False, http_client=http_client)
     print("Successfully connected to minio client...")
     return client
 
@@ -145,14 +158,13 @@ def get_list_of_objects(client, bucket_name):
 
 
 
-def get_list_of_objects_with_prefix(client, bucket_name, prefix):
-    object_names = []
-    objects = client.list_objects(bucket_name, prefix=prefix, recursive=True)
-
-    for obj in objects:
-        object_names.append(obj.object_name)
+def get_list_of_objects_with_prefix(client, bucket_name, prefix, use_cache=False):
+    # the sub prefixes are listed in parallel, see listing.py
+    # with use_cache the listing is kept on disk and only the new objects are listed again
+    if use_cache:
+        return get_list_of_objects_with_prefix_cached(client, bucket_name, prefix)
 
-    return object_names
+    return list(iterate_objects_with_prefix(client, bucket_name, prefix))
 
 
 def upload_from_file(client, bucket_name, object_name, file_path):
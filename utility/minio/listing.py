@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# listing of the objects of a prefix split over its sub prefixes
+# (datasets/<dataset>/0000/.., ranks/<date>/..), each listed by a thread
+#
+# objects are listed in lexicographic order, the sub prefixes are
+# listed in parallel but their objects are yielded in order,
+# so the listing streams in the same order as a serial list_objects
+#
+# listings can also be kept on disk, the snapshot is refreshed by listing
+# each sub prefix only after the last key the snapshot has of it (the last one in full),
+# and walked again once it's older than its ttl
+# objects written late into an older sub prefix are missed until then, so callers
+# that need every object (the scorers, etc.) list without the cache
+
+DEFAULT_LISTING_WORKERS = 8
+# sub prefixes listed ahead of the one being yielded, per worker
+LISTING_PREFETCH_FACTOR = 2
+# levels of sub prefixes expanded to get at least one sub prefix per worker
+MAX_PARTITION_DEPTH = 2
+
+DEFAULT_LISTING_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "minio-listings")
+DEFAULT_LISTING_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+
+def is_before(prefix, start_after):
+    # true if every object name starting with prefix is <= start_after
+    return start_after is not None and prefix <= start_after and not start_after.startswith(prefix)
+
+
+def list_prefix_entries(client, bucket_name, prefix, start_after=None):
+    # one level of the prefix, sorted (object name, is sub prefix) pairs
+    entries = []
+    for obj in client.list_objects(bucket_name, prefix=prefix, recursive=False):
+        if obj.is_dir:
+            if not is_before(obj.object_name, start_after):
+                entries.append((obj.object_name, True))
+        elif start_after is None or obj.object_name > start_after:
+            entries.append((obj.object_name, False))
+
+    # objects and sub prefixes come in separate lists
+    entries.sort()
+
+    return entries
+
+
+def partition_prefix(client, bucket_name, prefix, num_partitions, start_after=None):
+    entries = [(prefix, True)]
+    for _ in range(MAX_PARTITION_DEPTH):
+        num_sub_prefixes = sum(1 for _, is_sub_prefix in entries if is_sub_prefix)
+        if num_sub_prefixes == 0 or num_sub_prefixes >= num_partitions:
+            break
+
+        expanded_entries = []
+        for name, is_sub_prefix in entries:
+            if is_sub_prefix:
+                expanded_entries.extend(list_prefix_entries(client, bucket_name, name, start_after))
+            else:
+                expanded_entries.append((name, is_sub_prefix))
+        entries = expanded_entries
+
+    return entries
+
+
+def list_sub_prefix(client, bucket_name, prefix, start_after=None):
+    if is_before(prefix, start_after):
+        # the whole prefix is before start_after
+        return []
+
+    if start_after is not None and not start_after.startswith(prefix):
+        # the whole prefix is after start_after
+        start_after = None
+
+    return [obj.object_name for obj in client.list_objects(bucket_name,
+                                                           prefix=prefix,
+                                                           recursive=True,
+                                                           start_after=start_after)]
+
+
+def iterate_entries(client, bucket_name, entries, num_workers, get_start_after):
+    # entries are the sorted (object name, is sub prefix) pairs of partition_prefix
+    # the sub prefixes are listed after get_start_after(sub prefix)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        entry_iterator = iter(entries)
+
+        def fill_pending():
+            while len(pending) < num_workers * LISTING_PREFETCH_FACTOR:
+                entry = next(entry_iterator, None)
+                if entry is None:
+                    return
+                name, is_sub_prefix = entry
+                if is_sub_prefix:
+                    pending.append(executor.submit(list_sub_prefix, client, bucket_name, name, get_start_after(name)))
+                else:
+                    pending.append(name)
+
+        try:
+            fill_pending()
+            while len(pending) > 0:
+                entry = pending.popleft()
+                fill_pending()
+                if isinstance(entry, str):
+                    yield entry
+                else:
+                    yield from entry.result()
+        finally:
+            # the generator might be closed before the end
+            for entry in pending:
+                if not isinstance(entry, str):
+                    entry.cancel()
+
+
+def iterate_objects_with_prefix(client, bucket_name, prefix, num_workers=DEFAULT_LISTING_WORKERS, start_after=None):
+    # yields the names of the objects of the prefix that are after start_after, in order
+    entries = partition_prefix(client, bucket_name, prefix, num_workers, start_after)
+
+    yield from iterate_entries(client, bucket_name, entries, num_workers, lambda sub_prefix: start_after)
+
+
+def get_last_key_with_prefix(sorted_object_names, prefix):
+    if prefix == "":
+        return sorted_object_names[-1] if len(sorted_object_names) > 0 else None
+
+    # the names starting with prefix are between prefix and prefix with its last character incremented
+    end = bisect.bisect_left(sorted_object_names, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if end > 0 and sorted_object_names[end - 1].startswith(prefix):
+        return sorted_object_names[end - 1]
+
+    return None
+
+
+def iterate_new_objects_with_prefix(client, bucket_name, prefix, sorted_object_names, num_workers=DEFAULT_LISTING_WORKERS):
+    # yields the names of the objects of the prefix that are not in sorted_object_names, in order
+    # objects are only found if they're after the last known object of their sub prefix,
+    # which is where new images, dates, etc. are added, except in the last sub prefix
+    # which is listed again in full, since it's the one still being written to
+    entries = partition_prefix(client, bucket_name, prefix, num_workers)
+    sub_prefixes = [name for name, is_sub_prefix in entries if is_sub_prefix]
+    tail_sub_prefix = sub_prefixes[-1] if len(sub_prefixes) > 0 else None
+
+    def is_known(name):
+        index = bisect.bisect_left(sorted_object_names, name)
+        return index < len(sorted_object_names) and sorted_object_names[index] == name
+
+    def get_start_after(sub_prefix):
+        if sub_prefix == tail_sub_prefix:
+            return None
+        return get_last_key_with_prefix(sorted_object_names, sub_prefix)
+
+    new_entries = [(name, is_sub_prefix) for name, is_sub_prefix in entries if is_sub_prefix or not is_known(name)]
+    for name in iterate_entries(client, bucket_name, new_entries, num_workers, get_start_after):
+        if not is_known(name):
+            yield name
+
+
+def get_listing_cache_paths(bucket_name, prefix, cache_directory):
+    key = hashlib.sha1("{}/{}".format(bucket_name, prefix).encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory, key + ".json"), os.path.join(cache_directory, key + ".keys")
+
+
+def load_listing_snapshot(metadata_path, keys_path):
+    if not os.path.exists(metadata_path) or not os.path.exists(keys_path):
+        return None, []
+
+    with open(metadata_path, 'r') as file:
+        metadata = json.load(file)
+
+    with open(keys_path, 'r', encoding='utf-8') as file:
+        object_names = file.read().splitlines()
+
+    if len(object_names) != metadata["num_keys"]:
+        return None, []
+
+    return metadata, object_names
+
+
+def save_listing_snapshot(metadata_path, keys_path, metadata, object_names):
+    # the old snapshot is invalid while its keys are replaced
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    temp_path = "{}.{}.tmp".format(keys_path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        for name in object_names:
+            file.write(name + "\n")
+    os.replace(temp_path, keys_path)
+
+    metadata["num_keys"] = len(object_names)
+    temp_path = "{}.{}.tmp".format(metadata_path, os.getpid())
+    with open(temp_path, 'w') as file:
+        json.dump(metadata, file)
+    os.replace(temp_path, metadata_path)
+
+
+def get_list_of_objects_with_prefix_cached(client,
+                                           bucket_name,
+                                           prefix,
+                                           ttl_seconds=DEFAULT_LISTING_CACHE_TTL_SECONDS,
+                                           cache_directory=DEFAULT_LISTING_CACHE_DIRECTORY,
+                                           num_workers=DEFAULT_LISTING_WORKERS):
+    # objects added at the end of their sub prefix or anywhere in the last sub prefix
+    # are picked up on every call, removed objects are only dropped once the snapshot expires
+    os.makedirs(cache_directory, exist_ok=True)
+    metadata_path, keys_path = get_listing_cache_paths(bucket_name, prefix, cache_directory)
+    start_time = time.time()
+
+    try:
+        metadata, object_names = load_listing_snapshot(metadata_path, keys_path)
+    except Exception as e:
+        print("Error loading the listing snapshot of {}/{}: {}".format(bucket_name, prefix, e))
+        metadata, object_names = None, []
+
+    if metadata is not None and start_time - metadata["created_time"] <= ttl_seconds:
+        new_object_names = list(iterate_new_objects_with_prefix(client, bucket_name, prefix, object_names, num_workers))
+        if len(new_object_names) > 0:
+            object_names = list(heapq.merge(object_names, new_object_names))
+            metadata["refreshed_time"] = start_time
+            save_listing_snapshot(metadata_path, keys_path, metadata, object_names)
+
+        print("Listed {} objects of {}/{}, {} new since the snapshot, in {:.2f}s".format(len(object_names),
+                                                                                       bucket_name,
+                                                                                       prefix,
+                                                                                       len(new_object_names),
+                                                                                       time.time() - start_time))
+        return object_names
+
+    object_names = list(iterate_objects_with_prefix(client, bucket_name, prefix, num_workers=num_workers))
+    save_listing_snapshot(metadata_path, keys_path, {
+        "bucket_name": bucket_name,
+        "prefix": prefix,
+        "created_time": start_time,
+        "refreshed_time": start_time,
+    }, object_names)
+
+    print("Listed {} objects of {}/{} in {:.2f}s".format(len(object_names),
+                                                         bucket_name,
+                                                         prefix,
+                                                         time.time() - start_time))
+    return object_names
@@ -0,0 +1,197 @@
+import io
+import time
+import random
+import threading
+import traceback
+from collections import deque
+
+# uploads run on a fixed pool of threads
+# the data waiting to be uploaded is capped in bytes,
+# when the cap is reached submit() blocks the producer until uploads complete
+# failed uploads are retried with exponential backoff
+
+DEFAULT_UPLOAD_WORKERS = 8
+DEFAULT_MAX_QUEUED_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_SECONDS = 1.0
+MAX_RETRY_BACKOFF_SECONDS = 30.0
+
+
+def get_data_size(data):
+    # approximate size in bytes of the data an upload task holds on to
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    if isinstance(data, io.BytesIO):
+        return data.getbuffer().nbytes
+    if isinstance(data, str):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(get_data_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(get_data_size(value) for value in data)
+    # numpy arrays
+    if hasattr(data, "nbytes"):
+        return int(data.nbytes)
+    # torch tensors
+    if hasattr(data, "element_size") and hasattr(data, "nelement"):
+        return data.element_size() * data.nelement()
+    # PIL images
+    if hasattr(data, "getbands") and hasattr(data, "size"):
+        width, height = data.size
+        return width * height * len(data.getbands())
+
+    return 0
+
+
+def rewind_buffers(data):
+    # a failed upload may have read part of its buffers
+    # they're rewound so the retry uploads the data from the start
+    if isinstance(data, io.IOBase) and data.seekable():
+        data.seek(0)
+    elif isinstance(data, dict):
+        for value in data.values():
+            rewind_buffers(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            rewind_buffers(value)
+
+
+class UploadTask:
+    def __init__(self, function, args, kwargs, size):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.size = size
+
+
+class UploadService:
+    def __init__(self,
+                 num_workers=DEFAULT_UPLOAD_WORKERS,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 retry_backoff_seconds=DEFAULT_RETRY_BACKOFF_SECONDS,
+                 name="upload service"):
+        self.num_workers = num_workers
+        self.max_queued_bytes = max_queued_bytes
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.name = name
+
+        self.condition = threading.Condition()
+        self.tasks = deque()
+        # bytes of the tasks that are queued or running
+        self.pending_bytes = 0
+        self.num_pending_tasks = 0
+
+        # counters
+        self.start_time = time.time()
+        self.num_submitted = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_retries = 0
+        self.completed_bytes = 0
+        self.producer_wait_time = 0.0
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self.run_worker, name="{} worker {}".format(name, i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, function, *args, size=None, **kwargs):
+        # queues function(*args, **kwargs)
+        # size is the number of bytes the task holds on to, computed from the arguments if not given
+        # blocks while the queued bytes are over the cap
+        if size is None:
+            size = get_data_size(args) + get_data_size(kwargs)
+
+        with self.condition:
+            wait_start_time = time.time()
+            # a task bigger than the cap is still accepted when nothing else is pending
+            while self.pending_bytes > 0 and self.pending_bytes + size > self.max_queued_bytes:
+                self.condition.wait()
+            self.producer_wait_time += time.time() - wait_start_time
+
+            self.tasks.append(UploadTask(function, args, kwargs, size))
+            self.pending_bytes += size
+            self.num_pending_tasks += 1
+            self.num_submitted += 1
+            self.condition.notify_all()
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                while len(self.tasks) == 0:
+                    self.condition.wait()
+                task = self.tasks.popleft()
+
+            succeeded = self.run_task(task)
+
+            with self.condition:
+                self.pending_bytes -= task.size
+                self.num_pending_tasks -= 1
+                if succeeded:
+                    self.num_completed += 1
+                    self.completed_bytes += task.size
+                else:
+                    self.num_failed += 1
+                self.condition.notify_all()
+
+    def run_task(self, task):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if attempt > 0:
+                    rewind_buffers(task.args)
+                    rewind_buffers(task.kwargs)
+                task.function(*task.args, **task.kwargs)
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print("{}: upload failed after {} attempts: {}".format(self.name, attempt + 1, traceback.format_exc()))
+                    return False
+
+                backoff = min(self.retry_backoff_seconds * (2 ** attempt), MAX_RETRY_BACKOFF_SECONDS)
+                # jitter so that failed uploads don't retry all at once
+                backoff *= random.uniform(0.5, 1.0)
+                print("{}: upload failed, retrying in {:.2f}s: {}".format(self.name, backoff, e))
+
+                with self.condition:
+                    self.num_retries += 1
+                time.sleep(backoff)
+
+    def join(self):
+        # waits until every submitted task is done
+        with self.condition:
+            while self.num_pending_tasks > 0:
+                self.condition.wait()
+
+    def get_stats(self):
+        with self.condition:
+            elapsed_time = max(time.time() - self.start_time, 1e-6)
+            return {
+                "queued_tasks": len(self.tasks),
+                "pending_tasks": self.num_pending_tasks,
+                "pending_bytes": self.pending_bytes,
+                "submitted": self.num_submitted,
+                "completed": self.num_completed,
+                "failed": self.num_failed,
+                "retries": self.num_retries,
+                "completed_bytes": self.completed_bytes,
+                "tasks_per_second": self.num_completed / elapsed_time,
+                "bytes_per_second": self.completed_bytes / elapsed_time,
+                "producer_wait_time": self.producer_wait_time,
+            }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print("{}: queued={}, pending={} ({:.2f}MB), completed={}, failed={}, retries={}, "
+              "throughput={:.2f} uploads/s {:.2f}MB/s, producer wait={:.2f}s".format(self.name,
+                                                                                    stats["queued_tasks"],
+                                                                                    stats["pending_tasks"],
+                                                                                    stats["pending_bytes"] / (1024 * 1024),
+                                                                                    stats["completed"],
+                                                                                    stats["failed"],
+                                                                                    stats["retries"],
+                                                                                    stats["tasks_per_second"],
+                                                                                    stats["bytes_per_second"] / (1024 * 1024),
+                                                                                    stats["producer_wait_time"]))
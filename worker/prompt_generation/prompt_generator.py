@@ -576,6 +576,7 @@ def generate_image_generation_jobs_using_generated_prompts(csv_dataset_path,
     sequential_ids = request.http_get_sequential_id(dataset_name, prompt_count)
 
     count = 0
+    generation_task_json_list = []
     # generate jobs
     for prompt in prompts:
         # generate UUID
@@ -605,12 +606,13 @@ def generate_image_generation_jobs_using_generated_prompts(csv_dataset_path,
                                          model_file_path=model_file_path,
                                          task_input_dict=task_input_dict)
         generation_task_json = generation_task.to_dict()
-
-        # add job
-        generation_request.http_add_job(generation_task_json)
+        generation_task_json_list.append(generation_task_json)
 
         count += 1
 
+    # add all the jobs in one request
+    generation_request.http_add_jobs(generation_task_json_list)
+
 
 def generate_inpainting_generation_jobs_using_generated_prompts(csv_dataset_path,
                                                                 prompt_count,
@@ -629,6 +631,7 @@ def generate_inpainting_generation_jobs_using_generated_prompts(csv_dataset_path
     sequential_ids = request.http_get_sequential_id(dataset_name, prompt_count)
 
     count = 0
+    generation_task_json_list = []
     # generate jobs
     for prompt in prompts:
         # generate UUID
@@ -667,12 +670,13 @@ def generate_inpainting_generation_jobs_using_generated_prompts(csv_dataset_path
                                          model_file_path=model_file_path,
                                          task_input_dict=task_input_dict)
         generation_task_json = generation_task.to_dict()
-
-        # add job
-        generation_request.http_add_job(generation_task_json)
+        generation_task_json_list.append(generation_task_json)
 
         count += 1
 
+    # add all the jobs in one request
+    generation_request.http_add_jobs(generation_task_json_list)
+
 
 def run_generate_image_generation_task(generation_task: GenerationTask):
     generate_image_generation_jobs_using_generated_prompts(
@@ -169,18 +169,19 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_job_if_exist(worker_type_list):
-    job = None
+def get_jobs_if_exist(worker_type_list, count):
+    # leases up to count jobs in one request per worker type
+    jobs = []
     for worker_type in worker_type_list:
         if worker_type == "":
-            job = generation_request.http_get_job(model_type="sd_1_5")
+            jobs = generation_request.http_lease_jobs(model_type="sd_1_5", count=count)
         else:
-            job = generation_request.http_get_job(worker_type, model_type="sd_1_5")
+            jobs = generation_request.http_lease_jobs(worker_type, model_type="sd_1_5", count=count)
 
-        if job is not None:
+        if len(jobs) > 0:
             break
 
-    return job
+    return jobs
 
 
 def upload_data_and_update_job_status(job, output_file_path, output_file_hash, data, minio_client):
@@ -354,12 +355,11 @@ def process_jobs(worker_state):
                                                                           generation_task.task_input_dict[
                                                                               "negative_prompt"],
                                                                           worker_state.clip_text_embedder)
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_image_data_and_update_job_status,
                         worker_state, job, generation_task, -1, inpainting_latent, output_file_path, output_file_hash, job_completion_time,
                         img_data, prompt_embedding, prompt_embedding_average_pooled, prompt_embedding_max_pooled,
-                        prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'image_generation_sd_1_5':
                     output_file_path, output_file_hash, img_data, latent, seed = run_image_generation_task(worker_state,
@@ -381,22 +381,20 @@ def process_jobs(worker_state):
                                                                               "negative_prompt"],
                                                                           worker_state.clip_text_embedder)
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_image_data_and_update_job_status,
                         worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash,
                         job_completion_time, img_data, prompt_embedding, prompt_embedding_average_pooled,
-                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'clip_calculation_task_sd_1_5':
                     output_file_path, output_file_hash, clip_data = run_clip_calculation_task(worker_state,
                                                                                               generation_task,
                                                                                               model_type="sd_1_5")
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_data_and_update_job_status, args=(
-                        job, output_file_path, output_file_hash, clip_data, worker_state.minio_client,))
-                    thread.start()
+                    # queue the upload of the data and the job update
+                    worker_state.upload_service.submit(upload_data_and_update_job_status,
+                        job, output_file_path, output_file_hash, clip_data, worker_state.minio_client)
 
                 elif task_type == "generate_image_generation_task":
                     # run generate image generation task
@@ -425,6 +423,7 @@ def process_jobs(worker_state):
             last_job_time = job_end_time
             job_elapsed_time = job_end_time - job_start_time
             info(thread_state, f"job took {job_elapsed_time:.4f} seconds to execute.")
+            worker_state.upload_service.print_stats()
 
         else:
             # If there was no job, go to sleep for a while
@@ -472,13 +471,15 @@ def main():
             time.sleep(sleep_time_in_seconds)
             continue
 
-        # try to find a job
-        # if job exists add it to job queue
+        # try to find jobs to fill the queue
+        # if jobs exist add them to job queue
         # if not sleep for a while
-        job = get_job_if_exist(worker_type_list)
-        if job != None:
-            info(thread_state, 'Found job ! ')
-            worker_state.job_queue.put(job)
+        num_free_slots = worker_state.queue_size - worker_state.job_queue.qsize()
+        jobs = get_jobs_if_exist(worker_type_list, num_free_slots)
+        if len(jobs) > 0:
+            info(thread_state, 'Found {} jobs ! '.format(len(jobs)))
+            for job in jobs:
+                worker_state.job_queue.put(job)
             info(thread_state, 'Queue size ' + str(worker_state.job_queue.qsize()))
 
         else:
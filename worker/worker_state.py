@@ -6,6 +6,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio.cmd import get_minio_client
+from utility.minio.upload_service import UploadService
 from stable_diffusion import StableDiffusion, CLIPTextEmbedder
 from configs.model_config import ModelPathConfig
 from stable_diffusion.model_paths import (SDconfigs, CLIPconfigs)
@@ -21,6 +22,8 @@ class WorkerState:
         self.minio_client = get_minio_client(minio_access_key, minio_secret_key)
         self.queue_size = queue_size
         self.job_queue = queue.Queue()
+        # uploads of the generated data, bounded so the jobs wait when minio can't keep up
+        self.upload_service = UploadService(name="worker uploads")
         self.load_clip = load_clip
         if load_clip:
             self.clip = clip.ClipModel(device=device)